@@ -0,0 +1,122 @@
+"""
+BERTScore with the reference embeddings cached on disk.
+
+The references of a benchmark (e.g. MusicCaps captions) are the same for every
+checkpoint evaluated, so `CachedBERTScorer` embeds each reference text once and keeps
+its contextual embeddings in `<cache_dir>/<model>-L<layers>.pt`, keyed by the hash
+of the text. Comparing a new checkpoint then only embeds its predictions, in
+length-sorted batches of `batch_size`.
+
+Scores are those of `bert_score` with its defaults for lang="en" (roberta-large,
+layer 17, no idf weighting, no baseline rescaling): token embeddings of the chosen
+layer, normalized, without the special tokens, greedily matched by cosine
+similarity. The cache stores the embeddings in fp16, which moves scores by about
+1e-4.
+"""
+
+import hashlib
+import os
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoModel, AutoTokenizer
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class CachedBERTScorer:
+    def __init__(
+        self,
+        model_type="roberta-large",
+        num_layers=17,
+        cache_dir=None,
+        batch_size=64,
+        device=None,
+    ):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_type)
+        model = AutoModel.from_pretrained(model_type)
+        # the output of the last kept layer is the layer BERTScore uses
+        model.encoder.layer = model.encoder.layer[:num_layers]
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = model.to(device).eval()
+        self.device = device
+        self.batch_size = batch_size
+        self.cache_path = None
+        self.references = {}
+        if cache_dir is not None:
+            name = f"{model_type.replace('/', '--')}-L{num_layers}.pt"
+            self.cache_path = os.path.join(os.path.expanduser(cache_dir), name)
+            if os.path.exists(self.cache_path):
+                self.references = torch.load(self.cache_path)
+
+    def _encode(self, text):
+        kwargs = {}
+        if self.tokenizer.__class__.__name__.startswith(("GPT2", "Roberta")):
+            # as bert_score: the first word is tokenized like any other
+            kwargs["add_prefix_space"] = True
+        return self.tokenizer.encode(
+            text.strip(),
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.tokenizer.model_max_length,
+            **kwargs,
+        )
+
+    @torch.inference_mode()
+    def embed(self, texts):
+        """Normalized token embeddings of each text, without the special tokens."""
+        ids = [self._encode(text) for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: len(ids[i]))
+        pad_token_id = self.tokenizer.pad_token_id or 0
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            max_len = len(ids[batch[-1]])
+            input_ids = torch.full((len(batch), max_len), pad_token_id)
+            attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+            for row, i in enumerate(batch):
+                input_ids[row, : len(ids[i])] = torch.tensor(ids[i])
+                attention_mask[row, : len(ids[i])] = 1
+            hidden = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+            ).last_hidden_state
+            hidden = F.normalize(hidden.float(), dim=-1).cpu()
+            for row, i in enumerate(batch):
+                embeddings[i] = hidden[row, 1 : len(ids[i]) - 1].half()
+        return embeddings
+
+    def reference_embeddings(self, references):
+        """Embeddings of `references`, embedding (and caching) only new texts."""
+        digests = [text_digest(text) for text in references]
+        missing = {d: text for d, text in zip(digests, references)}
+        missing = {d: text for d, text in missing.items() if d not in self.references}
+        if missing:
+            embedded = self.embed(list(missing.values()))
+            self.references.update(zip(missing, embedded))
+            if self.cache_path is not None:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                torch.save(self.references, f"{self.cache_path}.tmp")
+                os.replace(f"{self.cache_path}.tmp", self.cache_path)
+        return [self.references[d] for d in digests]
+
+    def score(self, candidates, references):
+        """Precision, recall and F1 of each candidate against its reference."""
+        candidate_embeddings = self.embed(candidates)
+        reference_embeddings = self.reference_embeddings(references)
+        precision, recall, f1 = [], [], []
+        for candidate, reference in zip(candidate_embeddings, reference_embeddings):
+            if candidate.shape[0] == 0 or reference.shape[0] == 0:
+                p = r = f = 0.0
+            else:
+                sim = candidate.float() @ reference.float().T
+                p = sim.max(dim=1).values.mean().item()
+                r = sim.max(dim=0).values.mean().item()
+                f = 2 * p * r / (p + r) if p + r != 0 else 0.0
+            precision.append(p)
+            recall.append(r)
+            f1.append(f)
+        return torch.tensor(precision), torch.tensor(recall), torch.tensor(f1)
@@ -1,81 +1,13 @@
-import json
-import datasets
-import statistics
-from eval_utils import bleu as lpbleu
+"""
+Captioning metrics (BLEU-1..4, ROUGE-1/L, METEOR, BERTScore) of one or more
+prediction files, see llava/eval/metrics.py. Each line holds the model output in
+"text" and the reference in "gold_label".
 
-# Assuming two fields of model predictions:
-# "text": outputs from the model
-# "gold_label": gold standard used for evaluation
+    python llava/eval/eval_musiccaps.py answers.jsonl [more.jsonl ...] \
+        --report metrics.json
+"""
 
-MODEL_PREDICTION_JSON = ""
+from llava.eval.metrics import main
 
-# SacreBLEU
-metrics = datasets.load_metric("sacrebleu")
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        metrics.add_batch(predictions=[data["text"]], references=[[data["gold_label"]]])
-score = metrics.compute()
-print("\nsacrebleu", score)
-
-# BLEU
-gold, pred = [], []
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        gold.append([data["gold_label"]])
-        pred.append(data["text"])
-lpord1 = lpbleu(pred, gold, 1)
-print("lpbleu1", lpord1)
-lpord2 = lpbleu(pred, gold, 2)
-print("lpbleu2", lpord2)
-lpord3 = lpbleu(pred, gold, 3)
-print("lpbleu3", lpord3)
-lpord4 = lpbleu(pred, gold, 4)
-print("lpbleu4", lpord4)
-
-# RougeL
-from eval_utils import rouge as lprouge
-
-gold, pred = [], []
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        gold.append(data["gold_label"])
-        pred.append(data["text"])
-rougeL = lprouge(pred, gold)
-print("rougeL is ", rougeL)
-
-# Rouge1
-from eval_utils import rouge1 as lprouge1
-
-gold, pred = [], []
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        gold.append(data["gold_label"])
-        pred.append(data["text"])
-rouge1 = lprouge1(pred, gold)
-print("rouge1 is ", rouge1)
-
-
-# BertScore
-metrics = datasets.load_metric("bertscore")  # , 'sacrebleu', 'meteor', 'bertscore')
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        metrics.add_batch(predictions=[data["text"]], references=[data["gold_label"]])
-
-score = metrics.compute(lang="en")
-score = statistics.mean(score["f1"])
-print("\nbert score", score)
-
-# Meteor
-metrics = datasets.load_metric("meteor")  # , 'sacrebleu', 'meteor', 'bertscore')
-with open(MODEL_PREDICTION_JSON, "r") as fin:
-    for line in fin:
-        data = json.loads(line)
-        metrics.add_batch(predictions=[data["text"]], references=[data["gold_label"]])
-
-score = metrics.compute()
-print("\nmeteor", score)
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
+import functools
+
 import evaluate
 import numpy as np
 
+# each metric is loaded once per process, not once per call
+load_metric = functools.lru_cache(maxsize=None)(evaluate.load)
+
 
 # CAPTIONING METRICS
 def bleu(predictions, ground_truths, order):
-    bleu_eval = evaluate.load("bleu")
+    bleu_eval = load_metric("bleu")
     return bleu_eval.compute(
         predictions=predictions, references=ground_truths, max_order=order
     )["bleu"]
@@ -12,28 +17,28 @@ def bleu(predictions, ground_truths, order):
 
 def meteor(predictions, ground_truths):
     # https://github.com/huggingface/evaluate/issues/115
-    meteor_eval = evaluate.load("meteor")
+    meteor_eval = load_metric("meteor")
     return meteor_eval.compute(predictions=predictions, references=ground_truths)[
         "meteor"
     ]
 
 
 def rouge(predictions, ground_truths):
-    rouge_eval = evaluate.load("rouge")
+    rouge_eval = load_metric("rouge")
     return rouge_eval.compute(predictions=predictions, references=ground_truths)[
         "rougeL"
     ]
 
 
 def rouge1(predictions, ground_truths):
-    rouge_eval = evaluate.load("rouge")
+    rouge_eval = load_metric("rouge")
     return rouge_eval.compute(predictions=predictions, references=ground_truths)[
         "rouge1"
     ]
 
 
 def bertscore(predictions, ground_truths):
-    bertscore_eval = evaluate.load("bertscore")
+    bertscore_eval = load_metric("bertscore")
     score = bertscore_eval.compute(
         predictions=predictions, references=ground_truths, lang="en"
     )["f1"]
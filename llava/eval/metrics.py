@@ -0,0 +1,291 @@
+"""
+Captioning metrics of prediction files in one pass per file.
+
+Each JSONL file ("text": model output, "gold_label": reference) is read once. BLEU-1..4
+come from one 13a tokenization (as `evaluate`'s "bleu") and one n-gram count per
+sample, and ROUGE-1/L from one `rouge_score` tokenization. BLEU statistics, ROUGE
+and METEOR run on chunks of samples in a process pool. BERTScore runs batched in the
+main process with the reference embeddings cached on disk (llava/eval/bertscore.py),
+so references shared by several files or runs are embedded once. Every backend
+(scorers, nltk data, the BERTScore model) is loaded once per process for all files,
+and the scores of all files go to one JSON report.
+
+    python -m llava.eval.metrics answers_a.jsonl answers_b.jsonl --report metrics.json
+
+The numbers follow `evaluate` ("bleu" without smoothing, "rouge", "meteor",
+"bertscore" with lang="en"), except that ROUGE is the plain mean F-measure instead of
+the bootstrap median of the mean.
+"""
+
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+METRICS = ("bleu", "rouge", "meteor", "bertscore")
+
+_13A_RULES = [
+    # punctuation and symbols
+    (re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+    # periods and commas unless preceded by a digit
+    (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+    # periods and commas unless followed by a digit
+    (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+    # dashes preceded by a digit
+    (re.compile(r"([0-9])(-)"), r"\1 \2 "),
+]
+
+
+def tokenize_13a(line):
+    """The "13a" (mteval-v13a) tokenization of sacrebleu, used by `evaluate`'s bleu."""
+    line = line.replace("<skipped>", "").replace("-\n", "").replace("\n", " ")
+    if "&" in line:
+        line = line.replace("&quot;", '"').replace("&amp;", "&")
+        line = line.replace("&lt;", "<").replace("&gt;", ">")
+    line = f" {line} "
+    for pattern, replacement in _13A_RULES:
+        line = pattern.sub(replacement, line)
+    return line.split()
+
+
+def ngram_counts(tokens, max_order):
+    counts = collections.Counter()
+    for order in range(1, max_order + 1):
+        for i in range(len(tokens) - order + 1):
+            counts[tuple(tokens[i : i + order])] += 1
+    return counts
+
+
+def bleu_statistics(predictions, references, max_order=4):
+    """Clipped n-gram matches and possible matches per order, and the prediction and
+    reference lengths; these add up over chunks of a corpus."""
+    matches = [0] * max_order
+    possible = [0] * max_order
+    prediction_length = reference_length = 0
+    for prediction, refs in zip(predictions, references):
+        tokens = tokenize_13a(prediction)
+        ref_tokens = [tokenize_13a(ref) for ref in refs]
+        prediction_length += len(tokens)
+        reference_length += min(len(ref) for ref in ref_tokens)
+        ref_counts = collections.Counter()
+        for ref in ref_tokens:
+            ref_counts |= ngram_counts(ref, max_order)
+        for ngram, count in (ngram_counts(tokens, max_order) & ref_counts).items():
+            matches[len(ngram) - 1] += count
+        for order in range(1, max_order + 1):
+            possible[order - 1] += max(len(tokens) - order + 1, 0)
+    return matches, possible, prediction_length, reference_length
+
+
+def bleu_from_statistics(matches, possible, prediction_length, reference_length):
+    """BLEU-1 .. BLEU-max_order from `bleu_statistics` (no smoothing)."""
+    if prediction_length == 0:
+        return [0.0] * len(matches)
+    ratio = prediction_length / reference_length
+    brevity_penalty = 1.0 if ratio > 1.0 else math.exp(1 - 1.0 / ratio)
+    scores, log_precisions = [], 0.0
+    for order, (m, p) in enumerate(zip(matches, possible), start=1):
+        if m == 0 or p == 0:
+            # a zero precision makes this and every higher order zero
+            scores.extend([0.0] * (len(matches) - order + 1))
+            break
+        log_precisions += math.log(m / p)
+        scores.append(math.exp(log_precisions / order) * brevity_penalty)
+    return scores
+
+
+_rouge_scorer = None
+_meteor = None
+
+
+def _score_chunk(predictions, references, metrics):
+    """Per-chunk sums of the CPU-bound metrics, run in the process pool."""
+    global _rouge_scorer, _meteor
+    out = {}
+    if "bleu" in metrics:
+        out["bleu"] = bleu_statistics(predictions, references)
+    if "rouge" in metrics:
+        if _rouge_scorer is None:
+            from rouge_score import rouge_scorer
+
+            _rouge_scorer = rouge_scorer.RougeScorer(["rouge1", "rougeL"])
+        sums = {"rouge1": 0.0, "rougeL": 0.0}
+        for prediction, refs in zip(predictions, references):
+            scores = _rouge_scorer.score_multi(refs, prediction)
+            for key in sums:
+                sums[key] += scores[key].fmeasure
+        out["rouge"] = sums
+    if "meteor" in metrics:
+        if _meteor is None:
+            import nltk
+            from nltk.translate import meteor_score
+
+            for resource in ("wordnet", "punkt", "omw-1.4"):
+                nltk.download(resource, quiet=True)
+            _meteor = (nltk.word_tokenize, meteor_score.meteor_score)
+        word_tokenize, meteor = _meteor
+        out["meteor"] = sum(
+            meteor(
+                [word_tokenize(ref) for ref in refs],
+                word_tokenize(prediction),
+                alpha=0.9,
+                beta=3,
+                gamma=0.5,
+            )
+            for prediction, refs in zip(predictions, references)
+        )
+    return out
+
+
+def read_predictions(path, prediction_field="text", reference_field="gold_label"):
+    predictions, references = [], []
+    with open(path) as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            predictions.append(data[prediction_field])
+            refs = data[reference_field]
+            references.append(refs if isinstance(refs, list) else [refs])
+    return predictions, references
+
+
+class MetricsEngine:
+    """Scores prediction files with the backends loaded once for all of them."""
+
+    def __init__(
+        self,
+        metrics=METRICS,
+        num_workers=None,
+        chunk_size=256,
+        bertscore_batch_size=64,
+        bertscore_cache_dir=None,
+    ):
+        self.metrics = tuple(metrics)
+        self.cpu_metrics = [m for m in self.metrics if m != "bertscore"]
+        self.chunk_size = chunk_size
+        self.bertscore_batch_size = bertscore_batch_size
+        self.bertscore_cache_dir = bertscore_cache_dir
+        self.pool = None
+        if self.cpu_metrics:
+            # workers start on demand, possibly after BERTScore initialized CUDA,
+            # which forked processes cannot use
+            self.pool = ProcessPoolExecutor(
+                num_workers or os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        self.bert_scorer = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def bertscore(self, predictions, references):
+        if self.bert_scorer is None:
+            from llava.eval.bertscore import CachedBERTScorer
+
+            self.bert_scorer = CachedBERTScorer(
+                cache_dir=self.bertscore_cache_dir,
+                batch_size=self.bertscore_batch_size,
+            )
+        pairs = [(p, ref) for p, refs in zip(predictions, references) for ref in refs]
+        _, _, f1 = self.bert_scorer.score(
+            [p for p, _ in pairs], [ref for _, ref in pairs]
+        )
+        # with several references, the best matching one counts
+        best, start = [], 0
+        for refs in references:
+            best.append(f1[start : start + len(refs)].max().item())
+            start += len(refs)
+        return sum(best) / len(best)
+
+    def score(self, predictions, references):
+        num_samples = len(predictions)
+        if num_samples == 0:
+            return {"num_samples": 0}
+        chunks = []
+        if self.pool is not None:
+            chunks = [
+                self.pool.submit(
+                    _score_chunk,
+                    predictions[start : start + self.chunk_size],
+                    references[start : start + self.chunk_size],
+                    self.cpu_metrics,
+                )
+                for start in range(0, num_samples, self.chunk_size)
+            ]
+        # BERTScore on the GPU (or CPU) while the pool works through the chunks
+        report = {"num_samples": num_samples}
+        if "bertscore" in self.metrics:
+            report["bertscore"] = self.bertscore(predictions, references)
+        results = [chunk.result() for chunk in chunks]
+
+        if "bleu" in self.metrics:
+            matches, possible = [0] * 4, [0] * 4
+            prediction_length = reference_length = 0
+            for result in results:
+                m, p, pl, rl = result["bleu"]
+                matches = [a + b for a, b in zip(matches, m)]
+                possible = [a + b for a, b in zip(possible, p)]
+                prediction_length += pl
+                reference_length += rl
+            scores = bleu_from_statistics(
+                matches, possible, prediction_length, reference_length
+            )
+            for order, score in enumerate(scores, start=1):
+                report[f"bleu{order}"] = score
+        if "rouge" in self.metrics:
+            for key in ("rouge1", "rougeL"):
+                report[key] = sum(r["rouge"][key] for r in results) / num_samples
+        if "meteor" in self.metrics:
+            report["meteor"] = sum(r["meteor"] for r in results) / num_samples
+        return report
+
+    def score_file(self, path, prediction_field="text", reference_field="gold_label"):
+        return self.score(*read_predictions(path, prediction_field, reference_field))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("prediction_files", nargs="+")
+    parser.add_argument("--report", type=str, default="metrics.json")
+    parser.add_argument("--metrics", nargs="+", default=list(METRICS), choices=METRICS)
+    parser.add_argument("--prediction-field", type=str, default="text")
+    parser.add_argument("--reference-field", type=str, default="gold_label")
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--bertscore-batch-size", type=int, default=64)
+    parser.add_argument(
+        "--bertscore-cache-dir",
+        type=str,
+        default="~/.cache/openmu/bertscore",
+        help="Where the reference embeddings are kept across runs.",
+    )
+    args = parser.parse_args(argv)
+
+    engine = MetricsEngine(
+        args.metrics,
+        args.num_workers,
+        args.chunk_size,
+        args.bertscore_batch_size,
+        args.bertscore_cache_dir,
+    )
+    report = {}
+    try:
+        for path in args.prediction_files:
+            report[path] = engine.score_file(
+                path, args.prediction_field, args.reference_field
+            )
+            print(path, json.dumps(report[path], indent=2))
+    finally:
+        engine.close()
+    with open(args.report, "w") as fout:
+        json.dump(report, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Preparation of eval batches (audio loading and collation) in background threads
+while the model generates for the current one.
+"""
+
+import collections
+import itertools
+import queue
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Runs `prepare` on `items` in background threads, keeping at most `depth` prepared
+    items ahead of the consumer, and yields the results in order. `consumer_stall`
+    is the time the consumer waited for an item, `producer_stall` the time prepared
+    items waited for room in the queue.
+    """
+
+    def __init__(self, items, prepare, depth=2, num_threads=2):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.num_threads = num_threads
+        self.consumer_stall = 0.0
+        self.producer_stall = 0.0
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=self._produce, args=(items, prepare), daemon=True
+        )
+        self.thread.start()
+
+    def _produce(self, items, prepare):
+        items = iter(items)
+        pending = collections.deque()
+        while not self.closed.is_set():
+            # keep every thread busy, hand over the results in order
+            for item in itertools.islice(items, self.num_threads - len(pending)):
+                pending.append(self.executor.submit(prepare, item))
+            if not pending:
+                break
+            future = pending.popleft()
+            futures.wait([future])
+            start = time.perf_counter()
+            while not self.closed.is_set():
+                try:
+                    self.queue.put(future, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self.producer_stall += time.perf_counter() - start
+        if not self.closed.is_set():
+            self.queue.put(None)
+        # what the consumer stopped before (`cancel_futures` needs Python 3.9)
+        for future in pending:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                future = self.queue.get()
+                if future is None:
+                    return
+                result = future.result()
+                self.consumer_stall += time.perf_counter() - start
+                yield result
+        finally:
+            # the producer thread cancels what is still pending and shuts down
+            self.closed.set()
@@ -0,0 +1,639 @@
+"""
+Batched evaluation loop shared by the OpenMU-Bench scripts (model_musicqacaption.py,
+model_musiccapstest.py, model_lyrics_grid.py, model_tools.py).
+
+Each script describes its task as an `EvalTask`: how to load the questions, build
+the instruction of a question and fill the task-specific fields of an answer. The
+runner loads the model once per worker, generates for `--batch-size` questions at a
+time (prompts left-padded, see `LlavaLlamaForCausalLM.generate`) and splits the
+questions over `--num-workers` local processes, one per GPU by default. Workers
+append to `<answers-file>.part<k>`, which are merged in question order into the
+answers file once all of them are done. `--num-chunks/--chunk-idx` still select the
+share of a run across machines, before the local split.
+
+While a batch generates, `--prefetch-threads` background threads load and collate
+the audio of the next `--prefetch-depth` batches (llava/eval/prefetch.py); the time
+each side waited on the other is printed per dataset.
+
+`--shared-prefix-beams` runs beam search per question with the prompt's KV cache
+shared by the beams (llava/model/beam_search.py); `--static-kv-cache N` decodes
+greedy or sampled answers one question at a time into a preallocated cache of N
+positions (llava/model/static_cache.py), falling back to `generate` for prompts that
+do not fit; `--speculative prompt_lookup|draft`
+decodes one question at a time with
+llava/model/speculative.py and prints the draft acceptance rate per dataset.
+
+Multiple-choice and closed-set tasks (key, genre, tempo buckets, ...) can skip
+decoding: with `EvalTask.answer_candidates` or `--candidates-field`, each question's
+candidate answers are scored by length-normalized log-likelihood after a single
+prefill (llava/model/candidate_scoring.py); the best one is the answer text and all
+scores go to its metadata.
+
+`--sweep-temperature/--sweep-top-p/--sweep-num-beams/--sweep-max-new-tokens` run
+the grid of the given values (the plain arguments fill the rest): each batch's audio
+is loaded, encoded and prefilled once and every setting generates from a copy of the
+prompt cache (llava/model/sweep.py), writing
+`<answers-file>_t<temperature>_p<top_p>_b<beams>_n<tokens>`.
+
+Runs resume: question ids already in the answers file or its part files are skipped,
+so an interrupted run restarted with the same arguments only generates the rest
+(`--overwrite` starts over). Each batch is appended with a single write and fsync,
+and a partial last line left by a crash is cut off before resuming.
+
+    python -m llava.eval.runner --task musiccaps --model-path ... --batch-size 8
+"""
+
+import argparse
+import dataclasses
+import glob
+import importlib
+import itertools
+import json
+import math
+import operator
+import os
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import shortuuid
+import torch
+from tqdm import tqdm
+from transformers import AutoModelForCausalLM
+
+from llava.constants import (
+    IMAGE_TOKEN_INDEX,
+    DEFAULT_IMAGE_TOKEN,
+    DEFAULT_IM_START_TOKEN,
+    DEFAULT_IM_END_TOKEN,
+)
+from llava.conversation import conv_templates
+from llava.eval.prefetch import Prefetcher
+from llava.model.beam_search import shared_prefix_beam_search
+from llava.model.builder import load_pretrained_model
+from llava.model.candidate_scoring import score_candidate_batch
+from llava.model.speculative import speculative_generate_batch
+from llava.model.static_cache import StaticKVCache, static_generate
+from llava.model.sweep import generate_sweep
+from llava.utils import disable_torch_init
+from llava.mm_utils import (
+    tokenizer_image_token,
+    process_audio,
+    get_model_name_from_path,
+)
+
+# --task of `python -m llava.eval.runner` -> module defining `TASK`
+TASK_MODULES = {
+    "musicqa_captioning": "llava.eval.model_musicqacaption",
+    "musiccaps": "llava.eval.model_musiccapstest",
+    "lyrics": "llava.eval.model_lyrics_grid",
+    "tools": "llava.eval.model_tools",
+}
+
+
+def split_list(lst, n):
+    """Split a list into n (roughly) equal-sized chunks"""
+    chunk_size = math.ceil(len(lst) / n)  # integer division
+    return [lst[i : i + chunk_size] for i in range(0, len(lst), chunk_size)]
+
+
+def get_chunk(lst, n, k):
+    chunks = split_list(lst, n)
+    return chunks[k] if k < len(chunks) else []
+
+
+def instruction_field(line):
+    return line["instruction"]
+
+
+def gold_label_fields(line):
+    return {"gold_label": line["output"]}
+
+
+@dataclass
+class EvalTask:
+    # args -> {dataset name: [question, ...]}
+    load_questions: Callable
+    # question -> instruction, written to the answers as "prompt"
+    build_instruction: Callable = instruction_field
+    # question -> extra fields of its answer
+    answer_fields: Callable = gold_label_fields
+    # (model, tokenizer) -> None, e.g. to adjust the generation config
+    prepare_model: Optional[Callable] = None
+    # appended to the assistant role of the conversation
+    assistant_suffix: str = ""
+    # None: bf16 on GPU, the loaded (or quantized) dtype on CPU
+    dtype: Optional[torch.dtype] = None
+    image_sizes: tuple = (1024 * 3, 128)
+    # question -> candidate answers: if set, the answer is the most likely candidate
+    # (`LlavaLlamaForCausalLM.score_candidates`) instead of generated text
+    answer_candidates: Optional[Callable] = None
+
+
+def answers_path(answers_file, dataset_name, num_datasets):
+    if num_datasets == 1:
+        return answers_file
+    root, ext = os.path.splitext(answers_file)
+    return f"{root}_{dataset_name}{ext}"
+
+
+def sweep_configs(args):
+    """The (temperature, top_p, num_beams, max_new_tokens) grid of the `--sweep-*`
+    arguments; a normal run is the single setting of the plain arguments."""
+    grid = [
+        args.sweep_temperature or [args.temperature],
+        args.sweep_top_p or [args.top_p],
+        args.sweep_num_beams or [args.num_beams],
+        args.sweep_max_new_tokens or [args.max_new_tokens],
+    ]
+    keys = ("temperature", "top_p", "num_beams", "max_new_tokens")
+    return [dict(zip(keys, values)) for values in itertools.product(*grid)]
+
+
+def is_sweep(args):
+    return any(
+        (
+            args.sweep_temperature,
+            args.sweep_top_p,
+            args.sweep_num_beams,
+            args.sweep_max_new_tokens,
+        )
+    )
+
+
+def config_answers_path(path, config, sweep):
+    if not sweep:
+        return path
+    root, ext = os.path.splitext(path)
+    return (
+        f"{root}_t{config['temperature']}_p{config['top_p']}"
+        f"_b{config['num_beams']}_n{config['max_new_tokens']}{ext}"
+    )
+
+
+def answer_files(path):
+    return [path] + sorted(glob.glob(f"{glob.escape(path)}.part*"))
+
+
+def read_answers(path):
+    """The complete lines of an answers file, cutting off a partially written one."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as fin:
+        data = fin.read()
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+        with open(path, "r+b") as fout:
+            fout.truncate(end)
+    return [json.loads(line) for line in data[:end].splitlines()]
+
+
+def build_prompt(task, line, model_config, conv_mode, answer=None):
+    instruction = task.build_instruction(line)
+    if model_config.mm_use_im_start_end:
+        qs = (
+            DEFAULT_IM_START_TOKEN
+            + DEFAULT_IMAGE_TOKEN
+            + DEFAULT_IM_END_TOKEN
+            + "\n"
+            + instruction
+        )
+    else:
+        qs = DEFAULT_IMAGE_TOKEN + "\n" + instruction
+    conv = conv_templates[conv_mode].copy()
+    conv.append_message(conv.roles[0], qs)
+    conv.append_message(conv.roles[1] + task.assistant_suffix, answer)
+    return instruction, conv.get_prompt()
+
+
+def collate(prompts, fbanks, pad_token_id):
+    """Left-pads the prompts; the audio of every question has the same shape."""
+    max_len = max(ids.shape[0] for ids in prompts)
+    input_ids = torch.full((len(prompts), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), max_len), dtype=torch.long)
+    for i, ids in enumerate(prompts):
+        input_ids[i, max_len - ids.shape[0] :] = ids
+        attention_mask[i, max_len - ids.shape[0] :] = 1
+    return input_ids, attention_mask, torch.stack(fbanks)
+
+
+def candidate_token_ids(task, line, prompt_ids, tokenizer, model_config, conv_mode):
+    """Token ids of each candidate answer of a question, following its prompt."""
+    candidate_ids = []
+    for candidate in task.answer_candidates(line):
+        # a candidate is scored as the whole assistant turn, up to its end token
+        _, prompt = build_prompt(task, line, model_config, conv_mode, answer=candidate)
+        ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX)
+        candidate_ids.append(ids[prompt_ids.shape[0] :])
+    return candidate_ids
+
+
+def eval_worker(rank, args, task, datasets):
+    disable_torch_init()
+    device = args.device
+    if device == "cuda" and args.num_workers > 1:
+        device = f"cuda:{rank}"
+    model_path = os.path.expanduser(args.model_path)
+    model_name = get_model_name_from_path(model_path)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(
+        model_path,
+        args.model_base,
+        model_name,
+        is_audio_model=True,
+        audio_ckpt=args.audio_ckpt,
+        device=device,
+        quantize=args.quantize,
+        kv_cache_quantization=args.kv_cache_quantization,
+    )
+    if task.prepare_model is not None:
+        task.prepare_model(model, tokenizer)
+    dtype = task.dtype
+    if dtype is None:
+        # bf16 on GPU; on CPU the dtype the model was loaded (or quantized) in
+        dtype = model.dtype if device == "cpu" else torch.bfloat16
+    model = model.to(device, dtype=dtype)
+    draft_model = None
+    if args.speculative == "draft":
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            args.draft_model_path, torch_dtype=dtype
+        )
+        draft_model = draft_model.to(device).eval()
+    static_cache = None
+    if args.static_kv_cache is not None:
+        static_cache = StaticKVCache.allocate(model, args.static_kv_cache)
+
+    for dataset_name, questions in datasets.items():
+        print(f"Working on this dataset: {dataset_name}")
+        questions = questions[rank :: args.num_workers]
+        prompts = []
+        for idx, line in questions:
+            instruction, prompt = build_prompt(task, line, model.config, args.conv_mode)
+            input_ids = tokenizer_image_token(
+                prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt"
+            )
+            prompts.append((idx, line, instruction, input_ids))
+        # similar lengths in a batch waste less compute on padding
+        prompts.sort(key=lambda p: p[3].shape[0], reverse=True)
+
+        path = answers_path(args.answers_file, dataset_name, len(datasets))
+        configs = sweep_configs(args)
+        ans_files = [
+            open(f"{config_answers_path(path, config, is_sweep(args))}.part{rank}", "a")
+            for config in configs
+        ]
+
+        def prepare(batch):
+            fbanks = [
+                process_audio(
+                    [{"local_audio_path": line["local_audio_path"]}],
+                    image_processor,
+                    model.config,
+                )
+                for _, line, _, _ in batch
+            ]
+            return batch, *collate(
+                [p[3] for p in batch], fbanks, tokenizer.eos_token_id
+            )
+
+        batches = [
+            prompts[start : start + args.batch_size]
+            for start in range(0, len(prompts), args.batch_size)
+        ]
+        if args.prefetch_depth > 0:
+            batches = Prefetcher(
+                batches, prepare, args.prefetch_depth, args.prefetch_threads
+            )
+        else:
+            batches = map(prepare, batches)
+        num_proposed = num_accepted = 0
+        for batch, input_ids, attention_mask, images in tqdm(
+            batches, total=math.ceil(len(prompts) / args.batch_size), disable=rank > 0
+        ):
+            if is_sweep(args):
+                with torch.inference_mode():
+                    sweep_ids = generate_sweep(
+                        model,
+                        input_ids.to(device),
+                        attention_mask.to(device),
+                        images.to(device, dtype=dtype),
+                        configs,
+                        [task.image_sizes] * len(batch),
+                        tokenizer.eos_token_id,
+                    )
+            elif task.answer_candidates is not None:
+                candidates = [task.answer_candidates(line) for _, line, _, _ in batch]
+                candidate_ids = [
+                    candidate_token_ids(
+                        task, line, prompt_ids, tokenizer, model.config, args.conv_mode
+                    )
+                    for _, line, _, prompt_ids in batch
+                ]
+                with torch.inference_mode():
+                    candidate_scores = score_candidate_batch(
+                        model,
+                        input_ids.to(device),
+                        attention_mask.to(device),
+                        images.to(device, dtype=dtype),
+                        candidate_ids,
+                        image_sizes=[task.image_sizes],
+                    )
+                outputs = [
+                    texts[max(range(len(texts)), key=scores.__getitem__)]
+                    for texts, scores in zip(candidates, candidate_scores)
+                ]
+                metadata = [
+                    {"candidate_scores": dict(zip(texts, scores))}
+                    for texts, scores in zip(candidates, candidate_scores)
+                ]
+            elif args.speculative:
+                output_ids, proposed, accepted = speculative_generate_batch(
+                    model,
+                    input_ids.to(device),
+                    attention_mask.to(device),
+                    images.to(device, dtype=dtype),
+                    draft_model,
+                    max_new_tokens=args.max_new_tokens,
+                    num_draft_tokens=args.num_draft_tokens,
+                    do_sample=args.temperature > 0,
+                    temperature=args.temperature,
+                    top_p=args.top_p,
+                )
+                num_proposed += proposed
+                num_accepted += accepted
+            elif args.shared_prefix_beams and args.num_beams > 1:
+                output_ids = [
+                    shared_prefix_beam_search(
+                        model,
+                        input_ids[i : i + 1, attention_mask[i].bool()].to(device),
+                        images[i : i + 1].to(device, dtype=dtype),
+                        num_beams=args.num_beams,
+                        max_new_tokens=args.max_new_tokens,
+                        pad_token_id=tokenizer.eos_token_id,
+                    )[0].tolist()
+                    for i in range(len(batch))
+                ]
+            elif static_cache is not None and args.num_beams == 1:
+                output_ids = [
+                    static_generate(
+                        model,
+                        input_ids[i : i + 1, attention_mask[i].bool()].to(device),
+                        images[i : i + 1].to(device, dtype=dtype),
+                        max_new_tokens=args.max_new_tokens,
+                        image_sizes=[task.image_sizes],
+                        do_sample=args.temperature > 0,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        pad_token_id=tokenizer.eos_token_id,
+                        compile=args.compile_decode_step,
+                        cache=static_cache,
+                    )[0].tolist()
+                    for i in range(len(batch))
+                ]
+            else:
+                with torch.inference_mode():
+                    output_ids = model.generate(
+                        input_ids.to(device),
+                        attention_mask=attention_mask.to(device),
+                        images=images.to(device, dtype=dtype),
+                        image_sizes=[task.image_sizes] * len(batch),
+                        do_sample=True if args.temperature > 0 else False,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams,
+                        max_new_tokens=args.max_new_tokens,
+                        use_cache=True,
+                        pad_token_id=tokenizer.eos_token_id,
+                    )
+            if is_sweep(args):
+                results = [
+                    (
+                        tokenizer.batch_decode(ids, skip_special_tokens=True),
+                        [{}] * len(batch),
+                    )
+                    for ids in sweep_ids
+                ]
+            elif task.answer_candidates is not None:
+                results = [(outputs, metadata)]
+            else:
+                outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+                results = [(outputs, [{}] * len(batch))]
+            for ans_file, (outputs, metadata) in zip(ans_files, results):
+                lines = []
+                for (idx, line, instruction, _), text, meta in zip(
+                    batch, outputs, metadata
+                ):
+                    answer = {
+                        "question_id": idx,
+                        "prompt": instruction,
+                        "text": text.strip(),
+                        "answer_id": shortuuid.uuid(),
+                        "model_id": model_name,
+                        "metadata": meta,
+                        **task.answer_fields(line),
+                    }
+                    lines.append(json.dumps(answer) + "\n")
+                # one write per batch: a crash leaves at most one partial line
+                ans_file.write("".join(lines))
+                ans_file.flush()
+                os.fsync(ans_file.fileno())
+        for ans_file in ans_files:
+            ans_file.close()
+        if args.speculative:
+            print(
+                f"{dataset_name}: accepted {num_accepted} of {num_proposed} draft "
+                f"tokens ({num_accepted / max(num_proposed, 1):.1%})"
+            )
+        if isinstance(batches, Prefetcher):
+            print(
+                f"{dataset_name}: generation waited {batches.consumer_stall:.1f}s for "
+                f"inputs, prefetching waited {batches.producer_stall:.1f}s for "
+                "generation"
+            )
+
+
+def merge_answers(path):
+    files = answer_files(path)
+    answers = {
+        answer["question_id"]: answer for f in files for answer in read_answers(f)
+    }
+    with open(f"{path}.tmp", "w") as fout:
+        for question_id in sorted(answers):
+            fout.write(json.dumps(answers[question_id]) + "\n")
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(f"{path}.tmp", path)
+    for f in files[1:]:
+        os.remove(f)
+
+
+def run(args, task):
+    if args.candidates_field is not None:
+        task = dataclasses.replace(
+            task, answer_candidates=operator.itemgetter(args.candidates_field)
+        )
+    if is_sweep(args) and (args.speculative or task.answer_candidates is not None):
+        raise ValueError("--sweep-* cannot be combined with --speculative or scoring")
+    if args.speculative and args.num_beams > 1:
+        raise ValueError("--speculative decodes without beam search, use --num_beams 1")
+    if args.speculative == "draft" and args.draft_model_path is None:
+        raise ValueError("--speculative draft needs --draft-model-path")
+    if args.num_workers is None:
+        args.num_workers = (
+            max(torch.cuda.device_count(), 1) if args.device == "cuda" else 1
+        )
+    datasets = task.load_questions(args)
+    paths = {
+        name: [
+            config_answers_path(
+                answers_path(args.answers_file, name, len(datasets)),
+                config,
+                is_sweep(args),
+            )
+            for config in sweep_configs(args)
+        ]
+        for name in datasets
+    }
+    remaining = {}
+    for name, questions in datasets.items():
+        if args.overwrite:
+            for path in paths[name]:
+                for f in answer_files(path):
+                    if os.path.exists(f):
+                        os.remove(f)
+        # answered under every setting; the merge drops answers written twice
+        completed = set.intersection(
+            *(
+                {
+                    answer["question_id"]
+                    for f in answer_files(path)
+                    for answer in read_answers(f)
+                }
+                for path in paths[name]
+            )
+        )
+        # question ids are positions in this machine's chunk
+        questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+        remaining[name] = [
+            (idx, line) for idx, line in enumerate(questions) if idx not in completed
+        ]
+        print(
+            f"{name}: {len(questions) - len(remaining[name])} of {len(questions)} "
+            f"questions already answered in {', '.join(paths[name])}"
+        )
+    if any(remaining.values()):
+        if args.num_workers == 1:
+            eval_worker(0, args, task, remaining)
+        else:
+            torch.multiprocessing.spawn(
+                eval_worker, args=(args, task, remaining), nprocs=args.num_workers
+            )
+    for name in datasets:
+        for path in paths[name]:
+            merge_answers(path)
+
+
+def add_eval_args(parser, num_beams=1, max_new_tokens=256):
+    parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--question-file", type=str, default="tables/question.jsonl")
+    parser.add_argument("--answers-file", type=str, default="answer.jsonl")
+    parser.add_argument("--conv-mode", type=str, default="llama_3")
+    parser.add_argument("--num-chunks", type=int, default=1)
+    parser.add_argument("--chunk-idx", type=int, default=0)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--top_p", type=float, default=0.99)
+    parser.add_argument("--num_beams", type=int, default=num_beams)
+    parser.add_argument("--max_new_tokens", type=int, default=max_new_tokens)
+    parser.add_argument("--batch-size", type=int, default=8)
+    # a grid over any of these writes one answers file per setting
+    parser.add_argument("--sweep-temperature", type=float, nargs="+", default=None)
+    parser.add_argument("--sweep-top-p", type=float, nargs="+", default=None)
+    parser.add_argument("--sweep-num-beams", type=int, nargs="+", default=None)
+    parser.add_argument("--sweep-max-new-tokens", type=int, nargs="+", default=None)
+    parser.add_argument(
+        "--shared-prefix-beams",
+        action="store_true",
+        help="Beam search keeping a single copy of the prompt's KV cache.",
+    )
+    parser.add_argument(
+        "--static-kv-cache",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Decode into a preallocated KV cache of N positions (one question at a "
+        "time, without beam search); longer prompts fall back to generate.",
+    )
+    parser.add_argument(
+        "--compile-decode-step",
+        action="store_true",
+        help="torch.compile the decode step of --static-kv-cache.",
+    )
+    parser.add_argument(
+        "--speculative",
+        type=str,
+        default=None,
+        choices=["prompt_lookup", "draft"],
+        help="Speculative decoding, see llava/model/speculative.py.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="Text-only causal LM sharing the tokenizer, for --speculative draft.",
+    )
+    parser.add_argument("--num-draft-tokens", type=int, default=5)
+    parser.add_argument(
+        "--candidates-field",
+        type=str,
+        default=None,
+        help="Answer with the most likely of the candidate answers listed in this "
+        "field of each question instead of generating.",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        type=int,
+        default=2,
+        help="Batches prepared ahead of generation; 0 prepares them inline.",
+    )
+    parser.add_argument("--prefetch-threads", type=int, default=2)
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Discard existing answers instead of resuming from them.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="Local processes, default one per GPU (one on CPU).",
+    )
+    parser.add_argument(
+        "--audio-ckpt",
+        type=str,
+        default="vitb_finetuned.pth",
+    )
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8", "int4"],
+        help="Weight-only quantization, for --device cpu.",
+    )
+    parser.add_argument(
+        "--kv-cache-quantization",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Keep the KV cache in int8 during generation.",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    task_parser = argparse.ArgumentParser(add_help=False)
+    task_parser.add_argument("--task", type=str, required=True, choices=TASK_MODULES)
+    args, _ = task_parser.parse_known_args()
+    task_module = importlib.import_module(TASK_MODULES[args.task])
+    parser = task_module.add_args(argparse.ArgumentParser(parents=[task_parser]))
+    args = parser.parse_args()
+    run(args, task_module.TASK)
@@ -1,5 +1,8 @@
 import collections
 import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import torch
 
 
@@ -84,9 +87,17 @@ def bleu_score(candidate_corpus, references_corpus, max_n=4, weights=[0.25] * 4)
         references_corpus
     ), "The length of candidate and reference corpus should be the same"
 
+    return _bleu_from_counts(
+        *_bleu_counts(candidate_corpus, references_corpus, max_n),
+        weights=torch.tensor(weights),
+    )
+
+
+def _bleu_counts(candidate_corpus, references_corpus, max_n):
+    """Clipped and total n-gram counts per order, and the candidate and reference
+    lengths of the corpus."""
     clipped_counts = torch.zeros(max_n)
     total_counts = torch.zeros(max_n)
-    weights = torch.tensor(weights)
 
     candidate_len = 0.0
     refs_len = 0.0
@@ -114,6 +125,10 @@ def bleu_score(candidate_corpus, references_corpus, max_n=4, weights=[0.25] * 4)
             # The number of N-grams in a `candidate` of T tokens is `T - (N - 1)`
             total_counts[i] += max(current_candidate_len - i, 0)
 
+    return clipped_counts, total_counts, candidate_len, refs_len
+
+
+def _bleu_from_counts(clipped_counts, total_counts, candidate_len, refs_len, weights):
     if min(clipped_counts) == 0:
         return 0.0
     else:
@@ -123,4 +138,152 @@ def bleu_score(candidate_corpus, references_corpus, max_n=4, weights=[0.25] * 4)
 
         bp = math.exp(min(1 - refs_len / candidate_len, 0))
 
-        return bp * score.item()
\ No newline at end of file
+        return bp * score.item()
+
+
+def _encode_sentences(sentences, vocab):
+    """Token ids of all sentences, concatenated, and the length of each sentence."""
+    lengths = np.fromiter(
+        (len(s) for s in sentences), dtype=np.int64, count=len(sentences)
+    )
+    ids = np.fromiter(
+        (vocab.setdefault(token, len(vocab)) for s in sentences for token in s),
+        dtype=np.int64,
+        count=int(lengths.sum()),
+    )
+    return ids, lengths
+
+
+def _ngram_keys(ids, lengths, n, vocab_size):
+    """An int64 key per n-gram within each sentence (equal keys for equal n-grams)
+    and the index of its sentence."""
+    counts = np.maximum(lengths - n + 1, 0)
+    owner = np.repeat(np.arange(len(lengths)), counts)
+    # the position in `ids` of the first token of each n-gram
+    first = np.repeat(np.cumsum(lengths) - lengths - np.cumsum(counts) + counts, counts)
+    first += np.arange(len(first))
+    keys = ids[first]
+    bound = vocab_size
+    for k in range(1, n):
+        if bound * vocab_size >= 2**63:
+            # renumber the shorter n-grams densely so the keys stay exact in int64
+            _, keys = np.unique(keys, return_inverse=True)
+            bound = len(keys) and int(keys.max()) + 1
+        keys = keys * vocab_size + ids[first + k]
+        bound *= vocab_size
+    return keys, owner
+
+
+def _vectorized_bleu_counts(candidate_corpus, references_corpus, max_n):
+    """`_bleu_counts` with the n-grams counted in NumPy."""
+    vocab = {}
+    num_refs = np.fromiter((len(refs) for refs in references_corpus), dtype=np.int64)
+    ref_sentences = [ref for refs in references_corpus for ref in refs]
+    # candidates and references share one vocabulary, so their n-gram keys agree
+    ids, lengths = _encode_sentences(candidate_corpus + ref_sentences, vocab)
+    if any(" " in token for token in vocab):
+        # `_compute_ngram_counter` splits n-grams on spaces, keep its counts then
+        clipped_counts, total_counts, candidate_len, refs_len = _bleu_counts(
+            candidate_corpus, references_corpus, max_n
+        )
+        return clipped_counts.tolist(), total_counts.tolist(), candidate_len, refs_len
+
+    num_candidates = len(candidate_corpus)
+    candidate_lengths = lengths[:num_candidates]
+    ref_lengths = lengths[num_candidates:]
+    # the reference length closest to the candidate's, the first one on ties
+    ref_owner = np.repeat(np.arange(num_candidates), num_refs)
+    ref_position = np.arange(len(ref_lengths)) - np.repeat(
+        np.cumsum(num_refs) - num_refs, num_refs
+    )
+    table = np.full((num_candidates, int(num_refs.max(initial=1))), np.inf)
+    table[ref_owner, ref_position] = ref_lengths
+    closest = np.argmin(np.abs(candidate_lengths[:, None] - table), axis=1)
+    refs_len = float(table[np.arange(num_candidates), closest].sum())
+    candidate_len = float(candidate_lengths.sum())
+
+    clipped_counts, total_counts = [], []
+    for n in range(1, max_n + 1):
+        keys, owner = _ngram_keys(ids, lengths, n, max(len(vocab), 1))
+        num_candidate_ngrams = int(np.maximum(candidate_lengths - n + 1, 0).sum())
+        total_counts.append(num_candidate_ngrams)
+        # (candidate, n-gram) pairs as one int64 key per n-gram
+        unique_keys, dense = np.unique(keys, return_inverse=True)
+        ref_index = np.maximum(owner - num_candidates, 0)
+        candidate = np.where(owner < num_candidates, owner, ref_owner[ref_index])
+        pairs = candidate * len(unique_keys) + dense
+        candidate_keys, candidate_counts = np.unique(
+            pairs[:num_candidate_ngrams], return_counts=True
+        )
+        ref_pairs = pairs[num_candidate_ngrams:]
+        if len(candidate_keys) == 0 or len(ref_pairs) == 0:
+            clipped_counts.append(0)
+            continue
+
+        # counts per reference, then their max over the references of a candidate
+        ref_ids = owner[num_candidate_ngrams:]
+        order = np.lexsort((ref_ids, ref_pairs))
+        ref_pairs, ref_ids = ref_pairs[order], ref_ids[order]
+        new_run = (ref_pairs[1:] != ref_pairs[:-1]) | (ref_ids[1:] != ref_ids[:-1])
+        run_starts = np.flatnonzero(np.r_[True, new_run])
+        run_counts = np.diff(np.r_[run_starts, len(ref_pairs)])
+        run_pairs = ref_pairs[run_starts]
+        pair_starts = np.flatnonzero(np.r_[True, run_pairs[1:] != run_pairs[:-1]])
+        ref_keys = run_pairs[pair_starts]
+        ref_counts = np.maximum.reduceat(run_counts, pair_starts)
+
+        # clip by intersecting the sorted keys of the candidates and references
+        _, i, j = np.intersect1d(
+            candidate_keys, ref_keys, assume_unique=True, return_indices=True
+        )
+        clipped_counts.append(int(np.minimum(candidate_counts[i], ref_counts[j]).sum()))
+    return clipped_counts, total_counts, candidate_len, refs_len
+
+
+def vectorized_bleu_score(
+    candidate_corpus,
+    references_corpus,
+    max_n=4,
+    weights=[0.25] * 4,
+    num_workers=None,
+    chunk_size=10000,
+):
+    """`bleu_score` with the n-grams counted in NumPy, for large corpora.
+
+    Tokens are mapped to integer ids and n-grams to int64 keys; the candidate counts
+    are clipped by the reference counts through an intersection of sorted keys. With
+    `num_workers`, chunks of `chunk_size` sentences are counted in a process pool.
+    The score is the same as `bleu_score`'s.
+    """
+
+    assert max_n == len(weights), 'Length of the "weights" list has be equal to max_n'
+    assert len(candidate_corpus) == len(
+        references_corpus
+    ), "The length of candidate and reference corpus should be the same"
+
+    candidate_corpus = [list(candidate) for candidate in candidate_corpus]
+    references_corpus = [[list(ref) for ref in refs] for refs in references_corpus]
+    if not num_workers or num_workers == 1:
+        results = [_vectorized_bleu_counts(candidate_corpus, references_corpus, max_n)]
+    else:
+        starts = range(0, len(candidate_corpus), chunk_size)
+        with ProcessPoolExecutor(num_workers) as pool:
+            results = list(
+                pool.map(
+                    _vectorized_bleu_counts,
+                    [candidate_corpus[i : i + chunk_size] for i in starts],
+                    [references_corpus[i : i + chunk_size] for i in starts],
+                    [max_n] * len(starts),
+                )
+            )
+
+    # clipping is per sentence, so the counts of the chunks add up
+    clipped_counts = torch.tensor([sum(c) for c in zip(*(r[0] for r in results))])
+    total_counts = torch.tensor([sum(c) for c in zip(*(r[1] for r in results))])
+    return _bleu_from_counts(
+        clipped_counts.float(),
+        total_counts.float(),
+        sum(r[2] for r in results),
+        sum(r[3] for r in results),
+        weights=torch.tensor(weights),
+    )
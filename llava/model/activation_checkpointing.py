@@ -0,0 +1,213 @@
+"""
+Selective activation checkpointing for the LLM decoder layers and the AudioMAE
+(`audio_mae.models_vit`) blocks.
+
+A policy is one of
+    "none"            keep every activation
+    "all"             recompute every layer (what `--gradient_checkpointing` does)
+    "every:<k>"       recompute every k-th layer, starting with the first
+    "attention"       recompute only the attention sub-block of every layer
+    "mlp"             recompute only the MLP sub-block of every layer
+    "budget:<GiB>"    recompute as few layers as needed, spread evenly over the stack,
+                      for the saved activations of one step to fit in <GiB>
+
+Recomputation uses non-reentrant `torch.utils.checkpoint`, and only happens in
+training mode with gradients enabled. The budget is matched against an estimate of
+the bytes each layer saves for backward (see `llama_activation_bytes` and
+`vit_activation_bytes`), not against measured memory.
+"""
+
+import functools
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+POLICIES = ("none", "all", "every", "attention", "mlp", "budget")
+
+
+def parse_policy(policy):
+    """Splits e.g. "every:2" into ("every", 2.0); raises ValueError if malformed."""
+    name, _, value = policy.partition(":")
+    if name not in POLICIES or bool(value) != (name in ("every", "budget")):
+        raise ValueError(
+            f"Unknown checkpointing policy {policy!r}; expected one of none, all, "
+            "every:<k>, attention, mlp, budget:<GiB>."
+        )
+    if not value:
+        return name, None
+    value = float(value)
+    if value <= 0 or (name == "every" and not value.is_integer()):
+        raise ValueError(f"Invalid value in checkpointing policy {policy!r}.")
+    return name, value
+
+
+def checkpoint_module(module):
+    """Makes `module` recompute its forward during backward instead of saving it."""
+    if "forward" in module.__dict__:
+        # already wrapped, e.g. by an earlier `Trainer.train()`
+        return module
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def checkpointed_forward(*args, **kwargs):
+        if module.training and torch.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+
+    module.forward = checkpointed_forward
+    return module
+
+
+def select_checkpointing(policy, num_layers, layer_bytes=None):
+    """
+    Returns {layer index: "layer" | "attention" | "mlp"}, the part of each layer to
+    recompute. `layer_bytes` ({"attention", "mlp", "input"} bytes saved per step) is
+    only needed for "budget:<GiB>".
+    """
+    name, value = parse_policy(policy)
+    if name == "none":
+        return {}
+    if name in ("attention", "mlp"):
+        return {i: name for i in range(num_layers)}
+    if name == "every":
+        return {i: "layer" for i in range(0, num_layers, int(value))}
+    if name == "all":
+        return {i: "layer" for i in range(num_layers)}
+
+    if layer_bytes is None:
+        raise ValueError("A 'budget' checkpointing policy needs the layer sizes.")
+    budget = value * 2**30
+    kept = layer_bytes["attention"] + layer_bytes["mlp"]
+    recomputed = layer_bytes["input"]
+    num_checkpointed = num_layers
+    for n in range(num_layers + 1):
+        if (num_layers - n) * kept + n * recomputed <= budget:
+            num_checkpointed = n
+            break
+    else:
+        print(
+            f"=> Activations of {num_layers} checkpointed layers "
+            f"({num_layers * recomputed / 2**30:.2f} GiB) exceed the {value} GiB "
+            "budget; checkpointing all of them."
+        )
+    return {
+        num_layers * j // num_checkpointed: "layer" for j in range(num_checkpointed)
+    }
+
+
+def apply_checkpointing(layers, plan, attention_name, mlp_name):
+    """Wraps the parts of `layers` named by `plan` (see `select_checkpointing`)."""
+    for i, part in plan.items():
+        if part == "layer":
+            checkpoint_module(layers[i])
+        else:
+            name = attention_name if part == "attention" else mlp_name
+            checkpoint_module(getattr(layers[i], name))
+
+
+def _bytes_per_value(module):
+    return next(module.parameters()).element_size()
+
+
+def llama_activation_bytes(layer, config, num_tokens, seq_len):
+    """
+    Estimated bytes a Llama / Mistral decoder layer saves for backward over a step of
+    `num_tokens` tokens in sequences of `seq_len`. RMSNorm statistics are kept in
+    fp32; the attention probabilities are only stored by the eager implementation.
+    """
+    b = _bytes_per_value(layer)
+    h = config.hidden_size
+    kv = h // config.num_attention_heads * config.num_key_value_heads
+    norm = 4 * h + b * h
+    attention = norm + b * (4 * h + 4 * kv)
+    if getattr(config, "_attn_implementation", "eager") == "eager":
+        attention += 2 * b * config.num_attention_heads * seq_len
+    mlp = norm + b * (h + 4 * config.intermediate_size)
+    return {
+        "attention": attention * num_tokens,
+        "mlp": mlp * num_tokens,
+        "input": b * h * num_tokens,
+    }
+
+
+def vit_activation_bytes(block, num_tokens, seq_len):
+    """Same as `llama_activation_bytes` for a timm ViT block (eager attention)."""
+    b = _bytes_per_value(block)
+    h = block.norm1.normalized_shape[0]
+    attention = b * (6 * h + 2 * block.attn.num_heads * seq_len)
+    mlp = b * (2 * h + 2 * block.mlp.fc1.out_features)
+    return {
+        "attention": attention * num_tokens,
+        "mlp": mlp * num_tokens,
+        "input": b * h * num_tokens,
+    }
+
+
+def _decoder_layers(model):
+    from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+    from transformers.models.mistral.modeling_mistral import MistralDecoderLayer
+
+    return [
+        module
+        for module in model.modules()
+        if isinstance(module, (LlamaDecoderLayer, MistralDecoderLayer))
+    ]
+
+
+def apply_llm_checkpointing(model, policy, batch_size, seq_len, num_tokens=None):
+    """
+    Applies `policy` to the decoder layers of `model` (also behind a PeftModel).
+    `num_tokens` defaults to batch_size * seq_len.
+    """
+    layers = _decoder_layers(model)
+    if not layers:
+        raise ValueError("No Llama / Mistral decoder layers to checkpoint.")
+    # recomputing a layer would append to the KV cache a second time
+    model.config.use_cache = False
+    num_tokens = num_tokens or batch_size * seq_len
+    layer_bytes = llama_activation_bytes(layers[0], model.config, num_tokens, seq_len)
+    plan = select_checkpointing(policy, len(layers), layer_bytes)
+    apply_checkpointing(layers, plan, "self_attn", "mlp")
+    print(f"=> LLM activation checkpointing '{policy}': {_describe(plan, layers)}")
+    return plan
+
+
+def apply_audio_tower_checkpointing(model, policy, batch_size):
+    """
+    Applies `policy` to the blocks of the AudioMAE encoder of `model`. Each sample
+    is encoded as 3 windows of `patch_embed.num_patches` patches plus a cls token.
+    A frozen encoder runs without gradients and saves nothing for backward, so the
+    policy only applies to a trainable one (`--stage2_tune_encoder`).
+    """
+    from llava.model.multimodal_encoder.audio_mae.models_vit import VisionTransformer
+
+    vits = [m for m in model.modules() if isinstance(m, VisionTransformer)]
+    if not vits:
+        raise ValueError("No AudioMAE encoder to checkpoint.")
+    plan = {}
+    for vit in vits:
+        if not any(p.requires_grad for p in vit.parameters()):
+            print(
+                f"=> AudioMAE activation checkpointing '{policy}' skipped: the "
+                "encoder is frozen and keeps no activations (see "
+                "--stage2_tune_encoder)."
+            )
+            continue
+        seq_len = vit.patch_embed.num_patches + 1
+        block_bytes = vit_activation_bytes(
+            vit.blocks[0], 3 * batch_size * seq_len, seq_len
+        )
+        plan = select_checkpointing(policy, len(vit.blocks), block_bytes)
+        apply_checkpointing(vit.blocks, plan, "attn", "mlp")
+        print(
+            f"=> AudioMAE activation checkpointing '{policy}': "
+            f"{_describe(plan, vit.blocks)}"
+        )
+    return plan
+
+
+def _describe(plan, layers):
+    if not plan:
+        return f"none of {len(layers)} layers"
+    parts = sorted(set(plan.values()))
+    return f"{'/'.join(parts)} of layers {sorted(plan)} ({len(layers)} total)"
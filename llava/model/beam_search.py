@@ -0,0 +1,144 @@
+"""
+Beam search for `LlavaLlamaForCausalLM` with the prompt's KV cache shared by all
+beams.
+
+HF beam search expands the prompt (system prompt, audio tokens, lyrics) to
+`num_beams` rows and gathers the whole cache by beam index at every step. Here the
+prompt is run once with batch size 1 and its keys and values stay a single copy;
+the beams only keep the keys and values of the tokens they generated, so KV memory
+and the per-step reorder shrink by about the beam width for long prompts.
+Decoding steps attend to both parts (`manual_decode.attend`): the queries of all
+beams are stacked against the shared prefix (one matmul per KV head, no expanded
+copy) and each beam attends to its own generated tokens.
+
+Scoring is HF's `BeamSearchScorer` (length penalty, early stopping), so the result
+is that of `generate(num_beams=...)` without extra logits processors.
+"""
+
+import torch
+import torch.nn.functional as F
+from transformers import BeamSearchScorer
+
+from llava.model.manual_decode import attend, decode_step, project_qkv
+
+
+def _legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _decode_step(model, tokens, position, prefix_cache, beam_cache):
+    """Logits of the next token of every beam, and the beams' updated caches."""
+    position_ids = torch.full((tokens.shape[0], 1), position, device=tokens.device)
+    new_cache = []
+
+    def attention(layer_idx, attn, hidden):
+        q, k, v = project_qkv(attn, hidden, position_ids, position + 1)
+        beam_kv = beam_cache[layer_idx]
+        if beam_kv is not None:
+            k = torch.cat([beam_kv[0], k], dim=2)
+            v = torch.cat([beam_kv[1], v], dim=2)
+        new_cache.append((k, v))
+        return attend(attn, q, prefix_kv=prefix_cache[layer_idx], suffix_kv=(k, v))
+
+    return decode_step(model, tokens, attention), new_cache
+
+
+@torch.no_grad()
+def shared_prefix_beam_search(
+    model,
+    input_ids,
+    images,
+    num_beams=5,
+    max_new_tokens=128,
+    image_sizes=None,
+    length_penalty=1.0,
+    early_stopping=False,
+    eos_token_id=None,
+    pad_token_id=None,
+):
+    """
+    Beam search for a single sample (`input_ids` 1 x L, without padding). Returns
+    the new token ids of the best beam (1 x N).
+    """
+    generation_config = model.generation_config
+    if eos_token_id is None:
+        eos_token_id = generation_config.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    if pad_token_id is None:
+        pad_token_id = generation_config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id[0]
+
+    _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+        input_ids, None, None, None, None, images, image_sizes=image_sizes
+    )
+    out = model(inputs_embeds=inputs_embeds, use_cache=True)
+    prefix_cache = _legacy_cache(out.past_key_values)
+    position = inputs_embeds.shape[1]
+    device = inputs_embeds.device
+
+    # like `generate` with inputs_embeds: one placeholder token before the output
+    sequences = torch.full((num_beams, 1), 0, dtype=torch.long, device=device)
+    max_length = 1 + max_new_tokens
+    scorer = BeamSearchScorer(
+        batch_size=1,
+        num_beams=num_beams,
+        device=device,
+        length_penalty=length_penalty,
+        do_early_stopping=early_stopping,
+        max_length=max_length,
+    )
+    # only the first beam is live at the first step
+    beam_scores = torch.zeros(num_beams, device=device)
+    beam_scores[1:] = -1e9
+    logits = out.logits[:, -1].float().expand(num_beams, -1)
+    beam_cache = [None] * len(prefix_cache)
+    while True:
+        scores = F.log_softmax(logits, dim=-1) + beam_scores[:, None]
+        vocab_size = scores.shape[-1]
+        next_scores, next_tokens = torch.topk(
+            scores.view(1, num_beams * vocab_size),
+            max(2, 1 + len(eos_token_id)) * num_beams,
+            dim=1,
+        )
+        next_indices = torch.div(next_tokens, vocab_size, rounding_mode="floor")
+        next_tokens = next_tokens % vocab_size
+        beam_outputs = scorer.process(
+            sequences,
+            next_scores,
+            next_tokens,
+            next_indices,
+            pad_token_id=pad_token_id,
+            eos_token_id=eos_token_id,
+            decoder_prompt_len=1,
+        )
+        beam_scores = beam_outputs["next_beam_scores"]
+        beam_idx = beam_outputs["next_beam_indices"]
+        beam_tokens = beam_outputs["next_beam_tokens"].unsqueeze(-1)
+        sequences = torch.cat([sequences[beam_idx], beam_tokens], dim=-1)
+        if scorer.is_done or sequences.shape[-1] >= max_length:
+            break
+        # the reorder only touches the generated tokens' keys and values
+        beam_cache = [
+            kv if kv is None else (kv[0][beam_idx], kv[1][beam_idx])
+            for kv in beam_cache
+        ]
+        logits, beam_cache = _decode_step(
+            model, beam_tokens, position, prefix_cache, beam_cache
+        )
+        position += 1
+
+    sequences = scorer.finalize(
+        sequences,
+        beam_scores,
+        next_tokens,
+        next_indices,
+        pad_token_id=pad_token_id,
+        eos_token_id=eos_token_id,
+        max_length=max_length,
+        decoder_prompt_len=1,
+    )["sequences"]
+    return sequences[:, 1:]
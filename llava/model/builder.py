@@ -1,4 +1,5 @@
 import os
+import time
 import warnings
 import shutil
 
@@ -9,7 +10,11 @@ from transformers import (
     BitsAndBytesConfig,
 )
 import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
 from llava.model import *
+from llava.model.quantization import quantize_model
 from llava.constants import (
     DEFAULT_IMAGE_PATCH_TOKEN,
     DEFAULT_IM_START_TOKEN,
@@ -29,8 +34,25 @@ def load_pretrained_model(
     is_audio_model=False,
     audio_ckpt=None,
     audio_target_len=1024 * 3,
+    quantize=None,
+    quantize_group_size=128,
+    kv_cache_quantization=None,
     **kwargs,
 ):
+    """
+    `quantize` ("int8" or "int4") applies weight-only quantization for CPU inference
+    after loading, see llava/model/quantization.py. `kv_cache_quantization="int8"`
+    makes generation keep an int8 KV cache, see llava/model/kv_cache_quantization.py.
+    """
+    if model_base is None and is_merged_model(model_path):
+        tokenizer, model, image_processor, context_len = load_merged_model(
+            model_path, device=device
+        )
+        if quantize is not None:
+            quantize_model(model, quantize, group_size=quantize_group_size)
+        model.config.kv_cache_quantization = kv_cache_quantization
+        return tokenizer, model, image_processor, context_len
+
     kwargs = {"device_map": device_map, **kwargs}
 
     if device != "cuda":
@@ -46,6 +68,9 @@ def load_pretrained_model(
             bnb_4bit_use_double_quant=True,
             bnb_4bit_quant_type="nf4",
         )
+    elif device == "cpu":
+        # fp16 matmuls are slow or missing on CPU; quantize_model picks the dtype
+        kwargs["torch_dtype"] = torch.float32
     else:
         kwargs["torch_dtype"] = torch.float16
 
@@ -269,4 +294,73 @@ def load_pretrained_model(
         context_len = 2048
     # model.generation_config.temperature = 1.0
     # model.generation_config.top_p = 1.0
+    if quantize is not None:
+        quantize_model(model, quantize, group_size=quantize_group_size)
+    model.config.kv_cache_quantization = kv_cache_quantization
     return tokenizer, model, image_processor, context_len
+
+
+MERGED_WEIGHTS_NAME = "model.safetensors"
+
+
+def save_merged_model(model, tokenizer, save_path, dtype=torch.bfloat16, **merged_from):
+    """
+    Writes `model` (LoRA merged, audio tower and projector included) as a single
+    safetensors file in its final `dtype`, next to its config and tokenizer, for
+    `load_merged_model`. `merged_from` (e.g. model_path, model_base) is recorded in
+    the config and marks the directory as a merged model.
+    """
+    model.to(dtype)
+    model.config.merged_from = merged_from
+    model.save_pretrained(save_path, safe_serialization=True, max_shard_size="1000GB")
+    tokenizer.save_pretrained(save_path)
+
+
+def is_merged_model(model_path):
+    config_file = os.path.join(model_path, "config.json")
+    if not os.path.isfile(config_file) or not os.path.isfile(
+        os.path.join(model_path, MERGED_WEIGHTS_NAME)
+    ):
+        return False
+    return hasattr(AutoConfig.from_pretrained(model_path), "merged_from")
+
+
+def load_merged_model(model_path, device="cuda", torch_dtype=None):
+    """
+    Loads a directory written by `save_merged_model`. The model is built on the meta
+    device and each tensor is read from the memory-mapped safetensors file straight
+    onto `device`, in the stored dtype unless `torch_dtype` is given; nothing is
+    materialized in fp32 or held twice. Returns the same tuple as
+    `load_pretrained_model`.
+    """
+    start = time.perf_counter()
+    config = AutoConfig.from_pretrained(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+    dtype = torch_dtype or config.torch_dtype
+    with init_empty_weights():
+        model = LlavaLlamaForCausalLM._from_config(config, torch_dtype=dtype)
+
+    with safe_open(
+        os.path.join(model_path, MERGED_WEIGHTS_NAME),
+        framework="pt",
+        device=str(device),
+    ) as f:
+        for name in f.keys():
+            set_module_tensor_to_device(
+                model, name, device, value=f.get_tensor(name), dtype=dtype
+            )
+    missing = [name for name, p in model.named_parameters() if p.is_meta]
+    if missing:
+        raise ValueError(f"{model_path} has no weights for {missing}")
+    # non-persistent buffers (e.g. rotary tables) were built on the host
+    model.to(device)
+    model.tie_weights()
+    model.eval()
+
+    vision_tower = model.get_vision_tower()
+    vision_tower.is_loaded = True
+    context_len = getattr(config, "max_sequence_length", 2048)
+    print(
+        f"=> Loaded merged model from {model_path} in {time.perf_counter() - start:.1f}s"
+    )
+    return tokenizer, model, vision_tower.image_processor, context_len
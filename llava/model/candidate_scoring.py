@@ -0,0 +1,25 @@
+"""
+Closed-set answers by likelihood: each question's candidate answers are scored after
+a single prefill of its prompt (`LlavaLlamaForCausalLM.score_candidates`).
+"""
+
+
+def score_candidate_batch(
+    model, input_ids, attention_mask, images, candidate_ids, image_sizes=None
+):
+    """
+    Length-normalized log-likelihoods of the candidates of each question of a
+    left-padded batch; `candidate_ids[i]` holds the token ids of question i's
+    candidates. Returns one list of scores per question.
+    """
+    scores = []
+    for i, candidates in enumerate(candidate_ids):
+        scores.append(
+            model.score_candidates(
+                input_ids[i : i + 1, attention_mask[i].bool()],
+                images[i : i + 1],
+                candidates,
+                image_sizes=image_sizes,
+            ).tolist()
+        )
+    return scores
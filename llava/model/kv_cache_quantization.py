@@ -0,0 +1,205 @@
+"""
+An int8 KV cache for inference with long prompts (lyrics + audio tokens) and beams.
+
+`Int8KVCache` is a transformers `Cache`, so the Llama attention (eager, sdpa or
+flash-attn 2) writes to it through `update` like to the default `DynamicCache`.
+Keys and values are stored as int8 with one fp32 scale per (batch, head, token), the
+absmax over the head dimension. As in the `QuantizedCache` of later transformers
+versions, the most recent tokens (fewer than `residual_length`) stay in full
+precision and are quantized as one chunk when the window is full, so a decoding
+step appends to a small tensor instead of copying the whole int8 cache. An attention
+layer reads the chunks dequantized into one tensor with the residual and the new
+states; the states computed in the current forward are used as they are, so the
+prompt's own prefill is exact. With 128-dim heads, storage is about half of
+fp16/bf16.
+
+Set `config.kv_cache_quantization = "int8"` (`load_pretrained_model(...,
+kv_cache_quantization="int8")`) and `LlavaLlamaForCausalLM` uses it at inference.
+The decoders built on it (`prefix_cache.py`, `speculative.py`, `sweep.py`) keep the
+cache object through `copy`, `crop` and `repeat_interleave` rather than converting
+it to legacy tuples.
+"""
+
+import torch
+from transformers.cache_utils import Cache
+
+
+@torch.no_grad()
+def quantize_per_token(states):
+    """int8 values and fp32 scales (absmax / 127 over the last dimension)."""
+    scale = states.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+    quantized = torch.round(states.float() / scale).clamp(-127, 127).to(torch.int8)
+    return quantized, scale
+
+
+def dequantize_states(chunks, states):
+    """
+    The quantized `chunks` ((int8, scales) pairs) followed by the full-precision
+    `states`, along the token dimension, in one tensor of the dtype of `states`.
+    """
+    if not chunks:
+        return torch.cat(states, dim=-2)
+    length = sum(q.shape[-2] for q, _ in chunks) + sum(s.shape[-2] for s in states)
+    out = states[0].new_empty(states[0].shape[:-2] + (length, states[0].shape[-1]))
+    start = 0
+    for quantized, scale in chunks:
+        end = start + quantized.shape[-2]
+        out[..., start:end, :].copy_(quantized).mul_(scale.to(out.dtype))
+        start = end
+    for s in states:
+        end = start + s.shape[-2]
+        out[..., start:end, :] = s
+        start = end
+    return out
+
+
+class Int8KVCache(Cache):
+    def __init__(self, residual_length=128):
+        self.residual_length = residual_length
+        # per layer: quantized chunks, (int8 batch x heads x tokens x head_dim,
+        # fp32 scales ... x 1), and the full-precision states after them
+        self.key_chunks = []
+        self.value_chunks = []
+        self.key_residual = []
+        self.value_residual = []
+        self.seen_tokens = 0
+
+    def __getitem__(self, layer_idx):
+        if layer_idx < len(self):
+            return (
+                dequantize_states(
+                    self.key_chunks[layer_idx], [self.key_residual[layer_idx]]
+                ),
+                dequantize_states(
+                    self.value_chunks[layer_idx], [self.value_residual[layer_idx]]
+                ),
+            )
+        raise KeyError(
+            f"Cache only has {len(self)} layers, attempted to access layer with index "
+            f"{layer_idx}"
+        )
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    def __len__(self):
+        return len(self.key_chunks)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+        if len(self) <= layer_idx:
+            empty = key_states.shape[:-2] + (0, key_states.shape[-1])
+            self.key_chunks.append([])
+            self.value_chunks.append([])
+            self.key_residual.append(key_states.new_empty(empty))
+            self.value_residual.append(value_states.new_empty(empty))
+
+        keys = dequantize_states(
+            self.key_chunks[layer_idx], [self.key_residual[layer_idx], key_states]
+        )
+        values = dequantize_states(
+            self.value_chunks[layer_idx], [self.value_residual[layer_idx], value_states]
+        )
+        key_residual = torch.cat([self.key_residual[layer_idx], key_states], dim=-2)
+        value_residual = torch.cat(
+            [self.value_residual[layer_idx], value_states], dim=-2
+        )
+        if key_residual.shape[-2] >= self.residual_length:
+            self.key_chunks[layer_idx].append(quantize_per_token(key_residual))
+            self.value_chunks[layer_idx].append(quantize_per_token(value_residual))
+            # new empty tensors, slices would keep the quantized states alive
+            empty = key_residual.shape[:-2] + (0, key_residual.shape[-1])
+            key_residual = key_residual.new_empty(empty)
+            value_residual = value_residual.new_empty(empty)
+        self.key_residual[layer_idx] = key_residual
+        self.value_residual[layer_idx] = value_residual
+        return keys, values
+
+    def get_seq_length(self, layer_idx=0):
+        if len(self) <= layer_idx:
+            return 0
+        return (
+            sum(q.shape[-2] for q, _ in self.key_chunks[layer_idx])
+            + self.key_residual[layer_idx].shape[-2]
+        )
+
+    def get_max_length(self):
+        return None
+
+    def _apply(self, fn):
+        """Replaces every stored tensor `t` by `fn(t)`."""
+        for chunks in self.key_chunks + self.value_chunks:
+            chunks[:] = [tuple(fn(t) for t in chunk) for chunk in chunks]
+        for residual in (self.key_residual, self.value_residual):
+            residual[:] = [fn(t) for t in residual]
+
+    def reorder_cache(self, beam_idx):
+        self._apply(lambda t: t.index_select(0, beam_idx.to(t.device)))
+
+    def copy(self):
+        """
+        A cache sharing this one's tensors: `update`, `crop` and `reorder_cache`
+        replace tensors rather than writing into them, so the copy can be extended
+        without changing this cache (e.g. a cached prompt prefix).
+        """
+        cache = Int8KVCache(self.residual_length)
+        cache.key_chunks = [list(chunks) for chunks in self.key_chunks]
+        cache.value_chunks = [list(chunks) for chunks in self.value_chunks]
+        cache.key_residual = list(self.key_residual)
+        cache.value_residual = list(self.value_residual)
+        cache.seen_tokens = self.seen_tokens
+        return cache
+
+    def repeat_interleave(self, repeats):
+        """A copy with each batch row repeated `repeats` times (e.g. per beam)."""
+        cache = self.copy()
+        cache._apply(lambda t: t.repeat_interleave(repeats, dim=0))
+        return cache
+
+    def crop(self, length):
+        """Keeps the first `length` tokens of every layer, in place."""
+        for chunks_list, residual in (
+            (self.key_chunks, self.key_residual),
+            (self.value_chunks, self.value_residual),
+        ):
+            for layer_idx, chunks in enumerate(chunks_list):
+                kept, start = [], 0
+                for quantized, scale in chunks:
+                    if start >= length:
+                        break
+                    end = min(start + quantized.shape[-2], length)
+                    kept.append(
+                        (
+                            quantized[..., : end - start, :],
+                            scale[..., : end - start, :],
+                        )
+                    )
+                    start = end
+                chunks[:] = kept
+                residual[layer_idx] = residual[layer_idx][
+                    ..., : max(length - start, 0), :
+                ]
+        self.seen_tokens = min(self.seen_tokens, length)
+        return self
+
+    def to_legacy_cache(self):
+        return tuple(self)
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values=None):
+        cache = cls()
+        if past_key_values is not None:
+            for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+                cache.update(key_states, value_states, layer_idx)
+        return cache
+
+    def num_bytes(self):
+        chunks = [c for chunks in self.key_chunks + self.value_chunks for c in chunks]
+        return sum(
+            t.numel() * t.element_size()
+            for t in [t for chunk in chunks for t in chunk]
+            + self.key_residual
+            + self.value_residual
+        )
@@ -26,10 +26,13 @@ from transformers import (
     LlamaForCausalLM,
 )
 
+from transformers.cache_utils import Cache
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.generation.utils import GenerateOutput
 
+from ..kv_cache_quantization import Int8KVCache
 from ..llava_arch import LlavaMetaModel, LlavaMetaForCausalLM
+from ..manual_decode import attend, forward_hidden, project_qkv
 
 
 class LlavaConfig(LlamaConfig):
@@ -73,6 +76,7 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
         images: Optional[torch.FloatTensor] = None,
         image_sizes: Optional[List[List[int]]] = None,
         return_dict: Optional[bool] = None,
+        image_index: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
 
         if inputs_embeds is None:
@@ -91,8 +95,19 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                 labels,
                 images,
                 image_sizes,
+                image_index=image_index,
             )
 
+        if use_cache is None:
+            use_cache = self.config.use_cache
+        if (
+            getattr(self.config, "kv_cache_quantization", None) == "int8"
+            and use_cache
+            and not self.training
+            and not isinstance(past_key_values, Cache)
+        ):
+            past_key_values = Int8KVCache.from_legacy_cache(past_key_values)
+
         return super().forward(
             input_ids=input_ids,
             attention_mask=attention_mask,
@@ -129,6 +144,8 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
                     None,
                     images,
                     image_sizes=image_sizes,
+                    # batched prompts must end where generation starts
+                    padding_side="left",
                 )
             )
         else:
@@ -141,6 +158,96 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM, LlavaMetaForCausalLM):
             **kwargs,
         )
 
+    @torch.no_grad()
+    def score_candidates(
+        self,
+        input_ids: torch.Tensor,
+        images: Optional[torch.Tensor],
+        candidates: List[List[int]],
+        image_sizes: Optional[torch.Tensor] = None,
+        normalize: bool = True,
+        chunk_size: int = 32,
+    ) -> torch.FloatTensor:
+        """
+        Log-likelihoods of `candidates` (token ids of each answer) as continuations
+        of one prompt (`input_ids` 1 x L, without padding) and its audio. The prompt
+        is prefilled once and the candidates run in batches of `chunk_size` that all
+        attend to the one copy of its KV cache (see llava/model/manual_decode.py), so
+        only a batch's own keys, values and logits are allocated per candidate.
+        With `normalize`, the sum is divided by the candidate's length. Returns one
+        score per candidate; empty candidates score -inf.
+        """
+        _, _, _, _, inputs_embeds, _ = self.prepare_inputs_labels_for_multimodal(
+            input_ids, None, None, None, None, images, image_sizes=image_sizes
+        )
+        if inputs_embeds is None:
+            inputs_embeds = self.get_model().embed_tokens(input_ids)
+        # the text model alone: a legacy cache and no logits for the prompt positions
+        out = self.get_model()(inputs_embeds=inputs_embeds, use_cache=True)
+        # the first token is predicted by the prompt's last position
+        first_logits = self.lm_head(out.last_hidden_state[:, -1]).float()
+        scores = [
+            self._score_continuations(
+                out.past_key_values,
+                first_logits,
+                candidates[start : start + chunk_size],
+            )
+            for start in range(0, len(candidates), chunk_size)
+        ]
+        if not scores:
+            return torch.empty(0, device=self.device)
+        scores, lengths = (torch.cat(t) for t in zip(*scores))
+        if normalize:
+            scores = scores / lengths.clamp(min=1)
+        return scores.masked_fill(lengths == 0, float("-inf"))
+
+    def _score_continuations(self, prefix_cache, first_logits, candidates):
+        """Summed log-likelihoods and lengths of `candidates` after `prefix_cache`."""
+        num_candidates = len(candidates)
+        lengths = torch.tensor([len(c) for c in candidates], device=self.device)
+        max_len = lengths.max().item()
+        if max_len == 0:
+            return lengths.float(), lengths
+        ids = torch.zeros(
+            (num_candidates, max_len), dtype=torch.long, device=self.device
+        )
+        for i, candidate in enumerate(candidates):
+            ids[i, : len(candidate)] = torch.tensor(candidate, device=self.device)
+        mask = torch.arange(max_len, device=self.device) < lengths[:, None]
+
+        logits = first_logits[:, None].expand(num_candidates, -1, -1)
+        if max_len > 1:
+            # the last token predicts nothing that is scored
+            inputs = ids[:, :-1]
+            prefix_len = prefix_cache[0][0].shape[2]
+            position_ids = prefix_len + torch.arange(
+                inputs.shape[1], device=self.device
+            )
+            position_ids = position_ids.expand_as(inputs)
+            # candidates are padded on the right, causal attention keeps the padding
+            # away from the real tokens
+            causal = torch.ones(
+                (inputs.shape[1], inputs.shape[1]), dtype=torch.bool, device=self.device
+            ).tril()
+
+            def attention(layer_idx, attn, hidden):
+                q, k, v = project_qkv(
+                    attn, hidden, position_ids, prefix_len + inputs.shape[1]
+                )
+                return attend(
+                    attn,
+                    q,
+                    prefix_kv=prefix_cache[layer_idx],
+                    suffix_kv=(k, v),
+                    suffix_mask=causal,
+                )
+
+            hidden = forward_hidden(self, inputs, attention)
+            logits = torch.cat([logits, self.lm_head(hidden).float()], dim=1)
+        log_probs = torch.log_softmax(logits, dim=-1)
+        token_log_probs = log_probs.gather(-1, ids.unsqueeze(-1)).squeeze(-1)
+        return (token_log_probs * mask).sum(dim=-1), lengths
+
     def prepare_inputs_for_generation(
         self, input_ids, past_key_values=None, inputs_embeds=None, **kwargs
     ):
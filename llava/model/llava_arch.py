@@ -16,6 +16,7 @@ from llava.constants import (
 )
 
 from llava.mm_utils import get_anyres_image_grid_shape
+from llava.profiling import step_profiler
 
 # Pretrain
 # Llavametamodel config LlavaConfig {
@@ -184,10 +185,13 @@ class LlavaMetaForCausalLM(ABC):
         return self.get_model().get_vision_tower()
 
     def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
-        image_features = self.get_model().mm_projector(image_features)
+        with step_profiler.phase("audio_encoder"):
+            image_features = self.get_model().get_vision_tower()(images)
+        with step_profiler.phase("projector"):
+            image_features = self.get_model().mm_projector(image_features)
         return image_features
 
+    @step_profiler.wrap("prepare_inputs")
     def prepare_inputs_labels_for_multimodal(
         self,
         input_ids,
@@ -197,6 +201,8 @@ class LlavaMetaForCausalLM(ABC):
         labels,
         images,
         image_sizes=None,
+        image_index=None,
+        padding_side=None,
     ):
         # print(images.shape, image_sizes) # torch.Size([32, 1024, 128]) None
         vision_tower = self.get_vision_tower()
@@ -291,6 +297,9 @@ class LlavaMetaForCausalLM(ABC):
             # for audio inputs, we use patching etc in AudioMAE
             # assert isinstance(self.get_model().get_vision_tower(), AudioMAEencoder)
             image_features = self.encode_images(images)
+            if image_index is not None:
+                # clips shared by several samples were collated (and encoded) once
+                image_features = image_features[image_index]
             # bs x num_patch x projector_hidden
 
         # TODO: image start / end is not implemented here to support pretraining.
@@ -404,6 +413,8 @@ class LlavaMetaForCausalLM(ABC):
             new_labels = [x[:tokenizer_model_max_length] for x in new_labels]
 
         # Combine them
+        if padding_side is None:
+            padding_side = getattr(self.config, "tokenizer_padding_side", "right")
         max_len = max(x.shape[0] for x in new_input_embeds)
         batch_size = len(new_input_embeds)
 
@@ -427,7 +438,7 @@ class LlavaMetaForCausalLM(ABC):
             zip(new_input_embeds, new_labels)
         ):
             cur_len = cur_new_embed.shape[0]
-            if getattr(self.config, "tokenizer_padding_side", "right") == "left":
+            if padding_side == "left":
                 new_input_embeds_padded.append(
                     torch.cat(
                         (
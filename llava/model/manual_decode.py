@@ -0,0 +1,106 @@
+"""
+A hand-written Llama forward over a few new tokens per row for the decoders that
+manage their own KV cache (`static_cache.py`, `beam_search.py`, one token per row)
+and for scoring candidate answers after a shared prompt
+(`LlavaLlamaForCausalLM.score_candidates`).
+
+The keys and values the new tokens attend to come in two parts: a `prefix` of
+1 x kv heads x P x head_dim shared by all rows, attended without an expanded copy
+(the queries of all rows are stacked per KV head), and a per-row `suffix` of
+batch x kv heads x S x head_dim with an optional mask of the visible positions.
+Storing the new tokens' keys and values is left to the caller.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
+
+
+def project_qkv(attn, hidden, position_ids, rope_len):
+    """
+    Queries, keys and values (batch x heads x T x head_dim) of `hidden`
+    (batch x T x hidden) at `position_ids` (batch x T), with rotary embeddings
+    computed for `rope_len` positions.
+    """
+    bsz, q_len = hidden.shape[:2]
+    head_dim = attn.head_dim
+    q = attn.q_proj(hidden).view(bsz, q_len, attn.num_heads, head_dim)
+    k = attn.k_proj(hidden).view(bsz, q_len, attn.num_key_value_heads, head_dim)
+    v = attn.v_proj(hidden).view(bsz, q_len, attn.num_key_value_heads, head_dim)
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    cos, sin = attn.rotary_emb(v, seq_len=rope_len)
+    q, k = apply_rotary_pos_emb(q, k, cos, sin, position_ids)
+    return q, k, v
+
+
+def attend(attn, q, prefix_kv=None, suffix_kv=None, suffix_mask=None):
+    """
+    Output of `attn` for the queries `q` over `prefix_kv` and `suffix_kv` (see the
+    module docstring); `suffix_mask` (broadcast to batch x 1 x T x S) marks the
+    suffix positions that may be attended.
+    """
+    bsz, _, q_len, head_dim = q.shape
+    num_kv_heads = attn.num_key_value_heads
+    # the query heads of a KV head are consecutive: rows of groups x T queries
+    rows = attn.num_key_value_groups * q_len
+    q = q.reshape(bsz, num_kv_heads, rows, head_dim)
+    scores = []
+    if prefix_kv is not None:
+        prefix_k, prefix_v = prefix_kv[0][0], prefix_kv[1][0]  # kv heads x P x D
+        prefix_len = prefix_k.shape[1]
+        # kv heads x (batch * rows) x D: all rows against the one prefix copy
+        stacked_q = q.transpose(0, 1).reshape(num_kv_heads, bsz * rows, head_dim)
+        prefix_scores = torch.bmm(stacked_q, prefix_k.transpose(1, 2))
+        prefix_scores = prefix_scores.view(num_kv_heads, bsz, rows, prefix_len)
+        scores.append(prefix_scores.transpose(0, 1))
+    if suffix_kv is not None:
+        suffix_scores = torch.matmul(q, suffix_kv[0].transpose(2, 3))
+        if suffix_mask is not None:
+            suffix_len = suffix_scores.shape[-1]
+            suffix_scores = (
+                suffix_scores.view(bsz, attn.num_heads, q_len, suffix_len)
+                .masked_fill(~suffix_mask, torch.finfo(suffix_scores.dtype).min)
+                .view(bsz, num_kv_heads, rows, suffix_len)
+            )
+        scores.append(suffix_scores)
+    scores = torch.cat(scores, dim=-1) / math.sqrt(head_dim)
+    probs = F.softmax(scores, dim=-1, dtype=torch.float32).to(q.dtype)
+
+    out = 0
+    if prefix_kv is not None:
+        prefix_probs = probs[..., :prefix_len].transpose(0, 1)
+        prefix_out = torch.bmm(
+            prefix_probs.reshape(num_kv_heads, bsz * rows, prefix_len), prefix_v
+        )
+        out = prefix_out.view(num_kv_heads, bsz, rows, head_dim).transpose(0, 1)
+        probs = probs[..., prefix_len:]
+    if suffix_kv is not None:
+        out = out + torch.matmul(probs, suffix_kv[1])
+    out = out.reshape(bsz, attn.num_heads, q_len, head_dim).transpose(1, 2)
+    return attn.o_proj(out.reshape(bsz, q_len, attn.num_heads * head_dim))
+
+
+def forward_hidden(model, tokens, attention):
+    """
+    Final hidden states (batch x T x hidden, after the last norm) of `tokens`
+    (batch x T). For each layer, `attention(layer_idx, self_attn, hidden)` returns
+    the attention output of the normalized hidden states (typically `project_qkv`,
+    storing the new keys and values, then `attend`).
+    """
+    hidden = model.get_model().embed_tokens(tokens)
+    for layer_idx, layer in enumerate(model.get_model().layers):
+        residual = hidden
+        hidden = attention(layer_idx, layer.self_attn, layer.input_layernorm(hidden))
+        hidden = residual + hidden
+        hidden = hidden + layer.mlp(layer.post_attention_layernorm(hidden))
+    return model.get_model().norm(hidden)
+
+
+def decode_step(model, tokens, attention):
+    """
+    Logits (batch x vocab) of the token after `tokens` (batch x 1), see
+    `forward_hidden`.
+    """
+    return model.lm_head(forward_hidden(model, tokens, attention))[:, -1].float()
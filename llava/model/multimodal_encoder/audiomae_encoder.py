@@ -102,10 +102,17 @@ class AudioPreprocessor:
             fbank = m(fbank)
         elif p < 0:
             fbank = fbank[: self.target_length, :]
-        return fbank, 0
-
-    def preprocess(self, datum, *args, **kwargs):
-        fbank, _ = self._wav2fbank(datum["local_audio_path"])
+        return fbank, n_frames
+
+    def preprocess(self, datum, *args, return_duration=False, **kwargs):
+        """With `return_duration`, also returns the seconds of audio in the window."""
+        if "fbank" in datum:
+            # precomputed by _wav2fbank, e.g. read from audio shards
+            fbank = torch.as_tensor(datum["fbank"])
+            n_frames = datum.get("num_frames", fbank.shape[0])
+        else:
+            # a path or a file-like object holding the encoded audio
+            fbank, n_frames = self._wav2fbank(datum["local_audio_path"])
         freqm = torchaudio.transforms.FrequencyMasking(self.freqm)
         timem = torchaudio.transforms.TimeMasking(self.timem)
         fbank = fbank.transpose(0, 1).unsqueeze(0)  # 1, 128, 1024 (..., freq, time)
@@ -116,6 +123,9 @@ class AudioPreprocessor:
         fbank = torch.transpose(fbank.squeeze(), 0, 1)  # time, freq
         fbank = (fbank - self.audio_conf["mean"]) / (self.audio_conf["std"] * 2)
         # [time_frame_num, frequency_bins], e.g., [1024*3, 128]
+        if return_duration:
+            # 10 ms frame shift
+            return fbank.unsqueeze(0), min(n_frames, self.target_length) / 100
         return fbank.unsqueeze(0)
 
 
@@ -179,7 +189,6 @@ class AudioMAEencoder(nn.Module):
             print(f"\n=>Loaded pretrained audio ckpt. MSG: {msg}")
         self.mae.requires_grad_(False)
 
-    @torch.no_grad()
     def pool_freq(self, x):
         # x: bs * 3, 512, h
         bs3, h = x.shape[0], x.shape[2]
@@ -188,12 +197,15 @@ class AudioMAEencoder(nn.Module):
         x = x.view(bs3, -1, 512 // self.audio_num_pooling_tokens, h).mean(dim=1)
         return x
 
-    @torch.no_grad()
     def forward(self, x):
-        bs, num_chan, num_frames, num_bins = x.shape
-        assert num_frames == self.image_processor.target_length
-        xxx = torch.cat(torch.split(x, num_frames // 3, dim=2), dim=0)
-        all_hidden = self.mae.forward_features_no_pooling(xxx)[:, 1:, :]
-        all_hidden = self.pool_freq(all_hidden)  # bs*3 x 64 x hidden
-        x = torch.cat(torch.split(all_hidden, bs, dim=0), dim=1)
+        # frozen unless stage2_tune_encoder made the AudioMAE params trainable, then
+        # gradients (and activation checkpointing) reach its blocks
+        trainable = any(p.requires_grad for p in self.mae.parameters())
+        with torch.set_grad_enabled(trainable and torch.is_grad_enabled()):
+            bs, num_chan, num_frames, num_bins = x.shape
+            assert num_frames == self.image_processor.target_length
+            xxx = torch.cat(torch.split(x, num_frames // 3, dim=2), dim=0)
+            all_hidden = self.mae.forward_features_no_pooling(xxx)[:, 1:, :]
+            all_hidden = self.pool_freq(all_hidden)  # bs*3 x 64 x hidden
+            x = torch.cat(torch.split(all_hidden, bs, dim=0), dim=1)
         return x
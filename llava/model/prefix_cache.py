@@ -0,0 +1,111 @@
+"""
+Reuse of the KV cache of a prompt's prefix across requests about the same audio.
+
+A prompt is split after its (last) audio placeholder: the prefix is the system
+prompt and template up to and including the audio tokens, the rest is the question.
+`PrefixKVCache` keeps the keys and values of prefixes under
+(model id, prefix token ids, hash of the audio features), evicting the least
+recently used entries beyond `max_bytes`, and `generate_with_prefix_cache` only
+prefills the question tokens when the prefix is cached. The token ids carry the
+template and its system prompt, so a different template is a different key.
+"""
+
+import hashlib
+from collections import OrderedDict
+
+import torch
+from transformers import LlamaForCausalLM
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.kv_cache_quantization import Int8KVCache
+
+
+def audio_digest(images):
+    return hashlib.sha1(images.detach().cpu().float().numpy().tobytes()).hexdigest()
+
+
+def cache_bytes(past_key_values):
+    if isinstance(past_key_values, Int8KVCache):
+        return past_key_values.num_bytes()
+    return sum(t.numel() * t.element_size() for kv in past_key_values for t in kv)
+
+
+class PrefixKVCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, past_key_values):
+        size = cache_bytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= cache_bytes(self.entries.pop(key))
+        while self.entries and self.num_bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= cache_bytes(evicted)
+        self.entries[key] = past_key_values
+        self.num_bytes += size
+
+
+@torch.no_grad()
+def generate_with_prefix_cache(
+    model, input_ids, images, cache, model_id, image_sizes=None, **kwargs
+):
+    """
+    `model.generate(input_ids, images=images, **kwargs)` for a single sample
+    (greedy or sampling), reusing the cached prefix up to the audio tokens. Returns
+    the new token ids only.
+    """
+    if kwargs.get("num_beams", 1) > 1:
+        raise ValueError("generate_with_prefix_cache does not support beam search")
+    image_positions = torch.where(input_ids[0] == IMAGE_TOKEN_INDEX)[0]
+    split = image_positions[-1].item() + 1 if len(image_positions) else 0
+    prefix_ids, question_ids = input_ids[:, :split], input_ids[:, split:]
+    if split == 0 or question_ids.shape[1] == 0:
+        output_ids = model.generate(
+            input_ids, images=images, image_sizes=image_sizes, **kwargs
+        )
+        # drop the placeholder token generate puts before the output
+        return output_ids[:, 1:]
+
+    key = (model_id, tuple(prefix_ids[0].tolist()), audio_digest(images))
+    past_key_values = cache.get(key)
+    if past_key_values is None:
+        _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            prefix_ids, None, None, None, None, images, image_sizes=image_sizes
+        )
+        past_key_values = model(inputs_embeds=inputs_embeds, use_cache=True)[1]
+        cache.put(key, past_key_values)
+    if isinstance(past_key_values, Int8KVCache):
+        # generate appends to the cache object, the cached entry must stay the prefix
+        past_key_values = past_key_values.copy()
+        prefix_len = past_key_values.get_seq_length()
+    else:
+        prefix_len = past_key_values[0][0].shape[2]
+
+    # the cached positions only need placeholders: generate feeds the ids after them
+    placeholders = torch.zeros(
+        (1, prefix_len), dtype=input_ids.dtype, device=input_ids.device
+    )
+    ids = torch.cat([placeholders, question_ids], dim=1)
+    # the text-only generate of the LLM, LLaVA's own one would embed the ids
+    output_ids = LlamaForCausalLM.generate(
+        model,
+        ids,
+        attention_mask=torch.ones_like(ids),
+        past_key_values=past_key_values,
+        **kwargs,
+    )
+    return output_ids[:, ids.shape[1] :]
@@ -0,0 +1,132 @@
+"""
+Weight-only quantization of the linear layers for CPU inference, in plain PyTorch
+(no bitsandbytes).
+
+    "int8"  one scale per output channel
+    "int4"  one scale per `group_size` input columns, two weights packed per byte
+
+Activations stay in the compute dtype. For the few rows of a decoding step, int8
+layers use `torch._weight_int8pack_mm` when this torch has it; otherwise, and for
+int4 or long inputs (prefill, the audio tower), the weight is dequantized for the
+matmul, which for many rows costs less than the matmul itself.
+"""
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+QUANTIZE_MODES = {"int8": 8, "int4": 4}
+# `_weight_int8pack_mm` beats dequantize + matmul only for a handful of rows
+INT8PACK_MAX_ROWS = 16
+
+
+def cpu_compute_dtype():
+    """bf16 where the CPU has native bf16 matmuls, fp32 otherwise."""
+    if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        return torch.bfloat16
+    return torch.float32
+
+
+class QuantizedLinear(nn.Module):
+    def __init__(self, linear, bits=8, group_size=128):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.bits = bits
+        weight = linear.weight.detach().float()
+        if bits == 8:
+            scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+            qweight = torch.round(weight / scale[:, None]).clamp(-127, 127)
+            self.register_buffer("qweight", qweight.to(torch.int8))
+        else:
+            self.group_size = group_size
+            groups = weight.view(self.out_features, -1, group_size)
+            scale = groups.abs().amax(dim=2).clamp(min=1e-8) / 7
+            qweight = torch.round(groups / scale[:, :, None]).clamp(-8, 7) + 8
+            qweight = qweight.to(torch.uint8).view(self.out_features, -1, 2)
+            self.register_buffer("qweight", qweight[..., 0] | (qweight[..., 1] << 4))
+        self.register_buffer("scale", scale)
+        self.bias = linear.bias
+
+    def _apply(self, fn, *args, **kwargs):
+        # `.to(dtype)`, `.half()` and the like move the scales but keep them fp32
+        scale = self.scale
+        super()._apply(fn, *args, **kwargs)
+        self.scale = scale.to(self.scale.device)
+        return self
+
+    def dequantize(self, dtype):
+        if self.bits == 8:
+            return self.qweight.to(dtype) * self.scale.to(dtype)[:, None]
+        qweight = torch.stack((self.qweight & 15, self.qweight >> 4), dim=-1)
+        groups = qweight.view(self.out_features, -1, self.group_size).to(dtype) - 8
+        weight = groups * self.scale.to(dtype)[:, :, None]
+        return weight.view(self.out_features, self.in_features)
+
+    def forward(self, x):
+        num_rows = x.numel() // self.in_features
+        if (
+            self.bits == 8
+            and num_rows <= INT8PACK_MAX_ROWS
+            and x.device.type == "cpu"
+            and hasattr(torch, "_weight_int8pack_mm")
+        ):
+            out = torch._weight_int8pack_mm(
+                x.reshape(num_rows, self.in_features).contiguous(),
+                self.qweight,
+                self.scale.to(x.dtype),
+            ).view(*x.shape[:-1], self.out_features)
+        elif self.bits == 8:
+            # the per-channel scale commutes with the matmul
+            out = F.linear(x, self.qweight.to(x.dtype)) * self.scale.to(x.dtype)
+        else:
+            out = F.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bits={self.bits}, bias={self.bias is not None}"
+        )
+
+
+def quantize_model(
+    model, mode="int8", group_size=128, compute_dtype=None, skip=("mm_projector",)
+):
+    """
+    Replaces the nn.Linear layers of `model` (LLM and AudioMAE encoder; not the ones
+    whose name contains an entry of `skip`) by `QuantizedLinear`, then casts the
+    remaining floating point weights to `compute_dtype` (default
+    `cpu_compute_dtype()`); the quantization scales stay fp32. int4 layers whose input size is not a multiple of
+    `group_size` are quantized to int8 instead.
+    """
+    bits = QUANTIZE_MODES[mode]
+    compute_dtype = compute_dtype or cpu_compute_dtype()
+    linears = [
+        (name, module)
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not any(s in name for s in skip)
+    ]
+    for name, linear in linears:
+        layer_bits = bits
+        if bits == 4 and linear.in_features % group_size:
+            layer_bits = 8
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child_name, QuantizedLinear(linear, layer_bits, group_size))
+    model.to(compute_dtype)
+    print(
+        f"=> Quantized {len(linears)} linear layers to {mode}, computing in "
+        f"{compute_dtype}; {model_size_bytes(model) / 2**30:.2f} GiB"
+    )
+    return model
+
+
+def model_size_bytes(model):
+    tensors = {
+        t.data_ptr(): t.numel() * t.element_size()
+        for t in list(model.parameters()) + list(model.buffers())
+    }
+    return sum(tensors.values())
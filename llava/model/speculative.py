@@ -0,0 +1,262 @@
+"""
+Speculative decoding for `LlavaLlamaForCausalLM`, one sample at a time.
+
+The audio prefix is encoded once through `prepare_inputs_labels_for_multimodal`;
+after that a proposer guesses the next few tokens from the text alone and the model
+checks all of them in a single forward over its KV cache. Two proposers:
+
+    PromptLookupProposer  copies what followed the latest earlier occurrence of the
+                          last n-gram (prompt + generated text), e.g. lyrics that
+                          are quoted back
+    DraftModelProposer    a small text-only causal LM sharing the tokenizer
+
+The draft model's and the model's logits go through the logits processors
+`generate` builds from the generation config (repetition penalty, no-repeat
+n-grams, bad words, ...) and, when sampling, its warpers (temperature, top-k,
+top-p). Greedy outputs are those of greedy `generate` (up to the numerics of
+verifying several positions in one forward); sampling uses standard rejection
+sampling, so the output distribution is that of sampling from the model itself.
+"""
+
+import copy
+
+import torch
+from transformers import LogitsProcessorList
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.kv_cache_quantization import Int8KVCache
+
+
+def _crop_cache(past_key_values, length):
+    if isinstance(past_key_values, Int8KVCache):
+        return past_key_values.crop(length)
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+class PromptLookupProposer:
+    def __init__(self, max_ngram_size=3):
+        self.max_ngram_size = max_ngram_size
+
+    def propose(self, tokens, num_tokens, process=None):
+        """Returns the proposed tokens and, per token, its proposal distribution
+        (None: the token was chosen deterministically). `process(tokens, logits)`
+        applies the logits processors (and warpers) given the preceding tokens."""
+        for n in range(min(self.max_ngram_size, len(tokens) - 1), 0, -1):
+            ngram = tokens[-n:]
+            for start in range(len(tokens) - n - 1, -1, -1):
+                if tokens[start : start + n] == ngram:
+                    draft = tokens[start + n : start + n + num_tokens]
+                    return draft, [None] * len(draft)
+        return [], []
+
+
+class DraftModelProposer:
+    def __init__(self, model, do_sample=False):
+        self.model = model
+        self.do_sample = do_sample
+        self.past_key_values = None
+        # the tokens whose keys and values are in `past_key_values`
+        self.cached = []
+
+    @torch.no_grad()
+    def propose(self, tokens, num_tokens, process=None):
+        common = 0
+        for cached, token in zip(self.cached, tokens[:-1]):
+            if cached != token:
+                break
+            common += 1
+        past_key_values = None
+        if common:
+            past_key_values = _crop_cache(self.past_key_values, common)
+        device = self.model.device
+        input_ids = torch.tensor([tokens[common:]], device=device)
+        draft, probs = [], []
+        while True:
+            out = self.model(
+                input_ids=input_ids, past_key_values=past_key_values, use_cache=True
+            )
+            past_key_values = out.past_key_values
+            logits = process(tokens + draft, out.logits[0, -1].float())
+            if self.do_sample:
+                q = torch.softmax(logits, dim=-1)
+                token = torch.multinomial(q, 1).item()
+            else:
+                q, token = None, logits.argmax().item()
+            draft.append(token)
+            probs.append(q)
+            if len(draft) == num_tokens:
+                break
+            input_ids = torch.tensor([[token]], device=device)
+        self.past_key_values = past_key_values
+        self.cached = tokens + draft[:-1]
+        return draft, probs
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    input_ids,
+    images,
+    proposer,
+    image_sizes=None,
+    max_new_tokens=128,
+    num_draft_tokens=5,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    eos_token_id=None,
+    **kwargs,
+):
+    """
+    Generates for a single sample (`input_ids` 1 x L, without padding). Further
+    `kwargs` update the generation config like those of `generate` (e.g.
+    `repetition_penalty`). Returns the new token ids (1 x N, like `generate` with a
+    multimodal prefix) and the number of proposed and accepted draft tokens.
+    """
+    generation_config = copy.deepcopy(model.generation_config)
+    unused = generation_config.update(
+        do_sample=do_sample, temperature=temperature, top_p=top_p, **kwargs
+    )
+    if unused:
+        raise ValueError(
+            f"speculative_generate got unknown generation options {sorted(unused)}"
+        )
+    if eos_token_id is None:
+        eos_token_id = generation_config.eos_token_id
+    eos_token_ids = set(
+        eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+    )
+    # the ids the processors see in `generate`, where the prompt is embedded: a
+    # bos placeholder and the generated tokens
+    placeholder = torch.tensor(
+        [[generation_config.bos_token_id]], device=input_ids.device
+    )
+    processors = model._get_logits_processor(
+        generation_config=generation_config,
+        input_ids_seq_length=1,
+        encoder_input_ids=placeholder,
+        prefix_allowed_tokens_fn=None,
+        logits_processor=LogitsProcessorList(),
+    )
+    if do_sample:
+        processors.extend(model._get_logits_warper(generation_config))
+    # what the proposer sees: the prompt text and the generated tokens
+    context = [t for t in input_ids[0].tolist() if t != IMAGE_TOKEN_INDEX]
+
+    def process(tokens, logits):
+        """The processed `logits` of the token after `tokens` (context + output)."""
+        ids = placeholder.new_tensor([tokens[len(context) :]])
+        return processors(torch.cat([placeholder, ids], dim=1), logits[None])[0]
+
+    def pick(tokens, logits):
+        logits = process(tokens, logits)
+        if not do_sample:
+            return logits.argmax().item()
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).item()
+
+    def verify(tokens, logits, token, q):
+        """Whether `token` is accepted and, if not, the token to emit instead."""
+        logits = process(tokens, logits)
+        if not do_sample:
+            target = logits.argmax().item()
+            return target == token, target
+        p = torch.softmax(logits, dim=-1)
+        if q is None:
+            q = torch.zeros_like(p)
+            q[token] = 1
+        if torch.rand(()).item() < min(1.0, (p[token] / q[token]).item()):
+            return True, None
+        residual = (p - q).clamp(min=0)
+        if residual.sum() <= 0:
+            residual = p
+        return False, torch.multinomial(residual, 1).item()
+
+    _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+        input_ids, None, None, None, None, images, image_sizes=image_sizes
+    )
+    out = model(inputs_embeds=inputs_embeds, use_cache=True)
+    prefix_len = inputs_embeds.shape[1]
+    past_key_values = out.past_key_values
+    generated = []
+    num_proposed = num_accepted = 0
+
+    next_token = pick(context, out.logits[0, -1].float())
+    while True:
+        generated.append(next_token)
+        if next_token in eos_token_ids or len(generated) >= max_new_tokens:
+            break
+        draft, probs = proposer.propose(
+            context + generated,
+            min(num_draft_tokens, max_new_tokens - len(generated)),
+            process,
+        )
+        out = model(
+            input_ids=torch.tensor([[next_token] + draft], device=model.device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        logits = out.logits[0].float()
+        num_proposed += len(draft)
+        next_token, finished = None, False
+        for i, (token, q) in enumerate(zip(draft, probs)):
+            accepted, replacement = verify(context + generated, logits[i], token, q)
+            if not accepted:
+                next_token = replacement
+                break
+            generated.append(token)
+            num_accepted += 1
+            if token in eos_token_ids or len(generated) >= max_new_tokens:
+                finished = True
+                break
+        if finished:
+            break
+        if next_token is None:
+            next_token = pick(context + generated, logits[len(draft)])
+        # keep the cache of the tokens that were kept, `next_token` is fed next
+        past_key_values = _crop_cache(out.past_key_values, prefix_len + len(generated))
+
+    output_ids = torch.tensor([generated], device=input_ids.device)
+    return output_ids, num_proposed, num_accepted
+
+
+def speculative_generate_batch(
+    model,
+    input_ids,
+    attention_mask,
+    images,
+    draft_model=None,
+    max_new_tokens=128,
+    num_draft_tokens=5,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    **kwargs,
+):
+    """
+    `speculative_generate` for each question of a left-padded batch, proposing with
+    `draft_model` or, without one, prompt lookup; `kwargs` update the generation
+    config. Returns the new token ids of each question and the number of proposed
+    and accepted draft tokens.
+    """
+    output_ids, num_proposed, num_accepted = [], 0, 0
+    for i in range(input_ids.shape[0]):
+        if draft_model is None:
+            proposer = PromptLookupProposer()
+        else:
+            proposer = DraftModelProposer(draft_model, do_sample=do_sample)
+        ids, proposed, accepted = speculative_generate(
+            model,
+            input_ids[i : i + 1, attention_mask[i].bool()],
+            images[i : i + 1],
+            proposer,
+            max_new_tokens=max_new_tokens,
+            num_draft_tokens=num_draft_tokens,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            **kwargs,
+        )
+        output_ids.append(ids[0].tolist())
+        num_proposed += proposed
+        num_accepted += accepted
+    return output_ids, num_proposed, num_accepted
@@ -0,0 +1,171 @@
+"""
+Decoding with a preallocated KV cache.
+
+HF's cache (and the training-time flash-attn / xformers patches) grows the keys and
+values with `torch.cat` at every step, which reallocates and copies the whole cache
+per token and gives every step new shapes. `StaticKVCache` allocates
+prompt length + `max_new_tokens` positions once; `decode_step` writes the new
+token's keys and values in place (`index_copy_` at a position tensor) and attends
+over the whole buffer with the unused positions masked, so all its shapes are
+fixed and it can be wrapped in `torch.compile` without recompiling per token.
+"""
+
+import copy
+
+import torch
+import torch.nn.functional as F
+from transformers import LlamaForCausalLM
+
+from llava.model import manual_decode
+from llava.model.manual_decode import attend, project_qkv
+
+
+class StaticKVCache:
+    def __init__(self, keys, values):
+        # per layer: batch x kv heads x max_len x head_dim
+        self.keys = keys
+        self.values = values
+        self.max_len = keys[0].shape[2]
+
+    @classmethod
+    def allocate(cls, model, max_len, batch_size=1):
+        """Buffers of `max_len` positions for `model`, to reuse across prompts."""
+        config = model.config
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_key_value_heads, max_len, head_dim)
+        weight = model.get_model().embed_tokens.weight
+        keys = [weight.new_zeros(shape) for _ in range(config.num_hidden_layers)]
+        values = [weight.new_zeros(shape) for _ in range(config.num_hidden_layers)]
+        return cls(keys, values)
+
+    @classmethod
+    def from_prefill(cls, past_key_values, max_len):
+        """Copies the prompt's (HF) cache into buffers of `max_len` positions."""
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        keys, values = [], []
+        for k, v in past_key_values:
+            shape = (*k.shape[:2], max_len, k.shape[3])
+            keys.append(k.new_zeros(shape))
+            values.append(v.new_zeros(shape))
+        cache = cls(keys, values)
+        cache.load_prefill(past_key_values)
+        return cache
+
+    def load_prefill(self, past_key_values):
+        """
+        Copies the prompt's (HF) cache to the first positions; what a previous prompt
+        left after them is masked by `decode_step`.
+        """
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        for keys, values, (k, v) in zip(self.keys, self.values, past_key_values):
+            keys[:, :, : k.shape[2]] = k
+            values[:, :, : v.shape[2]] = v
+
+    def num_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+
+def decode_step(model, cache, tokens, position):
+    """
+    Logits (batch x vocab) of the token after `tokens` (batch x 1), which sit at
+    `position` (a 1-element long tensor) in every row.
+    """
+    position_ids = position.expand(tokens.shape[0], 1)
+    # positions after the current token are still empty
+    visible = torch.arange(cache.max_len, device=tokens.device) <= position
+
+    def attention(layer_idx, attn, hidden):
+        keys, values = cache.keys[layer_idx], cache.values[layer_idx]
+        q, k, v = project_qkv(attn, hidden, position_ids, cache.max_len)
+        keys.index_copy_(2, position, k)
+        values.index_copy_(2, position, v)
+        return attend(attn, q, suffix_kv=(keys, values), suffix_mask=visible)
+
+    return manual_decode.decode_step(model, tokens, attention)
+
+
+@torch.no_grad()
+def static_generate(
+    model,
+    input_ids,
+    images=None,
+    max_new_tokens=128,
+    image_sizes=None,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    eos_token_id=None,
+    pad_token_id=None,
+    compile=False,
+    cache=None,
+):
+    """
+    Greedy or sampled generation for one unpadded prompt (`input_ids` 1 x L) with a
+    `StaticKVCache`; `compile` wraps the decode step in `torch.compile`. `cache` is a
+    preallocated cache to reuse (`StaticKVCache.allocate`), otherwise one of prompt
+    length + `max_new_tokens` positions is allocated; a prompt that does not fit in
+    `cache` falls back to `generate`. Returns the new token ids (1 x N).
+    """
+    generation_config = copy.deepcopy(model.generation_config)
+    generation_config.update(do_sample=do_sample, temperature=temperature, top_p=top_p)
+    if eos_token_id is None:
+        eos_token_id = generation_config.eos_token_id
+    if not isinstance(eos_token_id, (list, tuple)):
+        eos_token_id = [] if eos_token_id is None else [eos_token_id]
+    eos_token_ids = torch.tensor(
+        eos_token_id, dtype=torch.long, device=input_ids.device
+    )
+    warpers = model._get_logits_warper(generation_config) if do_sample else None
+
+    if images is not None:
+        _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            input_ids, None, None, None, None, images, image_sizes=image_sizes
+        )
+    else:
+        inputs_embeds = model.get_model().embed_tokens(input_ids)
+    prompt_len = inputs_embeds.shape[1]
+    if cache is not None and prompt_len + max_new_tokens > cache.max_len:
+        # the text-only generate of the LLM, on the embeddings computed above
+        output_ids = LlamaForCausalLM.generate(
+            model,
+            inputs_embeds=inputs_embeds,
+            attention_mask=torch.ones(inputs_embeds.shape[:2], device=input_ids.device),
+            generation_config=generation_config,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=eos_token_id or None,
+            pad_token_id=pad_token_id,
+        )
+        # drop the placeholder token generate puts before the output
+        return output_ids[:, 1:]
+
+    out = model(inputs_embeds=inputs_embeds, use_cache=True)
+    if cache is None:
+        cache = StaticKVCache.from_prefill(
+            out.past_key_values, prompt_len + max_new_tokens
+        )
+    else:
+        cache.load_prefill(out.past_key_values)
+
+    def step(tokens, position):
+        return decode_step(model, cache, tokens, position)
+
+    if compile:
+        step = torch.compile(step, dynamic=False)
+
+    logits = out.logits[:, -1].float()
+    generated = []
+    position = torch.tensor([prompt_len], device=input_ids.device)
+    for _ in range(max_new_tokens):
+        if do_sample:
+            probs = F.softmax(warpers(None, logits), dim=-1)
+            token = torch.multinomial(probs, 1)
+        else:
+            token = logits.argmax(dim=-1, keepdim=True)
+        generated.append(token)
+        if torch.isin(token, eos_token_ids).item() or len(generated) == max_new_tokens:
+            break
+        logits = step(token, position)
+        position += 1
+    return torch.cat(generated, dim=1)
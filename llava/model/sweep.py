@@ -0,0 +1,76 @@
+"""
+Generation of one batch under several settings (sampling, beams, lengths) from a
+single audio encoding and prefill, for the eval runner's `--sweep-*` grids.
+"""
+
+import torch
+from transformers import LlamaForCausalLM
+
+from llava.model.kv_cache_quantization import Int8KVCache
+
+
+def generate_sweep(
+    model, input_ids, attention_mask, images, configs, image_sizes, pad_token_id
+):
+    """
+    The new token ids of a left-padded batch for every setting of `configs` (dicts of
+    temperature, top_p, num_beams and max_new_tokens), encoding the audio
+    and prefilling the prompts once. The cache holds all but the last prompt
+    position; each setting's `generate` starts from a copy of it by feeding the last
+    prompt token (a text token of the template, the last column when left-padded).
+    """
+    _, _, mm_attention_mask, _, inputs_embeds, _ = (
+        model.prepare_inputs_labels_for_multimodal(
+            input_ids,
+            None,
+            attention_mask,
+            None,
+            None,
+            images,
+            image_sizes=image_sizes,
+            padding_side="left",
+        )
+    )
+    position_ids = mm_attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(mm_attention_mask == 0, 1)
+    past_key_values = model(
+        inputs_embeds=inputs_embeds[:, :-1],
+        attention_mask=mm_attention_mask[:, :-1],
+        position_ids=position_ids[:, :-1],
+        use_cache=True,
+    ).past_key_values
+
+    # the cached positions only need placeholders: generate feeds the last id
+    ids = torch.cat(
+        [
+            input_ids.new_zeros((input_ids.shape[0], inputs_embeds.shape[1] - 1)),
+            input_ids[:, -1:],
+        ],
+        dim=1,
+    )
+    output_ids = []
+    for config in configs:
+        # generate expands the ids and mask per beam but not a given cache
+        if isinstance(past_key_values, Int8KVCache):
+            cache = past_key_values.repeat_interleave(config["num_beams"])
+        else:
+            cache = tuple(
+                tuple(t.repeat_interleave(config["num_beams"], dim=0) for t in kv)
+                for kv in past_key_values
+            )
+        # the text-only generate of the LLM, LLaVA's own one would embed the ids
+        out = LlamaForCausalLM.generate(
+            model,
+            ids,
+            attention_mask=mm_attention_mask,
+            past_key_values=cache,
+            do_sample=config["temperature"] > 0,
+            temperature=config["temperature"],
+            top_p=config["top_p"],
+            num_beams=config["num_beams"],
+            max_new_tokens=config["max_new_tokens"],
+            use_cache=True,
+            pad_token_id=pad_token_id,
+        )
+        output_ids.append(out[:, ids.shape[1] :])
+    return output_ids
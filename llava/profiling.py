@@ -0,0 +1,100 @@
+import functools
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+class StepPhaseProfiler:
+    """
+    Wall time and peak CUDA memory of named phases within a sampled training step.
+    Phases may nest (e.g. `audio_encoder` within `prepare_inputs` within
+    `forward_backward`). CUDA is synchronized at phase boundaries, and only while a
+    step is sampled; otherwise every hook is a single attribute check.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.events = []
+        self._stack = []
+
+    def start_step(self):
+        self.active = True
+        self.events = []
+        self._stack = []
+
+    def end_step(self):
+        self.active = False
+        events, self.events, self._stack = self.events, [], []
+        return events
+
+    def start_phase(self, name):
+        if not self.active:
+            return
+        frame = {"name": name, "peak_memory": None}
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            if self._stack:
+                # the parent's peak so far, before it is reset for this phase
+                self._stack[-1]["peak_memory"] = max(
+                    self._stack[-1]["peak_memory"], torch.cuda.max_memory_allocated()
+                )
+            torch.cuda.reset_peak_memory_stats()
+            frame["peak_memory"] = torch.cuda.memory_allocated()
+        frame["start"] = time.perf_counter()
+        self._stack.append(frame)
+
+    def end_phase(self):
+        if not self.active or not self._stack:
+            return
+        frame = self._stack.pop()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            frame["peak_memory"] = max(
+                frame["peak_memory"], torch.cuda.max_memory_allocated()
+            )
+            if self._stack:
+                self._stack[-1]["peak_memory"] = max(
+                    self._stack[-1]["peak_memory"], frame["peak_memory"]
+                )
+        frame["end"] = time.perf_counter()
+        self.events.append(frame)
+
+    @contextmanager
+    def phase(self, name):
+        self.start_phase(name)
+        try:
+            yield
+        finally:
+            self.end_phase()
+
+    def wrap(self, name):
+        """Decorator timing every call of the function as phase `name`."""
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapped(*args, **kwargs):
+                if not self.active:
+                    return fn(*args, **kwargs)
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    def iterate(self, iterable, name):
+        """Yields from `iterable`, timing each fetch as phase `name`."""
+        iterator = iter(iterable)
+        while True:
+            self.start_phase(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.end_phase()
+            yield item
+
+
+step_profiler = StepPhaseProfiler()
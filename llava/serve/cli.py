@@ -9,6 +9,8 @@ from llava.constants import (
 )
 from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
+from llava.model.prefix_cache import PrefixKVCache, generate_with_prefix_cache
+from llava.model.static_cache import StaticKVCache, static_generate
 from llava.utils import disable_torch_init
 from llava.mm_utils import (
     process_images,
@@ -153,6 +155,8 @@ def main(args):
         is_audio_model=args.is_audio_model,
         audio_ckpt=args.audio_ckpt,
         device=args.device,
+        quantize=args.quantize,
+        kv_cache_quantization=args.kv_cache_quantization,
     )
     if "llama-2" in model_name.lower():
         conv_mode = "llava_llama_2"
@@ -192,7 +196,15 @@ def main(args):
     else:
         image_tensor = image_tensor.to(model.device, dtype=torch.float32)
 
-    model = model.to(torch.bfloat16).cuda()
+    # bf16 on GPU; on CPU the dtype the model was loaded (or quantized) in
+    dtype = model.dtype if args.device == "cpu" else torch.bfloat16
+    model = model.to(args.device, dtype=dtype)
+    # questions about the same clip share the system prompt and audio tokens
+    prefix_cache = PrefixKVCache(max_bytes=int(args.prefix_cache_gb * 2**30))
+    model_id = (args.model_path, args.model_base, args.quantize)
+    static_cache = None
+    if args.static_kv_cache is not None:
+        static_cache = StaticKVCache.allocate(model, args.static_kv_cache)
 
     while True:
         try:
@@ -219,16 +231,33 @@ def main(args):
             .to(model.device)
         )
         with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids.cuda(),
-                images=image_tensor.to(torch.bfloat16).to(model.device),
-                image_sizes=[image_size],
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                max_new_tokens=args.max_new_tokens,
-                use_cache=True,
-                pad_token_id=tokenizer.eos_token_id,
-            )
+            if static_cache is not None:
+                output_ids = static_generate(
+                    model,
+                    input_ids,
+                    image_tensor.to(model.device, dtype=dtype),
+                    max_new_tokens=args.max_new_tokens,
+                    image_sizes=[image_size],
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    pad_token_id=tokenizer.eos_token_id,
+                    compile=args.compile_decode_step,
+                    cache=static_cache,
+                )
+            else:
+                output_ids = generate_with_prefix_cache(
+                    model,
+                    input_ids,
+                    image_tensor.to(model.device, dtype=dtype),
+                    prefix_cache,
+                    model_id,
+                    image_sizes=[image_size],
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    max_new_tokens=args.max_new_tokens,
+                    use_cache=True,
+                    pad_token_id=tokenizer.eos_token_id,
+                )
         outputs = tokenizer.decode(output_ids[0], skip_special_tokens=True).strip()
         # print("before", outputs)
         outputs = invoke_tools(function_registry, outputs)
@@ -259,6 +288,39 @@ if __name__ == "__main__":
     )
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8", "int4"],
+        help="Weight-only quantization, for --device cpu.",
+    )
+    parser.add_argument(
+        "--kv-cache-quantization",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="Keep the KV cache in int8 during generation.",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=4,
+        help="Memory for the KV cache of prompt prefixes (system prompt + audio).",
+    )
+    parser.add_argument(
+        "--static-kv-cache",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Decode into a preallocated KV cache of N positions instead of using the "
+        "prefix cache; longer prompts fall back to generate.",
+    )
+    parser.add_argument(
+        "--compile-decode-step",
+        action="store_true",
+        help="torch.compile the decode step of --static-kv-cache.",
+    )
     parser.add_argument("--debug", action="store_true")
     args = parser.parse_args()
     main(args)
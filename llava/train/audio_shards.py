@@ -0,0 +1,192 @@
+"""
+Tar shards of audio + instruction pairs, read sequentially instead of one random
+`torchaudio.load` per sample (slow on network filesystems).
+
+Every sample is stored as consecutive tar members sharing a key:
+    {key}.json    the training entry (instruction, output, local_audio_path, ...)
+    {key}.audio   raw bytes of the audio file, or
+    {key}.npy     fbank precomputed with `AudioPreprocessor._wav2fbank` (the entry
+                  then records the frames before padding as `num_frames`)
+An index (shards.json) next to the shards lists them with their number of samples.
+
+Packing a training json:
+    python llava/train/audio_shards.py \
+        --data_path MusicInstruct_long_eval.json \
+        --output_dir shards/ \
+        --samples_per_shard 1000 \
+        [--precompute_fbank --audio_input_target_length 3072]
+"""
+
+import argparse
+import io
+import json
+import os
+import tarfile
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+SHARD_INDEX_NAME = "shards.json"
+
+
+def _add_tar_member(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(payload))
+
+
+class AudioShardWriter:
+    """Writes samples to `shard-XXXXXX.tar` files and the shard index on close."""
+
+    def __init__(
+        self, output_dir, samples_per_shard=1000, audio_input_target_length=None
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.samples_per_shard = samples_per_shard
+        # only set when fbanks are precomputed; checked against the audio tower at load
+        self.audio_input_target_length = audio_input_target_length
+        self.shards = []
+        self._tar = None
+        self._key = 0
+
+    def _open_next_shard(self):
+        self._close_shard()
+        name = f"shard-{len(self.shards):06d}.tar"
+        self._tar = tarfile.open(os.path.join(self.output_dir, name), "w")
+        self.shards.append({"path": name, "num_samples": 0})
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def write(self, sample, audio_bytes=None, fbank=None):
+        assert (audio_bytes is None) != (fbank is None), "Need audio bytes or fbank."
+        if (
+            self._tar is None
+            or self.shards[-1]["num_samples"] == self.samples_per_shard
+        ):
+            self._open_next_shard()
+
+        key = f"{self._key:09d}"
+        _add_tar_member(self._tar, f"{key}.json", json.dumps(sample).encode("utf-8"))
+        if audio_bytes is not None:
+            _add_tar_member(self._tar, f"{key}.audio", audio_bytes)
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, np.asarray(fbank, dtype=np.float32))
+            _add_tar_member(self._tar, f"{key}.npy", buffer.getvalue())
+        self.shards[-1]["num_samples"] += 1
+        self._key += 1
+
+    def close(self):
+        self._close_shard()
+        index = {
+            "audio_input_target_length": self.audio_input_target_length,
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.output_dir, SHARD_INDEX_NAME), "w") as fout:
+            json.dump(index, fout, indent=2)
+
+
+def load_shard_index(data_path):
+    """`data_path` is a shard directory or its shards.json; returns the parsed index
+    with absolute shard paths."""
+    if os.path.isdir(data_path):
+        data_path = os.path.join(data_path, SHARD_INDEX_NAME)
+    with open(data_path, "r") as fin:
+        index = json.load(fin)
+    shard_dir = os.path.dirname(os.path.abspath(data_path))
+    for shard in index["shards"]:
+        shard["path"] = os.path.join(shard_dir, shard["path"])
+    return index
+
+
+def iterate_shard(path):
+    """Yields `(sample, audio_bytes, fbank)` in storage order, streaming the tar."""
+    sample, audio_bytes, fbank, cur_key = None, None, None, None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = member.name.split(".", 1)
+            if cur_key is not None and key != cur_key:
+                yield sample, audio_bytes, fbank
+                sample, audio_bytes, fbank = None, None, None
+            cur_key = key
+            payload = tar.extractfile(member).read()
+            if ext == "json":
+                sample = json.loads(payload.decode("utf-8"))
+            elif ext == "audio":
+                audio_bytes = payload
+            elif ext == "npy":
+                fbank = np.load(io.BytesIO(payload))
+    if cur_key is not None:
+        yield sample, audio_bytes, fbank
+
+
+def pack_audio_shards(
+    list_data_dict, output_dir, samples_per_shard=1000, preprocessor=None
+):
+    """Packs training entries into shards; with `preprocessor` (an `AudioPreprocessor`)
+    fbanks are stored instead of the audio bytes."""
+    writer = AudioShardWriter(
+        output_dir,
+        samples_per_shard=samples_per_shard,
+        audio_input_target_length=(
+            preprocessor.target_length if preprocessor is not None else None
+        ),
+    )
+    num_failed = 0
+    for sample in tqdm(list_data_dict):
+        try:
+            if preprocessor is not None:
+                fbank, num_frames = preprocessor._wav2fbank(sample["local_audio_path"])
+                writer.write(dict(sample, num_frames=num_frames), fbank=fbank.numpy())
+            else:
+                with open(sample["local_audio_path"], "rb") as fin:
+                    writer.write(sample, audio_bytes=fin.read())
+        except Exception as e:
+            num_failed += 1
+            print(f"Failed to pack {sample.get('local_audio_path')}: {e}")
+    writer.close()
+    print(
+        f"Packed {len(list_data_dict) - num_failed} samples into "
+        f"{len(writer.shards)} shards ({num_failed} failed)."
+    )
+    return writer.shards
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    parser.add_argument("--precompute_fbank", action="store_true")
+    parser.add_argument("--audio_input_target_length", type=int, default=3072)
+    args = parser.parse_args()
+
+    with open(args.data_path, "r") as fin:
+        list_data_dict = json.load(fin)
+
+    preprocessor = None
+    if args.precompute_fbank:
+        from llava.model.multimodal_encoder.audiomae_encoder import (
+            AUDIO_CONF,
+            AudioPreprocessor,
+        )
+
+        preprocessor = AudioPreprocessor(
+            freqm=AUDIO_CONF["ft_freqm"],
+            timem=AUDIO_CONF["ft_timem"],
+            target_length=args.audio_input_target_length,
+        )
+    pack_audio_shards(
+        list_data_dict,
+        args.output_dir,
+        samples_per_shard=args.samples_per_shard,
+        preprocessor=preprocessor,
+    )
@@ -0,0 +1,118 @@
+"""
+Background checkpoint writes, so `save_steps` does not stall training.
+
+The training thread only snapshots the tensors (asynchronous device-to-host copies
+into pinned memory); serialization and disk I/O run on a single writer thread, so
+files land in the order they were saved. Each file is written next to its final path
+and renamed into place once complete. The format follows the file name: `.safetensors`
+files are written with safetensors, anything else with `torch.save`, so existing files
+such as `mm_projector.bin` or `non_lora_trainables.bin` keep their layout.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors.torch import save_file
+
+
+def snapshot_state_dict(named_tensors, keep=True):
+    """
+    Copies `(name, tensor)` pairs to CPU. CUDA tensors go to pinned memory without
+    blocking; returns the snapshot and a CUDA event marking the end of the copies
+    (None if there were none). ZeRO-3 partitioned parameters are gathered and copied
+    synchronously since the gathered storage is released right after; gathering is
+    collective, so ranks that do not write still call this with `keep=False`.
+    """
+    snapshot = {}
+    has_cuda_copies = False
+    for name, tensor in named_tensors:
+        if hasattr(tensor, "ds_id"):
+            from deepspeed import zero
+
+            with zero.GatheredParameters([tensor]):
+                if keep:
+                    snapshot[name] = tensor.data.detach().cpu().clone()
+        elif not keep:
+            continue
+        elif tensor.is_cuda:
+            snapshot[name] = torch.empty(
+                tensor.shape, dtype=tensor.dtype, pin_memory=True
+            )
+            snapshot[name].copy_(tensor.detach(), non_blocking=True)
+            has_cuda_copies = True
+        else:
+            snapshot[name] = tensor.detach().clone()
+
+    copy_done = None
+    if has_cuda_copies:
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+    return snapshot, copy_done
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes state dicts on a worker thread, with at most `max_in_flight` saves pending;
+    a save beyond that waits for the oldest one. With `asynchronous=False` files are
+    written on the calling thread (same files, same atomic rename).
+    """
+
+    def __init__(self, max_in_flight=2, asynchronous=True):
+        self.max_in_flight = max_in_flight
+        self.asynchronous = asynchronous
+        self._executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        self._in_flight = deque()
+
+    def save(self, named_tensors, path, write=True):
+        """
+        Snapshots `named_tensors` (a state dict or `(name, tensor)` pairs) and writes
+        them to `path`. Returns once the snapshot is taken. Call it on every rank,
+        with `write` set on the one that saves.
+        """
+        if isinstance(named_tensors, dict):
+            named_tensors = named_tensors.items()
+        if not write:
+            snapshot_state_dict(named_tensors, keep=False)
+            return
+
+        start = time.perf_counter()
+        while len(self._in_flight) >= self.max_in_flight:
+            self._in_flight.popleft().result()
+        snapshot, copy_done = snapshot_state_dict(named_tensors)
+        blocked = time.perf_counter() - start
+
+        if not self.asynchronous:
+            self._write(snapshot, copy_done, path, blocked)
+            return
+        self._in_flight.append(
+            self._executor.submit(self._write, snapshot, copy_done, path, blocked)
+        )
+
+    def _write(self, snapshot, copy_done, path, blocked):
+        start = time.perf_counter()
+        if copy_done is not None:
+            copy_done.synchronize()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        if path.endswith(".safetensors"):
+            save_file(snapshot, tmp_path, metadata={"format": "pt"})
+        else:
+            torch.save(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+        print(
+            f"=> Saved {path}: training blocked {blocked:.2f}s, "
+            f"written in {time.perf_counter() - start:.2f}s"
+        )
+
+    def wait(self):
+        """Blocks until every pending save is on disk; re-raises write errors."""
+        while self._in_flight:
+            self._in_flight.popleft().result()
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
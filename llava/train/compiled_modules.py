@@ -0,0 +1,61 @@
+"""
+`torch.compile` for the multimodal modules (audio tower and projector).
+
+Only the module's `forward` is replaced, so parameter names, state dicts and the
+checkpoints written from them are unchanged. Graphs are compiled with static shapes:
+the first call fixes the per-sample input shape (e.g. 1 x 3072 x 128 frames for the
+audio tower), later calls with a different per-sample shape run eagerly instead of
+recompiling, and a new batch size compiles a new graph (up to dynamo's
+`cache_size_limit`, after which dynamo itself runs the frame eagerly). If compiling
+fails, the module prints why and stays eager for the rest of the run.
+"""
+
+import torch
+
+
+class CompiledForward:
+    """Compiled replacement of `module.forward`, falling back to the eager one."""
+
+    def __init__(self, module, name, **compile_kwargs):
+        self.name = name
+        self.eager_forward = module.forward
+        self.compiled_forward = torch.compile(
+            module.forward, dynamic=False, **compile_kwargs
+        )
+        self.sample_shape = None
+        self.failed = False
+
+    def __call__(self, x, *args, **kwargs):
+        if self.failed or not torch.is_tensor(x):
+            return self.eager_forward(x, *args, **kwargs)
+        if self.sample_shape is None:
+            self.sample_shape = x.shape[1:]
+        if x.shape[1:] != self.sample_shape:
+            return self.eager_forward(x, *args, **kwargs)
+        try:
+            return self.compiled_forward(x, *args, **kwargs)
+        except torch.cuda.OutOfMemoryError:
+            raise
+        except Exception as e:
+            print(f"=> torch.compile failed for {self.name}, running it eagerly: {e}")
+            self.failed = True
+            return self.eager_forward(x, *args, **kwargs)
+
+
+def compile_forward(module, name, **compile_kwargs):
+    if not hasattr(torch, "compile"):
+        print(f"=> torch {torch.__version__} has no torch.compile; {name} stays eager.")
+        return module
+    if not isinstance(module.forward, CompiledForward):
+        module.forward = CompiledForward(module, name, **compile_kwargs)
+    return module
+
+
+def compile_mm_modules(model, **compile_kwargs):
+    """Compiles the audio tower and the projector of a LLaVA model (or PeftModel)."""
+    vision_tower = model.get_vision_tower()
+    if vision_tower is not None:
+        compile_forward(vision_tower, "audio tower", **compile_kwargs)
+    mm_projector = getattr(model.get_model(), "mm_projector", None)
+    if mm_projector is not None:
+        compile_forward(mm_projector, "mm_projector", **compile_kwargs)
@@ -1,10 +1,10 @@
 import json
 import transformers
 import torch
-import copy, os
+import copy, io, itertools, os
 from typing import Dict, Optional, Sequence, List
 from llava import conversation as conversation_lib
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from PIL import Image
 from dataclasses import dataclass, field
 from llava.constants import (
@@ -15,6 +15,7 @@ from llava.constants import (
     DEFAULT_IM_END_TOKEN,
 )
 from llava.mm_utils import tokenizer_image_token
+from llava.train.audio_shards import iterate_shard, load_shard_index
 import tokenizers
 from packaging import version
 import random
@@ -37,6 +38,20 @@ class DataArguments:
     image_aspect_ratio: str = "square"
     ###### added for new modality
     audio_folder: Optional[str] = field(default=None)
+    data_format: str = field(
+        default="json",
+        metadata={
+            "help": "`json` for a json list, `shards` for a directory of audio shards "
+            "packed with llava/train/audio_shards.py."
+        },
+    )
+    shuffle_buffer_size: int = field(default=256)
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Round padded batch lengths up, e.g. for token-budget batches."
+        },
+    )
 
 
 def _tokenize_fn(
@@ -571,6 +586,32 @@ class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
 
     tokenizer: transformers.PreTrainedTokenizer
+    pad_to_multiple_of: Optional[int] = None
+    # tokens spliced in per <image> by the model, for `batch_stats`
+    num_audio_tokens: int = 0
+
+    def batch_stats(self, instances, input_ids, attention_mask):
+        """
+        Token counts of the batch as the LLM sees it, i.e. after the model replaces each
+        <image> with `num_audio_tokens` features and pads to the longest sample. Plain
+        numbers, so they stay on the host; the trainer pops them before the forward.
+        """
+        num_images = (input_ids == IMAGE_TOKEN_INDEX).sum(dim=1)
+        text_lengths = attention_mask.sum(dim=1) - num_images
+        audio_lengths = num_images * self.num_audio_tokens
+        lengths = (text_lengths + audio_lengths).clamp(
+            max=self.tokenizer.model_max_length
+        )
+        audio_lengths = torch.minimum(audio_lengths, lengths)
+        return dict(
+            samples=len(instances),
+            text_tokens=int((lengths - audio_lengths).sum()),
+            audio_tokens=int(audio_lengths.sum()),
+            padded_tokens=int(lengths.max() * len(lengths) - lengths.sum()),
+            audio_seconds=sum(
+                instance.get("audio_seconds", 0.0) for instance in instances
+            ),
+        )
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
         input_ids, labels = tuple(
@@ -582,6 +623,15 @@ class DataCollatorForSupervisedDataset(object):
         labels = torch.nn.utils.rnn.pad_sequence(
             labels, batch_first=True, padding_value=IGNORE_INDEX
         )
+        if self.pad_to_multiple_of is not None:
+            # fewer distinct shapes when batch sizes and lengths vary from step to step
+            num_padding = -input_ids.shape[1] % self.pad_to_multiple_of
+            input_ids = torch.nn.functional.pad(
+                input_ids, (0, num_padding), value=self.tokenizer.pad_token_id
+            )
+            labels = torch.nn.functional.pad(
+                labels, (0, num_padding), value=IGNORE_INDEX
+            )
         input_ids = input_ids[:, : self.tokenizer.model_max_length]
         labels = labels[:, : self.tokenizer.model_max_length]
         batch = dict(
@@ -589,9 +639,22 @@ class DataCollatorForSupervisedDataset(object):
             labels=labels,
             attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
         )
+        batch["batch_stats"] = self.batch_stats(
+            instances, input_ids, batch["attention_mask"]
+        )
 
         if "image" in instances[0]:
             images = [instance["image"] for instance in instances]
+            audio_ids = [instance.get("audio_id") for instance in instances]
+            if None not in audio_ids and len(set(audio_ids)) < len(audio_ids):
+                # collate each clip once; the model fans its features back out
+                unique_ids = {}
+                image_index = [
+                    unique_ids.setdefault(audio_id, len(unique_ids))
+                    for audio_id in audio_ids
+                ]
+                images = [images[audio_ids.index(audio_id)] for audio_id in unique_ids]
+                batch["image_index"] = torch.tensor(image_index)
             if all(x is not None and x.shape == images[0].shape for x in images):
                 batch["images"] = torch.stack(images)
             else:
@@ -677,6 +740,38 @@ class LazySupervisedDataset(Dataset):
             length_list.append(cur_len)
         return length_list
 
+    def _text_sources(self, sample):
+        """The conversation `__getitem__` tokenizes for `sample`, and has_image."""
+        has_image = "image" in sample
+        sources = copy.deepcopy([sample["conversations"]])
+        if has_image:
+            sources = preprocess_multimodal(sources, self.data_args)
+        return sources, has_image
+
+    @property
+    def token_lengths(self):
+        """
+        Tokens the LLM sees per sample: the tokenized conversation (template and
+        system prompt included) with each <image> replaced by `num_audio_tokens`,
+        truncated to model_max_length. Used for token-budget batching; keeps the < 0
+        convention of `modality_lengths` for text-only samples. Tokenizes the whole
+        dataset on first access, then cached.
+        """
+        if getattr(self, "_token_lengths", None) is None:
+            num_audio_tokens = getattr(self.data_args, "num_audio_tokens", 0)
+            signs = [1 if cur_len > 0 else -1 for cur_len in self.modality_lengths]
+            lengths = []
+            for sample, sign in zip(self.list_data_dict, signs):
+                sources, has_image = self._text_sources(sample)
+                input_ids = preprocess(sources, self.tokenizer, has_image=has_image)[
+                    "input_ids"
+                ][0]
+                num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+                cur_len = len(input_ids) + num_images * (num_audio_tokens - 1)
+                lengths.append(sign * min(cur_len, self.tokenizer.model_max_length))
+            self._token_lengths = lengths
+        return self._token_lengths
+
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         """
         {
@@ -761,74 +856,237 @@ class LazySupervisedDataset(Dataset):
         return data_dict
 
 
+def audio_instruction_conversations(source: Dict) -> List[Dict]:
+    return [
+        {
+            "from": "human",
+            "value": f"{source['instruction']}\n<image>",
+        },
+        {
+            "from": "gpt",
+            "value": f"{source['output']}",
+        },
+    ]
+
+
+def preprocess_audio_instruction(
+    source: Dict,
+    spec: torch.Tensor,
+    tokenizer: transformers.PreTrainedTokenizer,
+    data_args: DataArguments,
+    audio_seconds: float = 0.0,
+) -> Dict:
+    """
+    Tokenize an {"instruction", "output"} entry; `spec` is its processed audio
+    (torch.tensor 1 x 3072 x 128) holding `audio_seconds` of audio.
+    """
+    conversations = audio_instruction_conversations(source)
+    sources = preprocess_multimodal([conversations], data_args)
+    # just play with the texts
+    data_dict = preprocess(sources, tokenizer, has_image=True)
+    return dict(
+        input_ids=data_dict["input_ids"][0],
+        labels=data_dict["labels"][0],
+        image=spec,
+        audio_id=source["local_audio_path"],
+        audio_seconds=audio_seconds,
+    )
+
+
 class AudioLazySupervisedDataset(LazySupervisedDataset):
+    # (local_audio_path, spec, seconds) of the last decoded clip: entries sharing a
+    # clip are fetched back to back when grouped by audio
+    _cached_spec = None
+
+    @property
+    def audio_ids(self):
+        return [sample.get("local_audio_path") for sample in self.list_data_dict]
+
+    def _text_sources(self, sample):
+        sources = [audio_instruction_conversations(sample)]
+        return preprocess_multimodal(sources, self.data_args), True
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         sources = self.list_data_dict[i]
-        sources["conversations"] = [
-            {
-                "from": "human",
-                "value": f"{sources['instruction']}\n<image>",
-            },
-            {
-                "from": "gpt",
-                "value": f"{sources['output']}",
-            },
-        ]
-        sources = [sources]
-        assert "local_audio_path" in sources[0]
+        assert "local_audio_path" in sources
         processor = self.data_args.image_processor  # audio_tower.audio_processor
+        if (
+            self._cached_spec is not None
+            and self._cached_spec[0] == sources["local_audio_path"]
+        ):
+            _, spec, audio_seconds = self._cached_spec
+            return preprocess_audio_instruction(
+                sources, spec, self.tokenizer, self.data_args, audio_seconds
+            )
         # spec: torch.tensor 1 x 3072 x 128
         try:
-            spec = processor.preprocess(sources[0])
+            spec, audio_seconds = processor.preprocess(sources, return_duration=True)
         except Exception as e:
             pickone = random.randint(0, len(self.list_data_dict) - 1)
             print(
-                f"Audio Processor failed to handle {sources[0]['local_audio_path']}."
+                f"Audio Processor failed to handle {sources['local_audio_path']}."
                 f"Using {self.list_data_dict[pickone]['local_audio_path']} now.\n"
                 f"{e}"
             )
             return self.__getitem__(pickone)
-        sources = preprocess_multimodal(
-            copy.deepcopy([e["conversations"] for e in sources]), self.data_args
+        self._cached_spec = (sources["local_audio_path"], spec, audio_seconds)
+        return preprocess_audio_instruction(
+            sources, spec, self.tokenizer, self.data_args, audio_seconds
         )
-        # just play with the texts
-        data_dict = preprocess(
-            sources,
-            self.tokenizer,
-            has_image=(
-                "image" in self.list_data_dict[i]
-                or "audio_id" in self.list_data_dict[i]
-                or "local_audio_id" in self.list_data_dict[i]
-                or "local_audio_path" in self.list_data_dict[i]
-                or "audio_filename_idx" in self.list_data_dict[i]
-            ),
-        )
-        if isinstance(i, int):
-            data_dict = dict(
-                input_ids=data_dict["input_ids"][0], labels=data_dict["labels"][0]
-            )
-        # print(image.shape) # 3 x 336 x 336
+
+
+def _get_rank_and_world_size():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class AudioShardSupervisedDataset(IterableDataset):
+    """
+    Streams the tar shards written by `llava/train/audio_shards.py` sequentially.
+
+    Shards are shuffled every epoch and dealt out to ranks, then to dataloader workers;
+    records go through a shuffle buffer before being decoded. Each rank yields exactly
+    `len(self)` samples, cycling over its shards if needed, so all ranks run the same
+    number of steps.
+    """
+
+    def __init__(
+        self,
+        data_path: str,
+        tokenizer: transformers.PreTrainedTokenizer,
+        data_args: DataArguments,
+        shuffle_buffer_size: int = 256,
+        seed: int = 0,
+    ):
+        super(AudioShardSupervisedDataset, self).__init__()
+        index = load_shard_index(data_path)
+        target_length = index.get("audio_input_target_length")
         if (
-            "image" in self.list_data_dict[i]
-            or "audio_id" in self.list_data_dict[i]
-            or "local_audio_id" in self.list_data_dict[i]
-            or "local_audio_path" in self.list_data_dict[i]
-            or "audio_filename_idx" in self.list_data_dict[i]
+            target_length is not None
+            and target_length != data_args.image_processor.target_length
         ):
-            data_dict["image"] = spec
-        elif self.data_args.is_multimodal:
             raise ValueError(
-                f"You are not providing image data, while training with vision tower."
+                f"Shards hold fbanks of {target_length} frames, the audio tower "
+                f"expects {data_args.image_processor.target_length}."
             )
-        return data_dict
+        self.shards = index["shards"]
+        self.num_samples = sum(shard["num_samples"] for shard in self.shards)
+        self.tokenizer = tokenizer
+        self.data_args = data_args
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self._resume_position = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip_batches(self, num_batches, batch_size):
+        """
+        Skips the first `num_batches` batches this rank draws in the current epoch.
+        Skipped records are still read from the shards but never decoded.
+        """
+        self._resume_position = (self.epoch, num_batches, batch_size)
+
+    def __len__(self):
+        _, world_size = _get_rank_and_world_size()
+        return self.num_samples // world_size
+
+    def _shuffle_records(self, shards, rng):
+        buffer = []
+        for shard in shards:
+            for record in iterate_shard(shard["path"]):
+                if len(buffer) < self.shuffle_buffer_size:
+                    buffer.append(record)
+                    continue
+                idx = rng.randrange(len(buffer))
+                yield buffer[idx]
+                buffer[idx] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _cycle_records(self, shards, rng):
+        # every record is seen once before any is repeated
+        while True:
+            yield from self._shuffle_records(shards, rng)
+
+    def _decode_records(self, records):
+        processor = self.data_args.image_processor  # audio_tower.audio_processor
+        for sample, audio_bytes, fbank in records:
+            if fbank is not None:
+                datum = {"fbank": fbank}
+                if "num_frames" in sample:
+                    datum["num_frames"] = sample["num_frames"]
+            else:
+                datum = {"local_audio_path": io.BytesIO(audio_bytes)}
+            try:
+                spec, audio_seconds = processor.preprocess(datum, return_duration=True)
+            except Exception as e:
+                # skipped; the stream is endless so the per-rank count is unaffected
+                print(
+                    f"Audio Processor failed to handle {sample['local_audio_path']}."
+                    f"Skipping it.\n{e}"
+                )
+                continue
+            yield preprocess_audio_instruction(
+                sample, spec, self.tokenizer, self.data_args, audio_seconds
+            )
+
+    def __iter__(self):
+        rank, world_size = _get_rank_and_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        if len(self.shards) < world_size * num_workers:
+            raise ValueError(
+                f"{len(self.shards)} shards cannot feed {world_size} ranks x "
+                f"{num_workers} dataloader workers; pack smaller shards."
+            )
+
+        num_skipped_batches, batch_size = 0, 0
+        if self._resume_position is not None and self._resume_position[0] == self.epoch:
+            _, num_skipped_batches, batch_size = self._resume_position
+            # the dataloader takes whole batches from its workers in turn, starting with
+            # worker 0: hand worker 0 the role of the worker that owns the next batch
+            worker_id = (worker_id + num_skipped_batches) % num_workers
+
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        shards = shards[rank::world_size][worker_id::num_workers]
+        # this rank's samples are split evenly over its workers
+        num_samples = len(self) // num_workers + int(
+            worker_id < len(self) % num_workers
+        )
+        rng = random.Random(f"{self.seed}-{self.epoch}-{rank}-{worker_id}")
+
+        records = self._cycle_records(shards, rng)
+        if num_skipped_batches > 0:
+            num_skipped = batch_size * (
+                num_skipped_batches // num_workers
+                + int(worker_id < num_skipped_batches % num_workers)
+            )
+            num_skipped = min(num_skipped, num_samples)
+            records = itertools.islice(records, num_skipped, None)
+            num_samples -= num_skipped
+        yield from itertools.islice(self._decode_records(records), num_samples)
 
 
 def make_supervised_data_module(
     tokenizer: transformers.PreTrainedTokenizer, data_args
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
-    if data_args.is_audio_exp:
+    if data_args.is_audio_exp and data_args.data_format == "shards":
+        train_dataset = AudioShardSupervisedDataset(
+            tokenizer=tokenizer,
+            data_path=data_args.data_path,
+            data_args=data_args,
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+            seed=getattr(data_args, "seed", 0),
+        )
+    elif data_args.is_audio_exp:
         train_dataset = AudioLazySupervisedDataset(
             tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args
         )
@@ -836,7 +1094,11 @@ def make_supervised_data_module(
         train_dataset = LazySupervisedDataset(
             tokenizer=tokenizer, data_path=data_args.data_path, data_args=data_args
         )
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+    data_collator = DataCollatorForSupervisedDataset(
+        tokenizer=tokenizer,
+        pad_to_multiple_of=data_args.pad_to_multiple_of,
+        num_audio_tokens=getattr(data_args, "num_audio_tokens", 0),
+    )
     return dict(
         train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator
     )
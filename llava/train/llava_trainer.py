@@ -1,10 +1,17 @@
 import os
 import torch
 import torch.nn as nn
+import numpy as np
 
-from torch.utils.data import Sampler
+from torch.utils.data import DataLoader, IterableDataset, Sampler
 
 from transformers import Trainer
+from llava.model.activation_checkpointing import (
+    apply_audio_tower_checkpointing,
+    apply_llm_checkpointing,
+)
+from llava.train.checkpoint_writer import AsyncCheckpointWriter
+from llava.profiling import step_profiler
 from transformers.trainer import (
     is_sagemaker_mp_enabled,
     get_parameter_names,
@@ -20,7 +27,7 @@ from typing import List, Optional
 # import transformers.integrations.tpu.tpu_spmd_dataloader as tpu_spmd_dataloader
 from accelerate import __version__ as accelerate_version
 from accelerate import skip_first_batches
-from accelerate.data_loader import SeedableRandomSampler
+from accelerate.data_loader import SeedableRandomSampler, prepare_data_loader
 from accelerate.utils import DistributedType
 from torch.utils.data import RandomSampler
 from transformers.debug_utils import DebugOption, DebugUnderflowOverflow
@@ -37,12 +44,14 @@ from transformers.utils.import_utils import (
     is_accelerate_available,
     is_sagemaker_mp_enabled,
 )
-from transformers.trainer_utils import speed_metrics, TrainOutput
+from transformers.trainer_utils import speed_metrics, TrainOutput, seed_worker
 from transformers.trainer_callback import TrainerState
 from transformers.trainer_utils import HPSearchBackend
 from peft import PeftModel
 from packaging import version
+import heapq
 import importlib
+import json
 import math
 import sys
 import time
@@ -52,6 +61,7 @@ import shutil
 import subprocess
 
 TRAINER_STATE_NAME = "trainer_state.json"
+TRAINER_DATA_STATE_NAME = "data_state.json"
 
 if is_apex_available():
     from apex import amp
@@ -132,85 +142,109 @@ def split_to_even_chunks(indices, lengths, num_chunks):
     num_indices_per_chunk = len(indices) // num_chunks
 
     chunks = [[] for _ in range(num_chunks)]
-    chunks_lengths = [0 for _ in range(num_chunks)]
+    # (chunk length, chunk id): the shortest chunk, lowest id first; full chunks leave
+    heap = [(0, i) for i in range(num_chunks)]
     for index in indices:
-        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunk_length, shortest_chunk = heap[0]
         chunks[shortest_chunk].append(index)
-        chunks_lengths[shortest_chunk] += lengths[index]
         if len(chunks[shortest_chunk]) == num_indices_per_chunk:
-            chunks_lengths[shortest_chunk] = float("inf")
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (chunk_length + lengths[index], shortest_chunk))
 
     return chunks
 
 
+def split_megabatches_to_even_chunks(megabatches, megabatch_lengths, num_chunks):
+    """
+    `split_to_even_chunks` for every row of `megabatches` (num_megabatches x
+    megabatch_size) at once; returns the rows with each chunk laid out contiguously.
+    """
+    num_megabatches, megabatch_size = megabatches.shape
+    num_indices_per_chunk = megabatch_size // num_chunks
+    rows = np.arange(num_megabatches)
+
+    chunks_lengths = np.zeros((num_megabatches, num_chunks), dtype=np.float64)
+    chunks_sizes = np.zeros((num_megabatches, num_chunks), dtype=np.int64)
+    assignment = np.empty((num_megabatches, megabatch_size), dtype=np.int64)
+    for j in range(megabatch_size):
+        # argmin picks the lowest chunk id among ties, like `list.index(min(...))`
+        shortest_chunk = chunks_lengths.argmin(axis=1)
+        assignment[:, j] = shortest_chunk
+        chunks_lengths[rows, shortest_chunk] += megabatch_lengths[:, j]
+        chunks_sizes[rows, shortest_chunk] += 1
+        is_full = chunks_sizes[rows, shortest_chunk] == num_indices_per_chunk
+        chunks_lengths[rows[is_full], shortest_chunk[is_full]] = np.inf
+
+    order = np.argsort(assignment, axis=1, kind="stable")
+    return np.take_along_axis(megabatches, order, axis=1)
+
+
 def get_modality_length_grouped_indices(
     lengths, batch_size, world_size, generator=None
 ):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    assert all(l != 0 for l in lengths), "Should not have zero length."
-    if all(l > 0 for l in lengths) or all(l < 0 for l in lengths):
+    lengths = np.asarray(lengths)
+    assert np.all(lengths != 0), "Should not have zero length."
+    if np.all(lengths > 0) or np.all(lengths < 0):
         # all samples are in the same modality
         return get_length_grouped_indices(
             lengths, batch_size, world_size, generator=generator
         )
-    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
-    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    mm_indices = np.flatnonzero(lengths > 0)
+    lang_indices = np.flatnonzero(lengths < 0)
 
-    mm_shuffle = [
-        mm_indices[i]
-        for i in get_length_grouped_indices(
-            mm_lengths, batch_size, world_size, generator=None
+    mm_shuffle = mm_indices[
+        get_length_grouped_indices(
+            lengths[mm_indices], batch_size, world_size, generator=None
         )
     ]
-    lang_shuffle = [
-        lang_indices[i]
-        for i in get_length_grouped_indices(
-            lang_lengths, batch_size, world_size, generator=None
+    lang_shuffle = lang_indices[
+        get_length_grouped_indices(
+            -lengths[lang_indices], batch_size, world_size, generator=None
         )
     ]
     megabatch_size = world_size * batch_size
-    mm_megabatches = [
-        mm_shuffle[i : i + megabatch_size]
-        for i in range(0, len(mm_shuffle), megabatch_size)
-    ]
-    lang_megabatches = [
-        lang_shuffle[i : i + megabatch_size]
-        for i in range(0, len(lang_shuffle), megabatch_size)
-    ]
+    # all megabatches but the last of each modality are full
+    num_mm_full = (len(mm_shuffle) - 1) // megabatch_size * megabatch_size
+    num_lang_full = (len(lang_shuffle) - 1) // megabatch_size * megabatch_size
 
-    last_mm = mm_megabatches[-1]
-    last_lang = lang_megabatches[-1]
-    additional_batch = last_mm + last_lang
-    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    additional_batch = np.concatenate(
+        [mm_shuffle[num_mm_full:], lang_shuffle[num_lang_full:]]
+    )
+    megabatches = np.concatenate(
+        [mm_shuffle[:num_mm_full], lang_shuffle[:num_lang_full]]
+    ).reshape(-1, megabatch_size)
     megabatch_indices = torch.randperm(len(megabatches), generator=generator)
-    megabatches = [megabatches[i] for i in megabatch_indices]
-
-    if len(additional_batch) > 0:
-        megabatches.append(sorted(additional_batch))
+    megabatches = megabatches[megabatch_indices.numpy()]
 
-    return [i for megabatch in megabatches for i in megabatch]
+    return np.concatenate([megabatches.ravel(), np.sort(additional_batch)]).tolist()
 
 
 def get_length_grouped_indices(
     lengths, batch_size, world_size, generator=None, merge=True
 ):
     # We need to use torch for the random part as a distributed sampler will set the random seed for torch.
-    indices = torch.randperm(len(lengths), generator=generator)
+    lengths = np.asarray(lengths)
+    indices = torch.randperm(len(lengths), generator=generator).numpy()
     megabatch_size = world_size * batch_size
-    megabatches = [
-        indices[i : i + megabatch_size].tolist()
-        for i in range(0, len(lengths), megabatch_size)
-    ]
-    megabatches = [
-        sorted(megabatch, key=lambda i: lengths[i], reverse=True)
-        for megabatch in megabatches
-    ]
-    megabatches = [
-        split_to_even_chunks(megabatch, lengths, world_size)
-        for megabatch in megabatches
-    ]
+    num_full = len(indices) // megabatch_size * megabatch_size
+
+    # full megabatches, one per row: sort each by length (stable, longest first)
+    megabatches = indices[:num_full].reshape(-1, megabatch_size)
+    order = np.argsort(-lengths[megabatches], axis=1, kind="stable")
+    megabatches = np.take_along_axis(megabatches, order, axis=1)
+    megabatches = split_megabatches_to_even_chunks(
+        megabatches, lengths[megabatches], world_size
+    )
+
+    last_megabatch = indices[num_full:]
+    last_megabatch = last_megabatch[
+        np.argsort(-lengths[last_megabatch], kind="stable")
+    ].tolist()
+    last_chunks = split_to_even_chunks(last_megabatch, lengths.tolist(), world_size)
 
-    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+    return megabatches.ravel().tolist() + [i for chunk in last_chunks for i in chunk]
 
 
 class LengthGroupedSampler(Sampler):
@@ -226,6 +260,7 @@ class LengthGroupedSampler(Sampler):
         lengths: Optional[List[int]] = None,
         generator=None,
         group_by_modality: bool = False,
+        seed: int = 0,
     ):
         if lengths is None:
             raise ValueError("Lengths must be provided.")
@@ -235,24 +270,319 @@ class LengthGroupedSampler(Sampler):
         self.lengths = lengths
         self.generator = generator
         self.group_by_modality = group_by_modality
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def __len__(self):
         return len(self.lengths)
 
     def __iter__(self):
+        generator = self.generator
+        if generator is None:
+            # the order only depends on (seed, epoch), so a resumed run can rebuild it
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
         if self.group_by_modality:
             indices = get_modality_length_grouped_indices(
-                self.lengths, self.batch_size, self.world_size, generator=self.generator
+                self.lengths, self.batch_size, self.world_size, generator=generator
             )
         else:
             indices = get_length_grouped_indices(
-                self.lengths, self.batch_size, self.world_size, generator=self.generator
+                self.lengths, self.batch_size, self.world_size, generator=generator
             )
         return iter(indices)
 
 
+def get_audio_grouped_indices(audio_ids, batch_size, generator=None):
+    """
+    Pack the entries of each clip into the same `batch_size` chunk where possible.
+    Entries without audio (None) are their own group. Groups are taken in random order
+    and placed best-fit; a group is split only when nothing fits the room left in a
+    batch. Batches are shuffled, the (possibly short) last one stays last.
+    """
+    groups = {}
+    for i, audio_id in enumerate(audio_ids):
+        groups.setdefault(i if audio_id is None else audio_id, []).append(i)
+    groups = list(groups.values())
+    group_indices = torch.randperm(len(groups), generator=generator).tolist()
+
+    batches = []
+    # group size -> groups smaller than a batch
+    groups_by_size = [[] for _ in range(batch_size + 1)]
+    for group_idx in group_indices:
+        group = groups[group_idx]
+        num_full = len(group) // batch_size * batch_size
+        batches.extend(
+            group[i : i + batch_size] for i in range(0, num_full, batch_size)
+        )
+        if len(group) > num_full:
+            groups_by_size[len(group) - num_full].append(group[num_full:])
+
+    num_left = sum(len(g) for gs in groups_by_size for g in gs)
+    while num_left > 0:
+        batch = []
+        while len(batch) < batch_size and num_left > 0:
+            room = batch_size - len(batch)
+            size = next(
+                (size for size in range(room, 0, -1) if groups_by_size[size]), None
+            )
+            if size is None:
+                # nothing fits: split the smallest group
+                size = next(
+                    size for size in range(room + 1, batch_size) if groups_by_size[size]
+                )
+                group = groups_by_size[size].pop()
+                groups_by_size[size - room].append(group[room:])
+                group = group[:room]
+            else:
+                group = groups_by_size[size].pop()
+            batch.extend(group)
+            num_left -= len(group)
+        batches.append(batch)
+
+    if len(batches) == 0:
+        return []
+    batch_indices = torch.randperm(len(batches), generator=generator).tolist()
+    if len(batches[-1]) < batch_size:
+        # keep the short batch last so that every other chunk is a full batch
+        short_idx = len(batches) - 1
+        batch_indices.remove(short_idx)
+        batch_indices.append(short_idx)
+    return [i for batch_idx in batch_indices for i in batches[batch_idx]]
+
+
+class AudioGroupedSampler(Sampler):
+    r"""
+    Sampler that puts dataset entries sharing an audio clip in the same batch, so the
+    clip is decoded and encoded once per batch.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        audio_ids: Optional[List[str]] = None,
+        seed: int = 0,
+    ):
+        if audio_ids is None:
+            raise ValueError("Audio ids must be provided.")
+
+        self.batch_size = batch_size
+        self.audio_ids = audio_ids
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.audio_ids)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(
+            get_audio_grouped_indices(self.audio_ids, self.batch_size, generator)
+        )
+
+
+class EpochSeededRandomSampler(Sampler):
+    r"""
+    Random permutation of the dataset drawn from (seed, epoch), so a resumed run can
+    rebuild the order of any epoch without replaying the previous ones.
+    """
+
+    def __init__(self, num_samples: int, seed: int = 0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.num_samples, generator=generator).tolist())
+
+
+def get_token_budget_batches(lengths, max_tokens, max_batch_size=None, generator=None):
+    """
+    Pack indices into batches whose padded size (batch size x longest sample) stays
+    within `max_tokens`. Samples of equal length are shuffled with `generator`, so the
+    number of batches only depends on `lengths` and does not change across epochs.
+    """
+    indices = torch.randperm(len(lengths), generator=generator).tolist()
+    indices = sorted(indices, key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    batch = []
+    for index in indices:
+        # sorted in descending order, so the first sample of a batch is the longest
+        longest = lengths[batch[0]] if len(batch) > 0 else lengths[index]
+        if len(batch) > 0 and (
+            (len(batch) + 1) * longest > max_tokens
+            or (max_batch_size is not None and len(batch) == max_batch_size)
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler(Sampler):
+    r"""
+    Batch sampler that forms variable-size batches of at most `max_tokens` padded (text +
+    audio) tokens. Every rank builds the same global list of batches and keeps every
+    `world_size`-th one; the list is padded to a multiple of `world_size *
+    num_batches_multiple` so all ranks run the same number of (accumulation) steps.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        world_size: int = 1,
+        rank: int = 0,
+        max_batch_size: Optional[int] = None,
+        num_batches_multiple: int = 1,
+        seed: int = 0,
+        group_by_modality: bool = False,
+    ):
+        if lengths is None:
+            raise ValueError("Lengths must be provided.")
+
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.world_size = world_size
+        self.rank = rank
+        self.max_batch_size = max_batch_size
+        self.num_batches_multiple = num_batches_multiple
+        self.seed = seed
+        self.group_by_modality = group_by_modality
+        self.epoch = 0
+        self.num_batches = len(self._get_global_batches(generator=None))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _get_global_batches(self, generator):
+        if self.group_by_modality:
+            # same sign convention as `modality_lengths`: text-only samples are < 0
+            groups = [
+                [i for i, l in enumerate(self.lengths) if l > 0],
+                [i for i, l in enumerate(self.lengths) if l < 0],
+            ]
+        else:
+            groups = [list(range(len(self.lengths)))]
+
+        batches = []
+        for group in groups:
+            if len(group) == 0:
+                continue
+            group_batches = get_token_budget_batches(
+                [abs(self.lengths[i]) for i in group],
+                self.max_tokens,
+                max_batch_size=self.max_batch_size,
+                generator=generator,
+            )
+            batches.extend([[group[i] for i in batch] for batch in group_batches])
+
+        batch_indices = torch.randperm(len(batches), generator=generator).tolist()
+        batches = [batches[i] for i in batch_indices]
+
+        num_padding = -len(batches) % (self.world_size * self.num_batches_multiple)
+        batches += [batches[i % len(batches)] for i in range(num_padding)]
+        return batches
+
+    def __len__(self):
+        return self.num_batches // self.world_size
+
+    def __iter__(self):
+        # built eagerly so that the epoch counter advances as soon as iteration starts
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        batches = self._get_global_batches(generator)
+        return iter(batches[self.rank :: self.world_size])
+
+
 class LLaVATrainer(Trainer):
 
+    def __init__(self, *args, **kwargs):
+        super(LLaVATrainer, self).__init__(*args, **kwargs)
+        self.checkpoint_writer = AsyncCheckpointWriter(
+            max_in_flight=getattr(self.args, "checkpoint_max_in_flight", 2),
+            asynchronous=getattr(self.args, "async_checkpoint", True),
+        )
+        # `batch_stats` of the collator, summed over the steps since the last log
+        self._batch_stats = {}
+        self._batch_stats_start = None
+        self._audio_hours = None
+
+    def training_step(self, model, inputs):
+        batch_stats = inputs.pop("batch_stats", None)
+        if batch_stats is not None:
+            if self._batch_stats_start is None:
+                self._batch_stats_start = time.time()
+            for k, v in batch_stats.items():
+                self._batch_stats[k] = self._batch_stats.get(k, 0) + v
+        return super(LLaVATrainer, self).training_step(model, inputs)
+
+    def prediction_step(self, model, inputs, *args, **kwargs):
+        inputs.pop("batch_stats", None)
+        return super(LLaVATrainer, self).prediction_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs):
+        if "loss" in logs and self._batch_stats:
+            logs.update(self._reduce_batch_stats())
+        super(LLaVATrainer, self).log(logs)
+
+    def _reduce_batch_stats(self):
+        """Throughput and padding since the last log, summed over ranks in one reduce."""
+        keys = sorted(self._batch_stats)
+        totals = torch.tensor(
+            [float(self._batch_stats[k]) for k in keys],
+            dtype=torch.float64,
+            device=self.args.device,
+        )
+        totals = dict(zip(keys, self.accelerator.reduce(totals, "sum").tolist()))
+        elapsed = max(time.time() - self._batch_stats_start, 1e-6)
+        self._batch_stats = {}
+        self._batch_stats_start = None
+
+        if self._audio_hours is None:
+            # continue the running total of a resumed run
+            self._audio_hours = next(
+                (
+                    log["audio_hours"]
+                    for log in reversed(self.state.log_history)
+                    if "audio_hours" in log
+                ),
+                0.0,
+            )
+        self._audio_hours += totals["audio_seconds"] / 3600
+
+        tokens = totals["text_tokens"] + totals["audio_tokens"]
+        return {
+            "text_tokens": totals["text_tokens"],
+            "audio_tokens": totals["audio_tokens"],
+            "padded_tokens": totals["padded_tokens"],
+            "padding_fraction": totals["padded_tokens"]
+            / max(tokens + totals["padded_tokens"], 1),
+            "tokens_per_second": round(tokens / elapsed, 2),
+            "samples_per_second": round(totals["samples"] / elapsed, 3),
+            "audio_seconds_per_second": round(totals["audio_seconds"] / elapsed, 3),
+            "audio_hours": self._audio_hours,
+        }
+
     def _inner_training_loop(
         self,
         batch_size=None,
@@ -406,7 +736,16 @@ class LLaVATrainer(Trainer):
                 self.state.save_steps = args.save_steps
 
         # Activate gradient checkpointing if needed
-        if args.gradient_checkpointing:
+        checkpointing_policy = getattr(args, "gradient_checkpointing_policy", "all")
+        if args.gradient_checkpointing and checkpointing_policy != "all":
+            apply_llm_checkpointing(
+                self.model,
+                checkpointing_policy,
+                batch_size=self._checkpointing_batch_size(),
+                seq_len=self.tokenizer.model_max_length,
+                num_tokens=getattr(args, "max_tokens_per_batch", None),
+            )
+        elif args.gradient_checkpointing:
             if args.gradient_checkpointing_kwargs is None:
                 gradient_checkpointing_kwargs = {}
             else:
@@ -416,6 +755,16 @@ class LLaVATrainer(Trainer):
                 gradient_checkpointing_kwargs=gradient_checkpointing_kwargs
             )
 
+        audio_checkpointing_policy = getattr(
+            args, "audio_tower_checkpointing_policy", "none"
+        )
+        if audio_checkpointing_policy != "none":
+            apply_audio_tower_checkpointing(
+                self.model,
+                audio_checkpointing_policy,
+                batch_size=self._checkpointing_batch_size(),
+            )
+
         model = self._wrap_model(self.model_wrapped)
 
         # as the model is wrapped, don't use `accelerator.prepare`
@@ -501,6 +850,7 @@ class LLaVATrainer(Trainer):
         epochs_trained = 0
         steps_trained_in_current_epoch = 0
         steps_trained_progress_bar = None
+        data_state = None
 
         # Check if continuing training from a checkpoint
         if resume_from_checkpoint is not None and os.path.isfile(
@@ -518,6 +868,17 @@ class LLaVATrainer(Trainer):
             else:
                 steps_trained_in_current_epoch = 0
 
+            data_state = self._load_data_state(resume_from_checkpoint)
+            if data_state is not None and not args.ignore_data_skip:
+                epochs_trained = data_state["epoch"]
+                steps_trained_in_current_epoch = data_state["num_batches_consumed"]
+                if (
+                    len_dataloader is not None
+                    and steps_trained_in_current_epoch >= len_dataloader
+                ):
+                    epochs_trained += 1
+                    steps_trained_in_current_epoch = 0
+
             logger.info(
                 "  Continuing training from checkpoint, will skip to saved global_step"
             )
@@ -569,7 +930,10 @@ class LLaVATrainer(Trainer):
         )
 
         # Skip the first epochs_trained epochs to get the random state of the dataloader at the right point.
-        if not args.ignore_data_skip:
+        # Not needed with a saved data state if the order is drawn from (seed, epoch).
+        if not args.ignore_data_skip and (
+            data_state is None or not self._has_epoch_seeded_order(train_dataloader)
+        ):
             for epoch in range(epochs_trained):
                 sampler = get_dataloader_sampler(train_dataloader)
                 sampler_kinds = [RandomSampler]
@@ -591,6 +955,7 @@ class LLaVATrainer(Trainer):
             epoch_iterator = train_dataloader
             if hasattr(epoch_iterator, "set_epoch"):
                 epoch_iterator.set_epoch(epoch)
+            self._set_train_data_epoch(epoch_iterator, epoch)
 
             # Reset the past mems state at the beginning of each epoch if necessary.
             if args.past_index >= 0:
@@ -615,7 +980,7 @@ class LLaVATrainer(Trainer):
             rng_to_sync = False
             steps_skipped = 0
             if steps_trained_in_current_epoch > 0:
-                epoch_iterator = skip_first_batches(
+                epoch_iterator = self._skip_train_batches(
                     epoch_iterator, steps_trained_in_current_epoch
                 )
                 steps_skipped = steps_trained_in_current_epoch
@@ -623,7 +988,9 @@ class LLaVATrainer(Trainer):
                 rng_to_sync = True
 
             step = -1
-            for step, inputs in enumerate(epoch_iterator):
+            for step, inputs in enumerate(
+                step_profiler.iterate(epoch_iterator, "dataloader")
+            ):
                 total_batched_samples += 1
 
                 if step % 50 == 0:
@@ -662,13 +1029,16 @@ class LLaVATrainer(Trainer):
                 elif steps_trained_progress_bar is not None:
                     steps_trained_progress_bar.close()
                     steps_trained_progress_bar = None
+                self._train_data_position = (epoch, steps_skipped + step + 1)
 
                 if step % args.gradient_accumulation_steps == 0:
                     self.control = self.callback_handler.on_step_begin(
                         args, self.state, self.control
                     )
 
-                with self.accelerator.accumulate(model):
+                with self.accelerator.accumulate(model), step_profiler.phase(
+                    "forward_backward"
+                ):
                     tr_loss_step = self.training_step(model, inputs)
 
                 if (
@@ -701,6 +1071,8 @@ class LLaVATrainer(Trainer):
                     if is_last_step_and_steps_less_than_grad_acc:
                         self.accelerator.gradient_state._set_sync_gradients(True)
 
+                    # clipping, optimizer and scheduler steps
+                    step_profiler.start_phase("optimizer")
                     # Gradient clipping
                     if args.max_grad_norm is not None and args.max_grad_norm > 0:
                         # deepspeed does its own clipping
@@ -746,6 +1118,7 @@ class LLaVATrainer(Trainer):
                         ):
                             self.lr_scheduler.step()
                     model.zero_grad()
+                    step_profiler.end_phase()
                     self.state.global_step += 1
                     self.state.epoch = (
                         epoch + (step + 1 + steps_skipped) / steps_in_epoch
@@ -874,20 +1247,141 @@ class LLaVATrainer(Trainer):
 
         return TrainOutput(self.state.global_step, train_loss, metrics)
 
+    def _set_train_data_epoch(self, dataloader, epoch):
+        # accelerate only forwards `set_epoch` to `batch_sampler.sampler`, which misses
+        # our samplers once they are wrapped for sharding
+        for source in (
+            dataloader.batch_sampler,
+            get_dataloader_sampler(dataloader),
+            dataloader.dataset,
+        ):
+            if hasattr(source, "set_epoch"):
+                source.set_epoch(epoch)
+
+    def _has_epoch_seeded_order(self, dataloader):
+        """Whether the data order of an epoch only depends on (seed, epoch)."""
+        dataset = dataloader.dataset
+        if isinstance(dataset, IterableDataset) and hasattr(dataset, "skip_batches"):
+            # audio shards are shuffled by (seed, epoch) in the dataset
+            return True
+        seeded_samplers = (
+            LengthGroupedSampler,
+            AudioGroupedSampler,
+            TokenBudgetBatchSampler,
+            EpochSeededRandomSampler,
+        )
+        return isinstance(dataloader.batch_sampler, seeded_samplers) or isinstance(
+            get_dataloader_sampler(dataloader), seeded_samplers
+        )
+
+    def _skip_train_batches(self, dataloader, num_batches):
+        """Skips the first `num_batches` batches of the epoch without loading them."""
+        dataset = dataloader.dataset
+        if isinstance(dataset, IterableDataset) and hasattr(dataset, "skip_batches"):
+            dataset.skip_batches(num_batches, dataloader.batch_size)
+            return dataloader
+        # accelerate's SkipBatchSampler only draws (and drops) the skipped indices
+        return skip_first_batches(dataloader, num_batches)
+
+    def _save_data_state(self, output_dir):
+        if getattr(self, "_train_data_position", None) is None:
+            return
+        epoch, num_batches_consumed = self._train_data_position
+        data_state = {
+            "epoch": epoch,
+            "seed": self.args.seed,
+            "num_batches_consumed": num_batches_consumed,
+        }
+        with open(os.path.join(output_dir, TRAINER_DATA_STATE_NAME), "w") as fout:
+            json.dump(data_state, fout)
+
+    def _load_data_state(self, checkpoint):
+        data_state_file = os.path.join(checkpoint, TRAINER_DATA_STATE_NAME)
+        if not os.path.isfile(data_state_file):
+            return None
+        with open(data_state_file, "r") as fin:
+            data_state = json.load(fin)
+        if data_state["seed"] != self.args.seed:
+            logger.warning(
+                f"Checkpoint data order was drawn with seed {data_state['seed']}, "
+                f"resuming with seed {self.args.seed}: skipped samples will differ."
+            )
+        return data_state
+
+    def _checkpointing_batch_size(self):
+        # samples per device step, for the activation budget of a "budget:" policy
+        if getattr(self.args, "max_tokens_per_batch", None):
+            max_batch_size = getattr(self.args, "token_budget_max_batch_size", None)
+            if max_batch_size:
+                return max_batch_size
+        return self.args.per_device_train_batch_size
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         if self.train_dataset is None or not has_length(self.train_dataset):
             return None
 
-        if self.args.group_by_modality_length:
+        if getattr(self.args, "group_by_audio", False):
+            # chunks of the per-device batch size are dealt out to the ranks
+            return AudioGroupedSampler(
+                self.args.per_device_train_batch_size,
+                audio_ids=self.train_dataset.audio_ids,
+                seed=self.args.seed,
+            )
+        elif self.args.group_by_modality_length:
             lengths = self.train_dataset.modality_lengths
             return LengthGroupedSampler(
                 self.args.train_batch_size,
                 world_size=self.args.world_size * self.args.gradient_accumulation_steps,
                 lengths=lengths,
                 group_by_modality=True,
+                seed=self.args.seed,
             )
-        else:
+        elif self.args.group_by_length:
             return super()._get_train_sampler()
+        else:
+            # unlike RandomSampler, the order of an epoch can be rebuilt on resume
+            return EpochSeededRandomSampler(
+                len(self.train_dataset), seed=self.args.seed
+            )
+
+    def get_train_dataloader(self) -> DataLoader:
+        if isinstance(self.train_dataset, IterableDataset):
+            # audio shards are assigned to ranks by the dataset itself
+            dataloader = DataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+            return prepare_data_loader(dataloader, num_processes=1, process_index=0)
+
+        if getattr(self.args, "max_tokens_per_batch", None) is None:
+            return super().get_train_dataloader()
+
+        if self.train_dataset is None or not has_length(self.train_dataset):
+            raise ValueError("Token-budget batching requires a sized train_dataset.")
+
+        batch_sampler = TokenBudgetBatchSampler(
+            self.train_dataset.token_lengths,
+            max_tokens=self.args.max_tokens_per_batch,
+            world_size=self.args.world_size,
+            rank=self.args.process_index,
+            max_batch_size=self.args.token_budget_max_batch_size,
+            num_batches_multiple=self.args.gradient_accumulation_steps,
+            seed=self.args.seed,
+            group_by_modality=self.args.group_by_modality_length,
+        )
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            worker_init_fn=seed_worker,
+        )
+        # batches are already sharded across ranks by the sampler
+        return prepare_data_loader(dataloader, num_processes=1, process_index=0)
 
     def create_optimizer(self):
         """
@@ -1025,17 +1519,29 @@ class LLaVATrainer(Trainer):
             if getattr(self.args, "use_im_start_end", False):
                 keys_to_match.extend(["embed_tokens", "embed_in"])
 
-            weight_to_save = get_mm_adapter_state_maybe_zero_3(
-                self.model.named_parameters(), keys_to_match
-            )
+            weight_to_save = [
+                (k, t)
+                for k, t in self.model.named_parameters()
+                if any(key_match in k for key_match in keys_to_match)
+            ]
 
-            if self.args.local_rank == 0 or self.args.local_rank == -1:
+            should_write = self.args.local_rank == 0 or self.args.local_rank == -1
+            if should_write:
                 self.model.config.save_pretrained(output_dir)
-                torch.save(
-                    weight_to_save, os.path.join(output_dir, f"mm_projector.bin")
-                )
+            # written in the background; every rank snapshots (ZeRO-3 gathers)
+            self.checkpoint_writer.save(
+                weight_to_save,
+                os.path.join(output_dir, f"mm_projector.bin"),
+                write=should_write,
+            )
         else:
             super(LLaVATrainer, self)._save_checkpoint(model, trial, metrics)
+            if self.args.should_save:
+                from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+                checkpoint_folder = f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+                run_dir = self._get_output_dir(trial=trial)
+                self._save_data_state(os.path.join(run_dir, checkpoint_folder))
 
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         if getattr(self.args, "tune_mm_mlp_adapter", False):
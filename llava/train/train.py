@@ -5,7 +5,9 @@ import pathlib
 from typing import Dict, Optional
 import torch
 import transformers
+from llava.train.compiled_modules import compile_mm_modules
 from llava.train.llava_trainer import LLaVATrainer
+from llava.train.training_hooks import StepProfilerCallback
 from llava import conversation as conversation_lib
 from llava.model import *
 from dataloaders import make_supervised_data_module, DataArguments
@@ -79,7 +81,69 @@ class TrainingArguments(transformers.TrainingArguments):
     lora_weight_path: str = ""
     lora_bias: str = "none"
     mm_projector_lr: Optional[float] = None
+    async_checkpoint: bool = field(
+        default=True,
+        metadata={
+            "help": "Write projector / non-LoRA checkpoints on a background thread."
+        },
+    )
+    checkpoint_max_in_flight: int = field(
+        default=2,
+        metadata={"help": "Saves that may be pending before a new one waits."},
+    )
+    profile_every_n_steps: int = field(
+        default=0,
+        metadata={
+            "help": "Profile the phases of every N-th step (0: off); written to "
+            "output_dir/profile and TensorBoard."
+        },
+    )
+    profile_chrome_trace: bool = field(
+        default=False,
+        metadata={"help": "Also export the profiled steps as a Chrome trace."},
+    )
     group_by_modality_length: bool = field(default=False)
+    group_by_audio: bool = field(
+        default=False,
+        metadata={
+            "help": "Put entries sharing a `local_audio_path` in the same batch so the "
+            "clip is decoded and encoded once."
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Token budget (text + audio, after padding) of a per-device batch. "
+            "Enables dynamic batching; per_device_train_batch_size is then ignored."
+        },
+    )
+    token_budget_max_batch_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Upper bound on samples per batch with max_tokens_per_batch."
+        },
+    )
+    gradient_checkpointing_policy: str = field(
+        default="all",
+        metadata={
+            "help": "Decoder layers recomputed with --gradient_checkpointing: all, "
+            "every:<k>, attention, mlp or budget:<GiB> of saved activations."
+        },
+    )
+    audio_tower_checkpointing_policy: str = field(
+        default="none",
+        metadata={
+            "help": "Same for the AudioMAE blocks, with --stage2_tune_encoder only: "
+            "the frozen tower runs without gradients and saves no activations."
+        },
+    )
+    compile_mm_modules: bool = field(
+        default=False,
+        metadata={
+            "help": "torch.compile the audio tower and projector (static shapes, "
+            "eager fallback)."
+        },
+    )
 
 
 def maybe_zero_3(param, ignore_status=False, name=None):
@@ -182,13 +246,12 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer, output_dir: st
         if trainer.args.local_rank == 0 or trainer.args.local_rank == -1:
             if current_folder.startswith("checkpoint-"):
                 mm_projector_folder = os.path.join(parent_folder, "mm_projector")
-                os.makedirs(mm_projector_folder, exist_ok=True)
-                torch.save(
+                trainer.checkpoint_writer.save(
                     weight_to_save,
                     os.path.join(mm_projector_folder, f"{current_folder}.bin"),
                 )
             else:
-                torch.save(
+                trainer.checkpoint_writer.save(
                     weight_to_save, os.path.join(output_dir, f"mm_projector.bin")
                 )
         return
@@ -364,6 +427,10 @@ def train(attn_implementation=None):
         )
         data_args.image_processor = vision_tower.image_processor  # can be audio
         data_args.is_multimodal = True
+        if model_args.audio_tower is not None:
+            # AudioMAE averages each third of the input (512 patches) down to
+            # 512 // audio_num_pooling_tokens tokens, see AudioMAEencoder.pool_freq
+            data_args.num_audio_tokens = 512 // model_args.audio_num_pooling_tokens * 3
         # DECIDING process_images; not used if audio
         # default: square
         model.config.image_aspect_ratio = data_args.image_aspect_ratio
@@ -442,6 +509,10 @@ def train(attn_implementation=None):
             _param = next(model.base_model.model.model.vision_tower.parameters())
             assert _param.requires_grad
 
+    if training_args.compile_mm_modules and model_args.vision_tower is not None:
+        compile_mm_modules(model)
+
+    data_args.seed = training_args.seed
     data_module = make_supervised_data_module(tokenizer=tokenizer, data_args=data_args)
 
     trainer = LLaVATrainer(
@@ -450,6 +521,13 @@ def train(attn_implementation=None):
         args=training_args,
         **data_module,
     )
+    if training_args.profile_every_n_steps > 0:
+        trainer.add_callback(
+            StepProfilerCallback(
+                every_n_steps=training_args.profile_every_n_steps,
+                chrome_trace=training_args.profile_chrome_trace,
+            )
+        )
 
     if list(pathlib.Path(training_args.output_dir).glob("checkpoint-*")):
         trainer.train(resume_from_checkpoint=True)
@@ -468,16 +546,18 @@ def train(attn_implementation=None):
             model.named_parameters()
         )
         if training_args.local_rank == 0 or training_args.local_rank == -1:
-            model.config.save_pretrained(training_args.output_dir)
-            model.save_pretrained(training_args.output_dir, state_dict=state_dict)
-            torch.save(
+            # written in the background while the LoRA adapter is saved
+            trainer.checkpoint_writer.save(
                 non_lora_state_dict,
                 os.path.join(training_args.output_dir, "non_lora_trainables.bin"),
             )
+            model.config.save_pretrained(training_args.output_dir)
+            model.save_pretrained(training_args.output_dir, state_dict=state_dict)
     else:
         safe_save_model_for_hf_trainer(
             trainer=trainer, output_dir=training_args.output_dir
         )
+    trainer.checkpoint_writer.close()
 
 
 if __name__ == "__main__":
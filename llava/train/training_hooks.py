@@ -1,7 +1,12 @@
 import os
+import json
+import time
+
 from transformers import TrainerCallback, is_tensorboard_available
 import logging
 
+from llava.profiling import step_profiler
+
 # API ref: https://huggingface.co/docs/transformers/v4.21.1/en/main_classes/callback#transformers.TrainerCallback
 
 
@@ -113,3 +118,140 @@ class DetailedLoggingTensorBoardCallback(TrainerCallback):
         for tbw in self.tb_writers.values():
             tbw.close()
         self.tb_writers = None
+
+
+class StepProfilerCallback(TrainerCallback):
+    """
+    Samples every `every_n_steps`-th optimizer step with `step_profiler`. A sampled step
+    spans from its first dataloader fetch to `on_step_end`; for each one this writes a
+    JSONL record per rank (per-phase time, call count and peak memory, dataloader wait
+    fraction), the same scalars to TensorBoard on the main process and, with
+    `chrome_trace`, the phases to a Chrome trace (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, every_n_steps=100, output_dir=None, chrome_trace=False):
+        self.every_n_steps = every_n_steps
+        self.output_dir = output_dir
+        self.chrome_trace = chrome_trace
+        self._jsonl = None
+        self._tb_writer = None
+        self._trace_events = []
+
+    def _maybe_start_step(self, state):
+        if (state.global_step + 1) % self.every_n_steps == 0:
+            step_profiler.start_step()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        output_dir = self.output_dir or os.path.join(args.output_dir, "profile")
+        os.makedirs(output_dir, exist_ok=True)
+        self._rank = args.process_index
+        self._jsonl = open(
+            os.path.join(output_dir, f"steps_rank{self._rank}.jsonl"), "a"
+        )
+        self._trace_path = os.path.join(output_dir, f"trace_rank{self._rank}.json")
+        if state.is_world_process_zero and is_tensorboard_available():
+            from torch.utils.tensorboard import SummaryWriter
+
+            self._tb_writer = SummaryWriter(
+                log_dir=os.path.join(args.logging_dir, "profile")
+            )
+        self._maybe_start_step(state)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if step_profiler.active:
+            self._record(step_profiler.end_step(), state.global_step)
+        self._maybe_start_step(state)
+
+    def _record(self, events, step):
+        if not events:
+            return
+        step_start = min(event["start"] for event in events)
+        step_time = time.perf_counter() - step_start
+
+        phases = {}
+        for event in events:
+            phase = phases.setdefault(
+                event["name"], {"time": 0.0, "count": 0, "peak_memory_mb": None}
+            )
+            phase["time"] += event["end"] - event["start"]
+            phase["count"] += 1
+            if event["peak_memory"] is not None:
+                phase["peak_memory_mb"] = max(
+                    phase["peak_memory_mb"] or 0.0, event["peak_memory"] / 2**20
+                )
+        if "forward_backward" in phases and "prepare_inputs" in phases:
+            # the LLM share: forward_backward includes the multimodal input prep
+            phases["llm_forward_backward"] = {
+                "time": phases["forward_backward"]["time"]
+                - phases["prepare_inputs"]["time"],
+                "count": phases["forward_backward"]["count"],
+                "peak_memory_mb": phases["forward_backward"]["peak_memory_mb"],
+            }
+        dataloader_time = phases.get("dataloader", {}).get("time", 0.0)
+        record = {
+            "step": step,
+            "rank": self._rank,
+            "step_time": step_time,
+            "dataloader_wait_fraction": dataloader_time / step_time,
+            "phases": phases,
+        }
+        self._jsonl.write(json.dumps(record) + "\n")
+        self._jsonl.flush()
+
+        if self._tb_writer is not None:
+            self._tb_writer.add_scalar("profile/step_time", step_time, step)
+            self._tb_writer.add_scalar(
+                "profile/dataloader_wait_fraction",
+                record["dataloader_wait_fraction"],
+                step,
+            )
+            for name, phase in phases.items():
+                self._tb_writer.add_scalar(f"profile/{name}_time", phase["time"], step)
+                if phase["peak_memory_mb"] is not None:
+                    self._tb_writer.add_scalar(
+                        f"profile/{name}_peak_memory_mb", phase["peak_memory_mb"], step
+                    )
+            self._tb_writer.flush()
+
+        if self.chrome_trace:
+            self._trace_events.append(
+                {
+                    "name": f"step {step}",
+                    "ph": "X",
+                    "ts": step_start * 1e6,
+                    "dur": step_time * 1e6,
+                    "pid": self._rank,
+                    "tid": 0,
+                }
+            )
+            for event in events:
+                self._trace_events.append(
+                    {
+                        "name": event["name"],
+                        "ph": "X",
+                        "ts": event["start"] * 1e6,
+                        "dur": (event["end"] - event["start"]) * 1e6,
+                        "pid": self._rank,
+                        "tid": 0,
+                        "args": {
+                            "step": step,
+                            "peak_memory_mb": (
+                                event["peak_memory"] / 2**20
+                                if event["peak_memory"] is not None
+                                else None
+                            ),
+                        },
+                    }
+                )
+
+    def on_train_end(self, args, state, control, **kwargs):
+        step_profiler.end_step()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+        if self._tb_writer is not None:
+            self._tb_writer.close()
+            self._tb_writer = None
+        if self.chrome_trace:
+            with open(self._trace_path, "w") as fout:
+                json.dump({"traceEvents": self._trace_events}, fout)
@@ -0,0 +1,204 @@
+"""
+Step time against peak memory for the activation checkpointing policies of
+llava/model/activation_checkpointing.py, on a randomly initialized Llama decoder and
+on the AudioMAE ViT-B encoder (`AudioMAEencoder`, trainable as with
+--stage2_tune_encoder: frozen, it runs without gradients and saves nothing).
+
+    python scripts/bench_activation_checkpointing.py --batch_size 1 --seq_len 2048 \
+        --policies none all every:2 every:4 attention mlp budget:8 --plot ckpt.png
+
+Peak memory is measured on CUDA (allocated during forward + backward, on top of the
+weights). On CPU only the step time is measured and the memory column is the
+estimate the "budget:" policy uses.
+"""
+
+import argparse
+import copy
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import LlamaConfig, LlamaModel
+
+from llava.model.activation_checkpointing import (
+    apply_checkpointing,
+    llama_activation_bytes,
+    select_checkpointing,
+    vit_activation_bytes,
+)
+from llava.model.multimodal_encoder.audiomae_encoder import AudioMAEencoder
+
+
+def estimated_bytes(plan, num_layers, layer_bytes):
+    total = 0
+    for i in range(num_layers):
+        part = plan.get(i)
+        if part == "layer":
+            total += layer_bytes["input"]
+        else:
+            total += layer_bytes["attention"] + layer_bytes["mlp"]
+            if part is not None:
+                total += layer_bytes["input"] - layer_bytes[part]
+    return total
+
+
+def run_steps(model, forward, args):
+    device = torch.device(args.device)
+    times = []
+    peak = None
+    for step in range(args.warmup + args.steps):
+        model.zero_grad(set_to_none=True)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        forward().float().pow(2).mean().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() - baseline
+        if step >= args.warmup:
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2], peak
+
+
+def bench(name, model, layers, forward, layer_bytes, attention_name, args):
+    results = []
+    for policy in args.policies:
+        bench_model = copy.deepcopy(model)
+        bench_layers = layers(bench_model)
+        plan = select_checkpointing(policy, len(bench_layers), layer_bytes)
+        apply_checkpointing(bench_layers, plan, attention_name, "mlp")
+        seconds, peak = run_steps(bench_model, lambda: forward(bench_model), args)
+        estimate = estimated_bytes(plan, len(bench_layers), layer_bytes)
+        results.append((policy, seconds, peak, estimate))
+        peak_text = f"{peak / 2**30:8.2f}" if peak is not None else "       -"
+        print(
+            f"{name:8s} {policy:14s} {seconds * 1000:10.1f} ms {peak_text} GiB "
+            f"(est. {estimate / 2**30:.2f} GiB)"
+        )
+        del bench_model
+    return results
+
+
+def plot(all_results, path):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, len(all_results), figsize=(6 * len(all_results), 4))
+    for ax, (name, results) in zip(axes, all_results.items()):
+        for policy, seconds, peak, estimate in results:
+            memory = peak if peak is not None else estimate
+            ax.scatter(memory / 2**30, seconds * 1000)
+            ax.annotate(policy, (memory / 2**30, seconds * 1000))
+        measured = results[0][2] is not None
+        ax.set_xlabel(f"{'peak' if measured else 'estimated'} activation memory (GiB)")
+        ax.set_ylabel("step time (ms)")
+        ax.set_title(name)
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"=> Saved {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--policies",
+        nargs="+",
+        default=["none", "all", "every:2", "attention", "mlp", "budget:2"],
+    )
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seq_len", type=int, default=1024)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--intermediate_size", type=int, default=3584)
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--num_heads", type=int, default=16)
+    parser.add_argument("--num_kv_heads", type=int, default=4)
+    parser.add_argument("--attn_implementation", default="sdpa")
+    parser.add_argument("--audio_batch_size", type=int, default=1)
+    parser.add_argument("--audio_target_length", type=int, default=3072)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--device", default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument(
+        "--plot", default=None, help="Save the chart to this file (needs matplotlib)."
+    )
+    args = parser.parse_args()
+    dtype = torch.bfloat16 if args.bf16 else torch.float32
+
+    config = LlamaConfig(
+        hidden_size=args.hidden_size,
+        intermediate_size=args.intermediate_size,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        num_key_value_heads=args.num_kv_heads,
+        use_cache=False,
+        attn_implementation=args.attn_implementation,
+    )
+    llm = LlamaModel(config).to(args.device, dtype).train()
+    llm.embed_tokens.requires_grad_(False)
+    inputs_embeds = torch.randn(
+        args.batch_size,
+        args.seq_len,
+        args.hidden_size,
+        device=args.device,
+        dtype=dtype,
+        requires_grad=True,
+    )
+    llm_bytes = llama_activation_bytes(
+        llm.layers[0], config, args.batch_size * args.seq_len, args.seq_len
+    )
+
+    tower = AudioMAEencoder(
+        SimpleNamespace(
+            audio_pretrained_ckpt_path="vitb_finetuned.pth",
+            audio_input_target_length=args.audio_target_length,
+        ),
+        delay_load=True,
+    )
+    # what --stage2_tune_encoder does
+    tower.mae.requires_grad_(True)
+    tower = tower.to(args.device, dtype).train()
+    fbank = torch.randn(
+        args.audio_batch_size,
+        1,
+        args.audio_target_length,
+        128,
+        device=args.device,
+        dtype=dtype,
+    )
+    # each clip is encoded as 3 windows of target_length / 3 frames
+    seq_len = tower.mae.patch_embed.num_patches + 1
+    vit_bytes = vit_activation_bytes(
+        tower.mae.blocks[0], 3 * args.audio_batch_size * seq_len, seq_len
+    )
+
+    print(f"{'model':8s} {'policy':14s} {'step time':>13s} {'peak':>8s}")
+    print("-" * 60)
+    all_results = {
+        "llama": bench(
+            "llama",
+            llm,
+            lambda model: model.layers,
+            lambda model: model(inputs_embeds=inputs_embeds).last_hidden_state,
+            llm_bytes,
+            "self_attn",
+            args,
+        ),
+        "audiomae": bench(
+            "audiomae",
+            tower,
+            lambda model: model.mae.blocks,
+            lambda model: model(fbank),
+            vit_bytes,
+            "attn",
+            args,
+        ),
+    }
+    if args.plot:
+        plot(all_results, args.plot)
@@ -0,0 +1,111 @@
+"""
+Eager against `--compile_mm_modules` (llava/train/compiled_modules.py) on CPU for the
+modules it compiles: the AudioMAE tower forward (run under no_grad in training), the
+MAE blocks forward + backward (what `stage2_tune_encoder` would need) and the
+mlp2x_gelu projector forward + backward.
+
+    python scripts/bench_compile_mm_modules.py --batch_size 2 --steps 10
+
+The first compiled call includes compilation and is reported separately.
+"""
+
+import argparse
+import copy
+import time
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from llava.model.multimodal_encoder.audiomae_encoder import AudioMAEencoder
+from llava.model.multimodal_projector.builder import build_vision_projector
+from llava.train.compiled_modules import compile_forward
+
+
+class MAEFeatures(nn.Module):
+    """The MAE blocks of the tower without its no_grad wrapper."""
+
+    def __init__(self, mae):
+        super().__init__()
+        self.mae = mae
+
+    def forward(self, x):
+        return self.mae.forward_features_no_pooling(x)
+
+
+def step(module, x, backward):
+    if not backward:
+        with torch.no_grad():
+            return module(x)
+    module.zero_grad(set_to_none=True)
+    out = module(x)
+    out.float().pow(2).mean().backward()
+    return out
+
+
+def timed(module, x, backward, args):
+    start = time.perf_counter()
+    out = step(module, x, backward)
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(args.warmup + args.steps):
+        start = time.perf_counter()
+        step(module, x, backward)
+        times.append(time.perf_counter() - start)
+    return out.detach(), first, sorted(times[args.warmup :])[args.steps // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--audio_input_target_length", type=int, default=3072)
+    parser.add_argument("--audio_num_pooling_tokens", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=4096)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    cfg = SimpleNamespace(
+        audio_pretrained_ckpt_path="vitb_finetuned.pth",
+        audio_num_pooling_tokens=args.audio_num_pooling_tokens,
+        audio_input_target_length=args.audio_input_target_length,
+        mm_projector_type="mlp2x_gelu",
+        mm_hidden_size=768,
+        hidden_size=args.hidden_size,
+    )
+    tower = AudioMAEencoder(cfg, delay_load=True).eval()
+    fbank = torch.randn(args.batch_size, 1, args.audio_input_target_length, 128)
+    # the tower encodes each third of the input as its own sample
+    windows = torch.cat(torch.split(fbank, fbank.shape[2] // 3, dim=2), dim=0)
+    # eval: without drop path the eager and compiled outputs are comparable
+    mae = MAEFeatures(copy.deepcopy(tower.mae)).eval().requires_grad_(True)
+    projector = build_vision_projector(cfg)
+    # what the tower hands to the projector, see AudioMAEencoder.pool_freq
+    features = torch.randn(
+        args.batch_size, 512 // args.audio_num_pooling_tokens * 3, cfg.mm_hidden_size
+    )
+
+    cases = [
+        ("audio tower forward", tower, fbank, False),
+        ("mae forward+backward", mae, windows, True),
+        ("projector forward+backward", projector, features, True),
+    ]
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads")
+    for name, module, x, backward in cases:
+        compiled = compile_forward(copy.deepcopy(module), name)
+        eager_out, _, eager_seconds = timed(module, x, backward, args)
+        compiled_out, compile_seconds, compiled_seconds = timed(
+            compiled, x, backward, args
+        )
+        fell_back = getattr(compiled.forward, "failed", True)
+        print(
+            f"{name}: eager {eager_seconds * 1000:.1f} ms, compiled "
+            f"{compiled_seconds * 1000:.1f} ms ({eager_seconds / compiled_seconds:.2f}x"
+            f"{', fell back to eager' if fell_back else ''}), first compiled call "
+            f"{compile_seconds:.1f}s, max abs diff "
+            f"{(eager_out - compiled_out).abs().max().item():.2e}"
+        )
@@ -0,0 +1,72 @@
+"""
+Corpus BLEU time of `bleu_score` (per-sentence Counters of joined n-gram strings)
+against `vectorized_bleu_score` (int64 n-gram keys counted in NumPy), in process and
+with a process pool, on a synthetic corpus of Zipf-distributed words. The scores of
+all paths must be identical.
+
+    python scripts/bench_corpus_bleu.py --num_sentences 100000 --num_workers 8
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from llava.eval.torchtext_utils import bleu_score, vectorized_bleu_score
+
+
+def synthetic_corpus(num_sentences, vocab_size, max_refs, seed):
+    rng = np.random.default_rng(seed)
+    words = np.array([f"w{i}" for i in range(vocab_size)], dtype=object)
+
+    def sentence():
+        length = rng.integers(5, 40)
+        return list(words[np.minimum(rng.zipf(1.3, length), vocab_size) - 1])
+
+    candidates, references = [], []
+    for _ in range(num_sentences):
+        candidate = sentence()
+        refs = [sentence() for _ in range(rng.integers(1, max_refs + 1))]
+        # references share a stretch of the candidate, as for a reasonable model
+        start = rng.integers(0, len(candidate))
+        refs[0][: len(candidate) - start] = candidate[start:]
+        candidates.append(candidate)
+        references.append(refs)
+    return candidates, references
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_sentences", type=int, default=100000)
+    parser.add_argument("--vocab_size", type=int, default=20000)
+    parser.add_argument("--max_refs", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    candidates, references = synthetic_corpus(
+        args.num_sentences, args.vocab_size, args.max_refs, args.seed
+    )
+    reference, base = timed(lambda: bleu_score(candidates, references))
+    print(f"bleu_score: {reference:.12f} in {base:.2f}s")
+    runs = {
+        "vectorized": lambda: vectorized_bleu_score(candidates, references),
+        f"vectorized, {args.num_workers} workers": lambda: vectorized_bleu_score(
+            candidates,
+            references,
+            num_workers=args.num_workers,
+            chunk_size=args.chunk_size,
+        ),
+    }
+    for name, fn in runs.items():
+        score, seconds = timed(fn)
+        assert score == reference, (name, score, reference)
+        print(f"{name}: {score:.12f} in {seconds:.2f}s ({base / seconds:.1f}x)")
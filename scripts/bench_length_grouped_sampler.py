@@ -0,0 +1,151 @@
+"""
+Benchmark of the length-grouped index construction in llava/train/llava_trainer.py
+against the former list-based implementation (kept below as the reference).
+
+    python scripts/bench_length_grouped_sampler.py --num_samples 10000000 \
+        --world_size 64 --batch_size 16
+
+The reference is only timed up to --reference_num_samples (it takes minutes at 10M);
+its output is compared with the vectorized one at that size.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from llava.train.llava_trainer import (
+    get_length_grouped_indices,
+    get_modality_length_grouped_indices,
+)
+
+
+def reference_split_to_even_chunks(indices, lengths, num_chunks):
+    if len(indices) % num_chunks != 0:
+        return [indices[i::num_chunks] for i in range(num_chunks)]
+
+    num_indices_per_chunk = len(indices) // num_chunks
+
+    chunks = [[] for _ in range(num_chunks)]
+    chunks_lengths = [0 for _ in range(num_chunks)]
+    for index in indices:
+        shortest_chunk = chunks_lengths.index(min(chunks_lengths))
+        chunks[shortest_chunk].append(index)
+        chunks_lengths[shortest_chunk] += lengths[index]
+        if len(chunks[shortest_chunk]) == num_indices_per_chunk:
+            chunks_lengths[shortest_chunk] = float("inf")
+
+    return chunks
+
+
+def reference_get_length_grouped_indices(lengths, batch_size, world_size, generator):
+    indices = torch.randperm(len(lengths), generator=generator)
+    megabatch_size = world_size * batch_size
+    megabatches = [
+        indices[i : i + megabatch_size].tolist()
+        for i in range(0, len(lengths), megabatch_size)
+    ]
+    megabatches = [
+        sorted(megabatch, key=lambda i: lengths[i], reverse=True)
+        for megabatch in megabatches
+    ]
+    megabatches = [
+        reference_split_to_even_chunks(megabatch, lengths, world_size)
+        for megabatch in megabatches
+    ]
+    return [i for megabatch in megabatches for batch in megabatch for i in batch]
+
+
+def reference_get_modality_length_grouped_indices(
+    lengths, batch_size, world_size, generator
+):
+    mm_indices, mm_lengths = zip(*[(i, l) for i, l in enumerate(lengths) if l > 0])
+    lang_indices, lang_lengths = zip(*[(i, -l) for i, l in enumerate(lengths) if l < 0])
+    mm_shuffle = [
+        mm_indices[i]
+        for i in reference_get_length_grouped_indices(
+            mm_lengths, batch_size, world_size, generator=None
+        )
+    ]
+    lang_shuffle = [
+        lang_indices[i]
+        for i in reference_get_length_grouped_indices(
+            lang_lengths, batch_size, world_size, generator=None
+        )
+    ]
+    megabatch_size = world_size * batch_size
+    mm_megabatches = [
+        mm_shuffle[i : i + megabatch_size]
+        for i in range(0, len(mm_shuffle), megabatch_size)
+    ]
+    lang_megabatches = [
+        lang_shuffle[i : i + megabatch_size]
+        for i in range(0, len(lang_shuffle), megabatch_size)
+    ]
+    additional_batch = mm_megabatches[-1] + lang_megabatches[-1]
+    megabatches = mm_megabatches[:-1] + lang_megabatches[:-1]
+    megabatch_indices = torch.randperm(len(megabatches), generator=generator)
+    megabatches = [megabatches[i] for i in megabatch_indices]
+    if len(additional_batch) > 0:
+        megabatches.append(sorted(additional_batch))
+    return [i for megabatch in megabatches for i in megabatch]
+
+
+def timed(fn, lengths, args, seed):
+    # the modality variant draws its inner permutations from the global generator
+    torch.manual_seed(seed)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    start = time.perf_counter()
+    indices = fn(lengths, args.batch_size, args.world_size, generator=generator)
+    return indices, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_samples", type=int, default=10_000_000)
+    parser.add_argument("--reference_num_samples", type=int, default=1_000_000)
+    parser.add_argument("--world_size", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_length", type=int, default=2048)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lengths = rng.integers(1, args.max_length, size=args.num_samples)
+    # text-only samples are negative, as in `modality_lengths`
+    modality_lengths = lengths * rng.choice([1, -1], size=args.num_samples)
+
+    cases = [
+        (
+            "length_grouped",
+            get_length_grouped_indices,
+            reference_get_length_grouped_indices,
+            lengths,
+        ),
+        (
+            "modality_length_grouped",
+            get_modality_length_grouped_indices,
+            reference_get_modality_length_grouped_indices,
+            modality_lengths,
+        ),
+    ]
+    for name, fn, reference_fn, case_lengths in cases:
+        _, seconds = timed(fn, case_lengths, args, args.seed)
+        print(
+            f"{name}: {args.num_samples:,} samples, world_size {args.world_size}, "
+            f"batch_size {args.batch_size}: {seconds:.2f}s"
+        )
+
+        reference_lengths = case_lengths[: args.reference_num_samples]
+        indices, seconds = timed(fn, reference_lengths, args, args.seed)
+        reference_indices, reference_seconds = timed(
+            reference_fn, reference_lengths.tolist(), args, args.seed
+        )
+        print(
+            f"  at {len(reference_lengths):,} samples: {seconds:.2f}s vs "
+            f"{reference_seconds:.2f}s for the reference "
+            f"({reference_seconds / seconds:.1f}x), "
+            f"identical: {indices == reference_indices}"
+        )
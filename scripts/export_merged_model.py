@@ -0,0 +1,70 @@
+"""
+Merges a stage-2 LoRA checkpoint (base LLM + LoRA + non_lora_trainables.bin) and the
+AudioMAE weights into one directory holding a single safetensors file in its final
+dtype, the config and the tokenizer.
+
+    python scripts/export_merged_model.py --model-path checkpoints/llava-lora \
+        --model-base $LLAMA3_PATH --audio-ckpt vitb_finetuned.pth \
+        --save-path checkpoints/llava-merged
+
+Pass --save-path as the eval scripts' --model-path (without --model-base) to load it
+with `load_merged_model`.
+"""
+
+import argparse
+import time
+
+import torch
+
+from llava.mm_utils import get_model_name_from_path
+from llava.model.builder import (
+    load_merged_model,
+    load_pretrained_model,
+    save_merged_model,
+)
+
+
+def export(args):
+    start = time.perf_counter()
+    model_name = get_model_name_from_path(args.model_path)
+    tokenizer, model, _, _ = load_pretrained_model(
+        args.model_path,
+        args.model_base,
+        model_name,
+        device="cpu",
+        is_audio_model=True,
+        audio_ckpt=args.audio_ckpt,
+        audio_target_len=args.audio_target_len,
+    )
+    print(f"=> Loaded and merged in {time.perf_counter() - start:.1f}s")
+    save_merged_model(
+        model,
+        tokenizer,
+        args.save_path,
+        dtype=getattr(torch, args.dtype),
+        model_path=args.model_path,
+        model_base=args.model_base,
+        audio_ckpt=args.audio_ckpt,
+    )
+    print(f"=> Saved {args.save_path}")
+    if args.check_load:
+        del model
+        load_merged_model(args.save_path, device="cpu")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, required=True)
+    parser.add_argument("--audio-ckpt", type=str, required=True)
+    parser.add_argument("--audio-target-len", type=int, default=1024 * 3)
+    parser.add_argument("--save-path", type=str, required=True)
+    parser.add_argument(
+        "--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16"]
+    )
+    parser.add_argument(
+        "--check-load", action="store_true", help="Reload the export and time it."
+    )
+    args = parser.parse_args()
+
+    export(args)
@@ -0,0 +1,161 @@
+"""
+Accuracy and latency of the CPU inference path (llava/model/quantization.py): loads
+the model on CPU in fp32 and with each `--quantize` mode, runs greedy decoding on a
+fixed list of clips and compares every quantized run against fp32.
+
+    python scripts/report_cpu_quantization.py --model-path checkpoints/llava-merged \
+        --clips cpu_report_clips.json --modes fp32 int8 int4
+
+`--clips` is a JSON list of {"local_audio_path": ..., "instruction": ...}, the
+format of MusicQACaptioningTest.json. Per mode it reports the model size, the
+median latency per clip and decode tokens/s, the share of clips whose greedy output
+equals the fp32 one, and, teacher-forced on the fp32 outputs, the top-1 next-token
+agreement and the mean KL(fp32 || mode).
+"""
+
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
+from llava.conversation import conv_templates
+from llava.mm_utils import (
+    get_model_name_from_path,
+    process_audio,
+    tokenizer_image_token,
+)
+from llava.model.builder import load_pretrained_model
+from llava.model.quantization import model_size_bytes
+from llava.utils import disable_torch_init
+
+
+def encode_clip(clip, tokenizer, image_processor, model, args):
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + clip["instruction"])
+    conv.append_message(conv.roles[1], None)
+    input_ids = tokenizer_image_token(
+        conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt"
+    ).unsqueeze(0)
+    audio = process_audio(
+        [{"local_audio_path": clip["local_audio_path"]}], image_processor, model.config
+    )[0]
+    return input_ids, audio.unsqueeze(0).unsqueeze(0).to(model.dtype)
+
+
+@torch.inference_mode()
+def run_mode(mode, clips, args):
+    tokenizer, model, image_processor, _ = load_pretrained_model(
+        os.path.expanduser(args.model_path),
+        args.model_base,
+        get_model_name_from_path(args.model_path),
+        device="cpu",
+        is_audio_model=True,
+        audio_ckpt=args.audio_ckpt,
+        quantize=None if mode == "fp32" else mode,
+    )
+    model.eval()
+    results = []
+    for clip in clips:
+        input_ids, images = encode_clip(clip, tokenizer, image_processor, model, args)
+        start = time.perf_counter()
+        output_ids = model.generate(
+            input_ids,
+            images=images,
+            image_sizes=[(1024, 128)],
+            do_sample=False,
+            num_beams=1,
+            max_new_tokens=args.max_new_tokens,
+            use_cache=True,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "input_ids": input_ids,
+                "images": images,
+                "output_ids": output_ids[0],
+                "seconds": seconds,
+            }
+        )
+    return model, tokenizer, results
+
+
+@torch.inference_mode()
+def teacher_forced_logits(model, input_ids, images, output_ids):
+    """Next-token logits over the reference output, fed after the prompt."""
+    ids = torch.cat([input_ids, output_ids.unsqueeze(0)], dim=1)
+    logits = model(ids, images=images.to(model.dtype), image_sizes=[(1024, 128)])[0]
+    # the audio placeholder expands to several positions, so count from the end
+    return logits[0, -output_ids.numel() - 1 : -1].float()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--audio-ckpt", type=str, default="vitb_finetuned.pth")
+    parser.add_argument("--clips", type=str, required=True)
+    parser.add_argument("--num-clips", type=int, default=None)
+    parser.add_argument("--conv-mode", type=str, default="llama_3")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["fp32", "int8", "int4"],
+        choices=["fp32", "int8", "int4"],
+    )
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    disable_torch_init()
+
+    with open(args.clips) as fin:
+        clips = json.load(fin)[: args.num_clips]
+    modes = ["fp32"] + [m for m in args.modes if m != "fp32"]
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads")
+
+    reference = None
+    for mode in modes:
+        model, tokenizer, results = run_mode(mode, clips, args)
+        seconds = sorted(r["seconds"] for r in results)[len(results) // 2]
+        new_tokens = sum(r["output_ids"].numel() for r in results)
+        line = (
+            f"{mode}: {model_size_bytes(model) / 2**30:.2f} GiB, "
+            f"{seconds:.2f} s/clip (median), "
+            f"{new_tokens / sum(r['seconds'] for r in results):.1f} tokens/s"
+        )
+        if reference is None:
+            reference = results
+            # fp32 logits over its own outputs, the target of the comparisons below
+            for r in reference:
+                r["logits"] = teacher_forced_logits(
+                    model, r["input_ids"], r["images"], r["output_ids"]
+                )
+        else:
+            exact, agree, kl, positions = 0, 0, 0.0, 0
+            for r, ref in zip(results, reference):
+                exact += torch.equal(r["output_ids"], ref["output_ids"])
+                logits = teacher_forced_logits(
+                    model, ref["input_ids"], ref["images"], ref["output_ids"]
+                )
+                agree += (logits.argmax(-1) == ref["logits"].argmax(-1)).sum().item()
+                kl += F.kl_div(
+                    logits.log_softmax(-1),
+                    ref["logits"].log_softmax(-1),
+                    log_target=True,
+                    reduction="sum",
+                ).item()
+                positions += logits.shape[0]
+            line += (
+                f", greedy exact match {exact}/{len(results)}, top-1 agreement "
+                f"{agree / max(positions, 1):.3f}, "
+                f"KL {kl / max(positions, 1):.4f} nats/token"
+            )
+        print(line)
+        del model
+    print(f"{len(clips)} clips from {args.clips}, {args.max_new_tokens} new tokens max")
@@ -0,0 +1,153 @@
+"""
+Quality, memory and throughput of the int8 KV cache
+(llava/model/kv_cache_quantization.py) on OpenMU-Bench captioning: decodes the captioning questions with the default cache
+and with `kv_cache_quantization="int8"` on the same loaded model and compares both.
+
+    python scripts/report_kv_cache_quantization.py --model-path checkpoints/llava-merged \
+        --question-file MusicQACaptioningTest.json --num-questions 200
+
+Per mode it reports BLEU-4, METEOR and ROUGE-L against the gold captions
+(llava/eval/eval_utils.py), decode tokens/s, the KV cache size per prompt token and
+for the mean prompt, and on GPU the peak memory of generation. For int8 it also
+reports the share of outputs equal to those of the default cache.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import torch
+
+from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN
+from llava.conversation import conv_templates
+from llava.eval.eval_utils import bleu, meteor, rouge
+from llava.mm_utils import (
+    get_model_name_from_path,
+    process_audio,
+    tokenizer_image_token,
+)
+from llava.model.builder import load_pretrained_model
+from llava.utils import disable_torch_init
+
+
+def encode_question(line, tokenizer, image_processor, model, args):
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], DEFAULT_IMAGE_TOKEN + "\n" + line["instruction"])
+    conv.append_message(conv.roles[1], None)
+    input_ids = tokenizer_image_token(
+        conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt"
+    ).unsqueeze(0)
+    audio = process_audio(
+        [{"local_audio_path": line["local_audio_path"]}], image_processor, model.config
+    )[0]
+    images = audio.unsqueeze(0).unsqueeze(0).to(model.device, dtype=model.dtype)
+    return input_ids.to(model.device), images
+
+
+def kv_cache_bytes(past_key_values):
+    if hasattr(past_key_values, "num_bytes"):
+        return past_key_values.num_bytes()
+    return sum(t.numel() * t.element_size() for kv in past_key_values for t in kv)
+
+
+@torch.inference_mode()
+def run_mode(mode, model, tokenizer, inputs, args):
+    model.config.kv_cache_quantization = mode
+    outputs, seconds, new_tokens, cache_bytes, prompt_tokens = [], 0.0, 0, 0, 0
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    for input_ids, images in inputs:
+        past_key_values = model(
+            input_ids, images=images, image_sizes=[(1024, 128)], use_cache=True
+        ).past_key_values
+        cache_bytes += kv_cache_bytes(past_key_values)
+        prompt_tokens += (
+            past_key_values.get_seq_length()
+            if hasattr(past_key_values, "get_seq_length")
+            else past_key_values[0][0].shape[2]
+        )
+        del past_key_values
+
+        start = time.perf_counter()
+        output_ids = model.generate(
+            input_ids,
+            images=images,
+            image_sizes=[(1024, 128)],
+            do_sample=False,
+            num_beams=args.num_beams,
+            max_new_tokens=args.max_new_tokens,
+            use_cache=True,
+            pad_token_id=tokenizer.eos_token_id,
+        )
+        seconds += time.perf_counter() - start
+        new_tokens += output_ids.shape[1]
+        outputs.append(
+            tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
+        )
+    peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+    stats = {
+        "tokens/s": new_tokens / seconds,
+        "bytes/token": cache_bytes / prompt_tokens,
+        "prompt MiB": cache_bytes / len(inputs) / 2**20,
+        "peak": peak,
+    }
+    return outputs, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--audio-ckpt", type=str, default="vitb_finetuned.pth")
+    parser.add_argument(
+        "--question-file", type=str, default="MusicQACaptioningTest.json"
+    )
+    parser.add_argument("--num-questions", type=int, default=None)
+    parser.add_argument("--conv-mode", type=str, default="llama_3")
+    parser.add_argument("--num-beams", type=int, default=2)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+    disable_torch_init()
+
+    tokenizer, model, image_processor, _ = load_pretrained_model(
+        os.path.expanduser(args.model_path),
+        args.model_base,
+        get_model_name_from_path(args.model_path),
+        device=args.device,
+        is_audio_model=True,
+        audio_ckpt=args.audio_ckpt,
+    )
+    # bf16 on GPU; on CPU the dtype the model was loaded in
+    dtype = model.dtype if args.device == "cpu" else torch.bfloat16
+    model = model.to(args.device, dtype=dtype).eval()
+    with open(args.question_file) as fin:
+        questions = json.load(fin)[: args.num_questions]
+    inputs = [
+        encode_question(line, tokenizer, image_processor, model, args)
+        for line in questions
+    ]
+    gold = [line["output"] for line in questions]
+
+    reference = None
+    for mode in [None, "int8"]:
+        outputs, stats = run_mode(mode, model, tokenizer, inputs, args)
+        line = (
+            f"{mode or 'default'}: BLEU-4 {bleu(outputs, [[g] for g in gold], 4):.4f}, "
+            f"METEOR {meteor(outputs, gold):.4f}, ROUGE-L {rouge(outputs, gold):.4f}, "
+            f"{stats['tokens/s']:.1f} tokens/s, KV {stats['bytes/token'] / 1024:.1f} "
+            f"KiB/token ({stats['prompt MiB']:.1f} MiB per prompt)"
+        )
+        if stats["peak"] is not None:
+            line += f", peak memory {stats['peak'] / 2**30:.2f} GiB"
+        if reference is None:
+            reference = outputs
+        else:
+            same = sum(a == b for a, b in zip(outputs, reference))
+            line += f", same output as default {same}/{len(outputs)}"
+        print(line)
+    print(
+        f"{len(questions)} questions from {args.question_file}, {args.num_beams} "
+        f"beams, {args.max_new_tokens} new tokens max"
+    )